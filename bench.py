@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Benchmarks of winazurestorage against the local fake server (fakeazure.py).
+
+    python bench.py                          # run everything, write bench-results.json
+    python bench.py -b blob -b table_scan    # only benchmarks whose name contains these
+    python bench.py --latency 0.002 --scale 0.1 -o quick.json
+    python bench.py --compare base.json      # print the ratios against an earlier run
+
+Every benchmark reports ops/sec, p50/p99 latency per operation, CPU seconds and the peak
+resident memory of the process. The results file records the git commit, so runs of
+different commits can be compared with --compare.
+'''
+
+import sys
+import os
+import time
+import json
+import platform
+import resource
+import subprocess
+import optparse
+from cStringIO import StringIO
+from datetime import datetime
+
+from winazurestorage import *
+from fakeazure import FakeAzure
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class Benchmark(object):
+    '''Runs one benchmark and collects its per-operation latencies and resource use.'''
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.extra = {}
+
+    def __enter__(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._cpu = usage.ru_utime + usage.ru_stime
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.time() - self._start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu_seconds = usage.ru_utime + usage.ru_stime - self._cpu
+        self.maxrss_kb = usage.ru_maxrss
+
+    def time(self, func, *args):
+        '''Call func(*args), recording its latency. Safe to use from several threads.'''
+        start = time.time()
+        result = func(*args)
+        self.latencies.append(time.time() - start)
+        return result
+
+    def result(self, ops = None):
+        if ops is None: ops = len(self.latencies)
+        result = {"ops": ops, "seconds": self.seconds, "ops_per_sec": ops / self.seconds if self.seconds else None,
+                  "cpu_seconds": self.cpu_seconds, "maxrss_kb": self.maxrss_kb,
+                  "p50_ms": None, "p99_ms": None}
+        if self.latencies:
+            result["p50_ms"] = percentile(self.latencies, 50) * 1000
+            result["p99_ms"] = percentile(self.latencies, 99) * 1000
+        result.update(self.extra)
+        return result
+
+class Runner(object):
+    def __init__(self, fake, scale, selected):
+        self.fake = fake
+        self.scale = scale
+        self.selected = selected
+        self.results = {}
+
+    def count(self, n):
+        return max(1, int(n * self.scale))
+
+    def run(self, name, func):
+        if self.selected and not [pattern for pattern in self.selected if pattern in name]: return
+        bench = Benchmark(name)
+        func(bench)
+        result = self.results[name] = bench.result(bench.extra.pop("ops", None))
+        line = "%-28s %10.1f ops/s  cpu %6.2f s  rss %7d KB" % (name, result["ops_per_sec"] or 0, result["cpu_seconds"], result["maxrss_kb"])
+        if result["p50_ms"] is not None and len(bench.latencies) > 1:
+            line += "  p50 %.3f ms  p99 %.3f ms" % (result["p50_ms"], result["p99_ms"])
+        for key in sorted(bench.extra):
+            line += "  %s %s" % (key, isinstance(bench.extra[key], float) and "%.1f" % bench.extra[key] or bench.extra[key])
+        print line
+        sys.stdout.flush()
+
+    def blobs(self, **options):
+        return BlobStorage(self.fake.blob_host, self.fake.account, self.fake.key, **options)
+
+    def queues(self, **options):
+        return QueueStorage(self.fake.queue_host, self.fake.account, self.fake.key, **options)
+
+    def tables(self, **options):
+        return TableStorage(self.fake.table_host, self.fake.account, self.fake.key, **options)
+
+def bench_signing(runner):
+    credentials = SharedKeyCredentials(runner.fake.account, runner.fake.key)
+    n = runner.count(20000)
+    def sign(bench, method):
+        with bench:
+            for i in xrange(n):
+                req = RequestWithMethod("PUT", "http://127.0.0.1:10000/%s/container/blob%d?comp=block&blockid=YQ%%3D%%3D" % (runner.fake.account, i), data = "")
+                req.add_header("Content-Type", "application/octet-stream")
+                req.add_header("x-ms-meta-owner", "bench")
+                bench.time(getattr(credentials, method), req)
+    runner.run("sign_request", lambda bench: sign(bench, "sign_request"))
+    runner.run("sign_table_request", lambda bench: sign(bench, "sign_table_request"))
+
+def bench_blobs(runner):
+    blobs = runner.blobs()
+    blobs.create_container("bench")
+    small = "x" * 1024
+    n = runner.count(2000)
+
+    def put_small(bench):
+        with bench:
+            for i in xrange(n): bench.time(blobs.put_blob, "bench", "small/%06d" % i, small)
+    runner.run("blob_put_1k", put_small)
+
+    def get_small(bench, storage):
+        with bench:
+            for i in xrange(n): bench.time(storage.get_blob, "bench", "small/%06d" % (i % 100))
+    blobs.put_many("bench", [("small/%06d" % i, small) for i in xrange(100)]).wait()
+    runner.run("blob_get_1k", lambda bench: get_small(bench, blobs))
+    # Same requests with a new connection each time, to show what the pool saves.
+    runner.run("blob_get_1k_no_pool", lambda bench: get_small(bench, runner.blobs(connection_pool = ConnectionPool(max_idle_per_host = 0))))
+
+    def async_get(bench):
+        async_blobs = AsyncBlobStorage(runner.fake.blob_host, runner.fake.account, runner.fake.key)
+        count = runner.count(10000)
+        with bench:
+            futures = [async_blobs.get_blob("bench", "small/%06d" % (i % 100)) for i in xrange(count)]
+            for future in futures: future.result()
+        async_blobs.close()
+        bench.extra["ops"] = count
+    runner.run("blob_get_1k_async", async_get)
+
+    size = runner.count(64) * 1024 * 1024
+    payload = os.urandom(1024 * 1024) * (size / (1024 * 1024))
+    def upload(bench):
+        with bench:
+            bench.time(blobs.upload_stream, "bench", "large", StringIO(payload))
+        bench.extra["bytes"] = size
+        bench.extra["mb_per_sec"] = size / bench.seconds / 1024 / 1024
+    runner.run("blob_upload_large", upload)
+    if "blob_upload_large" not in runner.results: blobs.upload_stream("bench", "large", StringIO(payload))
+
+    def download(bench):
+        file_name = "bench-download.tmp"
+        try:
+            with bench:
+                bench.time(blobs.download_blob_to_file, "bench", "large", file_name)
+        finally:
+            os.remove(file_name)
+        bench.extra["bytes"] = size
+        bench.extra["mb_per_sec"] = size / bench.seconds / 1024 / 1024
+    runner.run("blob_download_large", download)
+
+    # Compressible content, as JSON exports are, sent as is and gzip compressed with MD5s.
+    rows = runner.count(200000)
+    text = "\n".join('{"id": %d, "name": "row %d", "status": "active"}' % (i, i) for i in xrange(rows))
+    def upload_text(bench, blob_name, **options):
+        with bench:
+            bench.time(lambda: blobs.upload_stream("bench", blob_name, StringIO(text), **options))
+        bench.extra["bytes"] = len(text)
+        bench.extra["bytes_sent"] = int(blobs.get_blob_properties("bench", blob_name)["content-length"])
+        bench.extra["mb_per_sec"] = len(text) / bench.seconds / 1024 / 1024
+    runner.run("blob_upload_text", lambda bench: upload_text(bench, "text"))
+    runner.run("blob_upload_text_gzip", lambda bench: upload_text(bench, "text.gz", content_encoding = "gzip", compute_md5 = True))
+
+    count = runner.count(20000)
+    blobs.put_many("bench", [("list/%06d" % i, "") for i in xrange(count)]).wait()
+    def list_all(bench):
+        with bench:
+            listed = bench.time(lambda: sum(1 for blob in blobs.list_blobs("bench", "list/")))
+        bench.extra["ops"] = listed
+    runner.run("blob_list", list_all)
+    blobs.delete_container("bench")
+
+def bench_queues(runner):
+    queues = runner.queues()
+    queues.create_queue("bench")
+    n = runner.count(2000)
+    def put(bench):
+        with bench:
+            for i in xrange(n): bench.time(queues.put_message, "bench", "message %d" % i)
+    runner.run("queue_put", put)
+    if "queue_put" not in runner.results:
+        for i in xrange(n): queues.put_message("bench", "message %d" % i)
+
+    def get_delete(bench):
+        received = 0
+        with bench:
+            while True:
+                messages = bench.time(queues.get_messages, "bench", QUEUE_MAX_MESSAGES, 60)
+                if not messages: break
+                received += len(messages)
+                queues.delete_messages("bench", messages)
+        bench.extra["ops"] = received
+    runner.run("queue_get_delete", get_delete)
+    queues.delete_queue("bench")
+
+def make_entity(i):
+    return TableEntity("partition%02d" % (i % 20), "row%08d" % i,
+                       {"Name": "entity %d" % i, "Count": i, "Total": i * 1.5, "Active": i % 2 == 0,
+                        "Created": datetime(2013, 1, 1, 12, 0, i % 60), "Big": long(i) << 33})
+
+def bench_tables(runner):
+    n = runner.count(10000)
+    entities = [make_entity(i) for i in xrange(n)]
+
+    def serialize(bench, func):
+        with bench:
+            for entity in entities: func(entity.partition_key, entity.row_key, entity.properties)
+        bench.extra["ops"] = n
+    runner.run("table_serialize_atom", lambda bench: serialize(bench, serialize_entity))
+    runner.run("table_serialize_json", lambda bench: serialize(bench, serialize_json_entity))
+
+    def compile_filters(bench):
+        # One shape, so every compile after the first reuses the cached template.
+        with bench:
+            for entity in entities:
+                ((Property("PartitionKey") == entity.partition_key) & (Property("RowKey") >= entity.row_key) & (Property("Big") < entity.properties["Big"])).compile()
+        bench.extra["ops"] = n
+    runner.run("table_filter_compile", compile_filters)
+
+    tables = runner.tables()
+    tables.create_table("bench")
+    def insert(bench):
+        with bench:
+            for entity in entities[:runner.count(1000)]: bench.time(tables.insert_entity, "bench", entity)
+    runner.run("table_insert", insert)
+    if "table_insert" not in runner.results: tables.write_entities("bench", entities[:runner.count(1000)])
+
+    def batch_insert(bench):
+        with bench:
+            failures = tables.write_entities("bench", entities[runner.count(1000):])
+        bench.extra["ops"] = n - runner.count(1000)
+        bench.extra["failures"] = len(failures)
+    runner.run("table_batch_insert", batch_insert)
+    if "table_batch_insert" not in runner.results: tables.write_entities("bench", entities[runner.count(1000):])
+
+    for payload_format in (PAYLOAD_ATOM, PAYLOAD_MINIMAL_METADATA, PAYLOAD_NO_METADATA):
+        def scan(bench, payload_format = payload_format):
+            metrics = MetricsCollector()
+            storage = runner.tables(payload_format = payload_format, instrumentation = metrics)
+            with bench:
+                scanned = sum(1 for entity in storage.iter_entities("bench"))
+            bytes_in = sum(stats["bytes_in"] for stats in metrics.snapshot().values())
+            bench.extra.update(ops = scanned, bytes_per_1000 = bytes_in * 1000 / scanned,
+                               cpu_ms_per_1000 = bench.cpu_seconds * 1000000 / scanned)
+        runner.run("table_scan_%s" % payload_format, scan)
+
+    # The fake answers from this process, so with no latency the workers mostly contend
+    # for the GIL; 50ms, about what a page of a table query takes, shows how the scan
+    # overlaps requests.
+    boundaries = ["partition%02d" % i for i in xrange(1, 20)]
+    edges = [None] + boundaries + [None]
+    latency, runner.fake.latency = runner.fake.latency, runner.fake.latency or 0.05
+    for workers in (1, 2, 4, 8):
+        def parallel_scan(bench, workers = workers):
+            with bench:
+                scanned = tables.scan_entities("bench", lambda entity: None, ranges = zip(edges, edges[1:]), max_workers = workers)
+            bench.extra["ops"] = scanned
+        runner.run("table_scan_parallel_%d" % workers, parallel_scan)
+    runner.fake.latency = latency
+
+    def parse(bench):
+        # Parsing alone, from a page held in memory.
+        response = tables._open_query("bench", None, None, None, None)
+        page = response.read()
+        with bench:
+            for i in xrange(max(1, runner.count(10))):
+                parsed = sum(1 for entity in tables._iter_entities(StringIO(page)))
+        bench.extra["ops"] = parsed * max(1, runner.count(10))
+    runner.run("table_parse_atom", parse)
+    tables.delete_table("bench")
+
+BENCHMARKS = (bench_signing, bench_blobs, bench_queues, bench_tables)
+
+def git_commit():
+    try:
+        return subprocess.Popen(["git", "rev-parse", "HEAD"], stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def compare(results, base_file):
+    with open(base_file) as f:
+        base = json.load(f)
+    print
+    print "Compared with %s (commit %s):" % (base_file, base.get("commit"))
+    for name in sorted(results["results"]):
+        before = base["results"].get(name)
+        if not before or not before.get("ops_per_sec"): continue
+        after = results["results"][name]
+        print "%-28s %6.2fx ops/s  %6.2fx cpu" % (name, after["ops_per_sec"] / before["ops_per_sec"],
+                                                  after["cpu_seconds"] / before["cpu_seconds"] if before["cpu_seconds"] else 0)
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-o", "--output", default = "bench-results.json", help = "results file [%default]")
+    parser.add_option("-b", "--benchmark", action = "append", default = [], help = "only run benchmarks whose name contains this")
+    parser.add_option("--scale", type = "float", default = 1.0, help = "multiply every operation count by this")
+    parser.add_option("--latency", type = "float", default = 0, help = "seconds the fake server adds to every request")
+    parser.add_option("--failure-rate", type = "float", default = 0, help = "share of requests failing with 503")
+    parser.add_option("--compare", help = "results file of an earlier run to compare with")
+    options, args = parser.parse_args()
+
+    fake = FakeAzure(latency = options.latency, failure_rate = options.failure_rate, seed = 1).start()
+    runner = Runner(fake, options.scale, options.benchmark)
+    try:
+        for benchmark in BENCHMARKS:
+            benchmark(runner)
+    finally:
+        fake.stop()
+    results = {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+               "python": sys.version.split()[0], "platform": platform.platform(),
+               "options": {"scale": options.scale, "latency": options.latency, "failure_rate": options.failure_rate},
+               "results": runner.results}
+    with open(options.output, "w") as f:
+        json.dump(results, f, indent = 2, sort_keys = True)
+    print "Results written to %s" % options.output
+    if options.compare: compare(results, options.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,845 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+A local stand-in for the Windows Azure blob, queue and table services. It implements the
+subset of the REST API used by winazurestorage, keeps everything in memory, and can add
+latency and inject failures, so the library can be exercised and benchmarked offline:
+
+    fake = FakeAzure(latency = 0.002)
+    fake.start()
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    ...
+    fake.stop()
+
+Requests are not authenticated. Table queries support $filter (comparisons combined with
+and, or, not and parentheses), $select, $top and continuation tokens.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import socket
+import random
+import re
+import time
+import uuid
+import json
+import base64
+import hashlib
+from xml.etree.cElementTree import fromstring
+from xml.sax.saxutils import escape
+from urlparse import urlsplit, parse_qsl
+from urllib import unquote
+from datetime import datetime
+
+from winazurestorage import DEVSTORE_ACCOUNT, DEVSTORE_SECRET_KEY, ATOM_NAMESPACE, DATASERVICES_NAMESPACE, METADATA_NAMESPACE, PROPERTY_DECODERS, PAGE_SIZE
+
+LIST_MAX_RESULTS = 5000 # page size of blob and container listings
+QUERY_MAX_RESULTS = 1000 # page size of table queries
+
+RESPONSE_REASONS = {503: "Server Busy", 500: "Internal Server Error"}
+
+def rfc1123_date(value = None):
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(value))
+
+def edm_timestamp():
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f0Z")
+
+class FakeRequest(object):
+    '''What a service handler gets to see of an HTTP request: method, the path below the
+       account, the decoded query string, the headers and the body.'''
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+def error(code, error_code, message = ""):
+    body = '<?xml version="1.0" encoding="utf-8"?><Error><Code>%s</Code><Message>%s</Message></Error>' % (error_code, escape(message or error_code))
+    return code, body, {"Content-Type": "application/xml"}
+
+class BlobService(object):
+    '''Blobs are dicts of their data and properties. Copies complete copy_delay seconds after
+       they are started; until then they are reported as pending. Page blobs keep their full
+       (zero filled) data plus the set of page numbers that have been written.'''
+    def __init__(self, copy_delay = 0):
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.copy_delay = copy_delay
+
+    def handle(self, request):
+        container, _, blob = request.path.partition("/")
+        with self.lock:
+            if not container:
+                if request.query.get("comp") == "list": return self.list_containers(request)
+                return error(400, "InvalidUri")
+            if not blob:
+                if request.query.get("comp") == "list": return self.list_blobs(container, request)
+                if request.query.get("restype") != "container": return error(400, "InvalidUri")
+                if request.method == "PUT":
+                    if container in self.containers: return error(409, "ContainerAlreadyExists")
+                    self.containers[container] = {}
+                    return 201, "", {"ETag": self._etag(), "Last-Modified": rfc1123_date()}
+                if request.method == "DELETE":
+                    if self.containers.pop(container, None) is None: return error(404, "ContainerNotFound")
+                    return 202, "", {}
+                return error(405, "UnsupportedHttpVerb")
+            blobs = self.containers.get(container)
+            if blobs is None: return error(404, "ContainerNotFound")
+            self._complete_copy(blobs.get(blob))
+            if request.method == "PUT":
+                if request.query.get("comp") == "snapshot": return self.snapshot_blob(blobs, blob, request)
+                if request.query.get("comp") == "copy": return self.abort_copy(blobs, blob, request)
+                if "x-ms-copy-source" in request.headers: return self.copy_blob(blobs, blob, request)
+                return self.put_blob(blobs, blob, request)
+            if request.method in ("GET", "HEAD"): return self.get_blob(blobs, blob, request)
+            if request.method == "DELETE": return self.delete_blob(blobs, blob, request)
+            return error(405, "UnsupportedHttpVerb")
+
+    def delete_blob(self, blobs, name, request):
+        blob = blobs.get(name)
+        if blob is None or blob["data"] is None: return error(404, "BlobNotFound")
+        snapshots = blob.get("snapshots") or {}
+        if "snapshot" in request.query:
+            if snapshots.pop(request.query["snapshot"], None) is None: return error(404, "BlobNotFound")
+            return 202, "", {}
+        delete_snapshots = request.headers.get("x-ms-delete-snapshots")
+        if snapshots and delete_snapshots not in ("include", "only"): return error(409, "SnapshotsPresent")
+        if delete_snapshots == "only": snapshots.clear()
+        else: del blobs[name]
+        return 202, "", {}
+
+    def snapshot_blob(self, blobs, name, request):
+        blob = blobs.get(name)
+        if blob is None or blob["data"] is None: return error(404, "BlobNotFound")
+        snapshot = dict((key, value) for key, value in blob.iteritems() if key not in ("blocks", "snapshots"))
+        if "pages" in blob: snapshot["pages"] = set(blob["pages"])
+        metadata = dict((key, value) for key, value in request.headers.items() if key.startswith("x-ms-meta-"))
+        if metadata: snapshot["metadata"] = metadata
+        snapshots = blob.setdefault("snapshots", {})
+        snapshot_id = edm_timestamp()
+        while snapshot_id in snapshots: snapshot_id = edm_timestamp()
+        snapshots[snapshot_id] = snapshot
+        return 201, "", {"x-ms-snapshot": snapshot_id, "ETag": blob["etag"], "Last-Modified": blob["modified"]}
+
+    def copy_blob(self, blobs, name, request):
+        source_url = request.headers["x-ms-copy-source"]
+        (scheme, host, path, query, fragment) = urlsplit(source_url)
+        account, _, path = unquote(path).lstrip("/").partition("/")
+        container, _, source_name = path.partition("/")
+        source = self.containers.get(container, {}).get(source_name)
+        snapshot = dict(parse_qsl(query)).get("snapshot")
+        if source is not None and snapshot is not None: source = (source.get("snapshots") or {}).get(snapshot)
+        if source is None or source["data"] is None: return error(404, "CannotVerifyCopySource")
+        data = source["data"]
+        self._store(blobs, name, data, request, source["content_md5"])
+        blob = blobs[name]
+        blob["content_type"] = source["content_type"]
+        blob["content_encoding"] = source["content_encoding"]
+        blob["type"] = source["type"]
+        if "pages" in source: blob["pages"] = set(source["pages"])
+        if not blob["metadata"]: blob["metadata"] = dict(source["metadata"])
+        blob["copy"] = {"id": str(uuid.uuid4()), "source": source_url, "progress": "%d/%d" % (len(data), len(data)),
+                        "status": "success", "completion-time": rfc1123_date()}
+        if self.copy_delay:
+            blob.update(data = "", copy_data = data, copy_done_at = time.time() + self.copy_delay)
+            blob["copy"].update(status = "pending", progress = "0/%d" % len(data))
+            del blob["copy"]["completion-time"]
+        return 202, "", {"x-ms-copy-id": blob["copy"]["id"], "x-ms-copy-status": blob["copy"]["status"],
+                         "ETag": blob["etag"], "Last-Modified": blob["modified"]}
+
+    def _complete_copy(self, blob):
+        if blob is None or blob.get("copy_done_at") is None or blob["copy_done_at"] > time.time(): return
+        blob["data"] = blob.pop("copy_data")
+        del blob["copy_done_at"]
+        blob["copy"].update(status = "success", progress = "%d/%d" % (len(blob["data"]), len(blob["data"])), **{"completion-time": rfc1123_date()})
+
+    def abort_copy(self, blobs, name, request):
+        blob = blobs.get(name)
+        if blob is None: return error(404, "BlobNotFound")
+        copy = blob.get("copy")
+        if copy is None or copy["status"] != "pending" or copy["id"] != request.query.get("copyid"):
+            return error(409, "NoPendingCopyOperation")
+        blob.pop("copy_data")
+        del blob["copy_done_at"]
+        copy.update(status = "aborted", **{"completion-time": rfc1123_date()})
+        return 204, "", {}
+
+    def _etag(self):
+        return '"0x%s"' % uuid.uuid4().hex[:15].upper()
+
+    def _store(self, blobs, name, data, request, content_md5):
+        blob = blobs.get(name) or {"blocks": {}}
+        blob.pop("pages", None)
+        blob.update(data = data, etag = self._etag(), modified = rfc1123_date(), content_md5 = content_md5, copy = None, type = "BlockBlob",
+                    content_type = request.headers.get("x-ms-blob-content-type") or request.headers.get("content-type") or "application/octet-stream",
+                    content_encoding = request.headers.get("x-ms-blob-content-encoding") or request.headers.get("content-encoding"),
+                    metadata = dict((key, value) for key, value in request.headers.items() if key.startswith("x-ms-meta-")))
+        blobs[name] = blob
+        return 201, "", {"ETag": blob["etag"], "Last-Modified": blob["modified"], "Content-MD5": content_md5 or ""}
+
+    def put_blob(self, blobs, name, request):
+        comp = request.query.get("comp")
+        if comp == "page": return self.put_page(blobs, name, request)
+        if comp == "appendblock": return self.append_block(blobs, name, request)
+        blob_type = request.headers.get("x-ms-blob-type", "BlockBlob")
+        if blob_type == "PageBlob":
+            size = int(request.headers.get("x-ms-blob-content-length", -1))
+            if size < 0 or size % PAGE_SIZE: return error(400, "InvalidHeaderValue")
+            result = self._store(blobs, name, "\0" * size, request, None)
+            blobs[name].update(type = blob_type, pages = set())
+            return result
+        if blob_type == "AppendBlob":
+            result = self._store(blobs, name, "", request, None)
+            blobs[name]["type"] = blob_type
+            return result
+        if comp == "block":
+            content_md5 = request.headers.get("content-md5")
+            if content_md5 and content_md5 != base64.b64encode(hashlib.md5(request.body).digest()):
+                return error(400, "Md5Mismatch")
+            blob = blobs.setdefault(name, {"blocks": {}, "data": None})
+            blob["blocks"][request.query["blockid"]] = request.body
+            return 201, "", {}
+        if comp == "blocklist":
+            blob = blobs.get(name)
+            blocks = blob and blob["blocks"] or {}
+            ids = re.findall(r"<(?:Latest|Uncommitted|Committed)>([^<]*)</", request.body)
+            if [block_id for block_id in ids if block_id not in blocks]: return error(400, "InvalidBlockList")
+            result = self._store(blobs, name, "".join(blocks[block_id] for block_id in ids), request, request.headers.get("x-ms-blob-content-md5"))
+            blobs[name]["blocks"] = dict((block_id, blocks[block_id]) for block_id in ids) # uncommitted blocks are discarded
+            return result
+        content_md5 = request.headers.get("content-md5")
+        if content_md5 and content_md5 != base64.b64encode(hashlib.md5(request.body).digest()):
+            return error(400, "Md5Mismatch")
+        return self._store(blobs, name, request.body, request, content_md5)
+
+    def put_page(self, blobs, name, request):
+        blob = blobs.get(name)
+        if blob is None or blob["data"] is None: return error(404, "BlobNotFound")
+        if blob["type"] != "PageBlob": return error(409, "InvalidBlobType")
+        match = re.match(r"bytes=(\d+)-(\d+)$", request.headers.get("x-ms-range") or request.headers.get("range") or "")
+        if match is None: return error(400, "InvalidPageRange")
+        start, end = int(match.group(1)), int(match.group(2))
+        if start % PAGE_SIZE or (end + 1) % PAGE_SIZE or end >= len(blob["data"]): return error(416, "InvalidPageRange")
+        pages = xrange(start / PAGE_SIZE, (end + 1) / PAGE_SIZE)
+        if request.headers.get("x-ms-page-write") == "clear":
+            data = "\0" * (end + 1 - start)
+            blob["pages"].difference_update(pages)
+        else:
+            data = request.body
+            if len(data) != end + 1 - start: return error(400, "InvalidPageRange")
+            blob["pages"].update(pages)
+        blob.update(data = blob["data"][:start] + data + blob["data"][end + 1:], etag = self._etag(), modified = rfc1123_date(), content_md5 = None)
+        return 201, "", {"ETag": blob["etag"], "Last-Modified": blob["modified"]}
+
+    def get_page_ranges(self, blob, request):
+        pages = sorted(blob["pages"])
+        match = re.match(r"bytes=(\d+)-(\d+)$", request.headers.get("x-ms-range") or request.headers.get("range") or "")
+        if match is not None:
+            first, last = int(match.group(1)) / PAGE_SIZE, int(match.group(2)) / PAGE_SIZE
+            pages = [page for page in pages if first <= page <= last]
+        ranges = []
+        for page in pages:
+            if ranges and ranges[-1][1] == page - 1: ranges[-1][1] = page
+            else: ranges.append([page, page])
+        entries = ["<PageRange><Start>%d</Start><End>%d</End></PageRange>" % (first * PAGE_SIZE, (last + 1) * PAGE_SIZE - 1) for first, last in ranges]
+        body = '<?xml version="1.0" encoding="utf-8"?><PageList>%s</PageList>' % "".join(entries)
+        return 200, body, {"Content-Type": "application/xml", "ETag": blob["etag"], "x-ms-blob-content-length": str(len(blob["data"]))}
+
+    def append_block(self, blobs, name, request):
+        blob = blobs.get(name)
+        if blob is None or blob["data"] is None: return error(404, "BlobNotFound")
+        if blob["type"] != "AppendBlob": return error(409, "InvalidBlobType")
+        append_position = request.headers.get("x-ms-blob-condition-appendpos")
+        if append_position is not None and int(append_position) != len(blob["data"]): return error(412, "AppendPositionConditionNotMet")
+        offset = len(blob["data"])
+        blob["append_count"] = blob.get("append_count", 0) + 1
+        blob.update(data = blob["data"] + request.body, etag = self._etag(), modified = rfc1123_date(), content_md5 = None)
+        return 201, "", {"ETag": blob["etag"], "Last-Modified": blob["modified"], "x-ms-blob-append-offset": str(offset),
+                         "x-ms-blob-committed-block-count": str(blob["append_count"])}
+
+    def get_blob(self, blobs, name, request):
+        blob = blobs.get(name)
+        if blob is not None and "snapshot" in request.query: blob = (blob.get("snapshots") or {}).get(request.query["snapshot"])
+        if blob is None or blob["data"] is None: return error(404, "BlobNotFound")
+        if request.query.get("comp") == "pagelist":
+            if blob["type"] != "PageBlob": return error(400, "InvalidBlobType")
+            return self.get_page_ranges(blob, request)
+        if request.headers.get("if-none-match") == blob["etag"]: return 304, "", {"ETag": blob["etag"]}
+        if_match = request.headers.get("if-match")
+        if if_match not in (None, "*", blob["etag"]): return error(412, "ConditionNotMet")
+        headers = {"ETag": blob["etag"], "Last-Modified": blob["modified"], "Content-Type": blob["content_type"],
+                   "x-ms-blob-type": blob["type"]}
+        headers.update(blob["metadata"])
+        if blob["content_md5"]: headers["Content-MD5"] = blob["content_md5"]
+        if blob["content_encoding"]: headers["Content-Encoding"] = blob["content_encoding"]
+        for key, value in (blob.get("copy") or {}).items():
+            headers["x-ms-copy-" + key] = value
+        data = blob["data"]
+        match = re.match(r"bytes=(\d+)-(\d*)$", request.headers.get("x-ms-range") or request.headers.get("range") or "")
+        if match is None: return 200, data, headers
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        if start >= len(data): return error(416, "InvalidRange")
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+        return 206, data[start:end + 1], headers
+
+    def _page(self, names, request):
+        prefix = request.query.get("prefix", "")
+        marker = request.query.get("marker", "")
+        max_results = int(request.query.get("maxresults", LIST_MAX_RESULTS))
+        names = [name for name in sorted(names) if name.startswith(prefix) and name >= marker]
+        next_marker = len(names) > max_results and names[max_results] or ""
+        return names[:max_results], next_marker
+
+    def list_containers(self, request):
+        names, next_marker = self._page(self.containers, request)
+        entries = ["<Container><Name>%s</Name><Properties><Last-Modified>%s</Last-Modified><Etag>0x1</Etag></Properties></Container>" % (escape(name), rfc1123_date())
+                   for name in names]
+        body = '<?xml version="1.0" encoding="utf-8"?><EnumerationResults><Containers>%s</Containers><NextMarker>%s</NextMarker></EnumerationResults>' % ("".join(entries), escape(next_marker))
+        return 200, body, {"Content-Type": "application/xml"}
+
+    def list_blobs(self, container, request):
+        blobs = self.containers.get(container)
+        if blobs is None: return error(404, "ContainerNotFound")
+        committed = [name for name, blob in blobs.iteritems() if blob["data"] is not None]
+        names, next_marker = self._page(committed, request)
+        entries = []
+        for name in names:
+            blob = blobs[name]
+            entries.append("<Blob><Name>%s</Name><Properties><Last-Modified>%s</Last-Modified><Etag>%s</Etag><Content-Length>%d</Content-Length><Content-Type>%s</Content-Type><Content-Encoding>%s</Content-Encoding><Content-MD5>%s</Content-MD5><BlobType>%s</BlobType></Properties></Blob>"
+                           % (escape(name), blob["modified"], blob["etag"], len(blob["data"]), escape(blob["content_type"]), escape(blob["content_encoding"] or ""), blob["content_md5"] or "", blob["type"]))
+        body = '<?xml version="1.0" encoding="utf-8"?><EnumerationResults ContainerName="%s"><Blobs>%s</Blobs><NextMarker>%s</NextMarker></EnumerationResults>' % (escape(container), "".join(entries), escape(next_marker))
+        return 200, body, {"Content-Type": "application/xml"}
+
+class QueueService(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def handle(self, request):
+        parts = request.path.split("/")
+        with self.lock:
+            if len(parts) == 1:
+                if request.method == "PUT":
+                    if parts[0] in self.queues: return 204, "", {}
+                    self.queues[parts[0]] = []
+                    return 201, "", {}
+                if request.method == "DELETE":
+                    if self.queues.pop(parts[0], None) is None: return error(404, "QueueNotFound")
+                    return 204, "", {}
+                return error(405, "UnsupportedHttpVerb")
+            messages = self.queues.get(parts[0])
+            if messages is None: return error(404, "QueueNotFound")
+            if len(parts) == 2:
+                if request.method == "POST": return self.put_message(messages, request)
+                if request.method == "GET": return self.get_messages(messages, request)
+                if request.method == "DELETE":
+                    del messages[:]
+                    return 204, "", {}
+                return error(405, "UnsupportedHttpVerb")
+            for message in messages:
+                if message["id"] == parts[2]: break
+            else:
+                return error(404, "MessageNotFound")
+            if message["pop_receipt"] is None or request.query.get("popreceipt") != message["pop_receipt"]:
+                return error(400, "PopReceiptMismatch")
+            if request.method == "DELETE":
+                messages.remove(message)
+                return 204, "", {}
+            if request.method == "PUT":
+                text = re.search(r"<MessageText>(.*)</MessageText>", request.body, re.S)
+                if text is not None: message["text"] = text.group(1)
+                message["visible_at"] = time.time() + int(request.query.get("visibilitytimeout", 0))
+                message["pop_receipt"] = uuid.uuid4().hex
+                return 204, "", {"x-ms-popreceipt": message["pop_receipt"], "x-ms-time-next-visible": rfc1123_date(message["visible_at"])}
+            return error(405, "UnsupportedHttpVerb")
+
+    def put_message(self, messages, request):
+        text = re.search(r"<MessageText>(.*)</MessageText>", request.body, re.S)
+        if text is None: return error(400, "InvalidXmlDocument")
+        now = time.time()
+        messages.append({"id": str(uuid.uuid4()), "text": text.group(1).strip(), "inserted": now, "pop_receipt": None,
+                         "visible_at": now + int(request.query.get("visibilitytimeout", 0)), "dequeue_count": 0})
+        return 201, "", {}
+
+    def get_messages(self, messages, request):
+        count = int(request.query.get("numofmessages", 1))
+        if not 1 <= count <= 32: return error(400, "OutOfRangeQueryParameterValue")
+        peek = request.query.get("peekonly") == "true"
+        now = time.time()
+        entries = []
+        for message in messages:
+            if len(entries) >= count: break
+            if message["visible_at"] > now: continue
+            if not peek:
+                message["visible_at"] = now + int(request.query.get("visibilitytimeout", 30))
+                message["pop_receipt"] = uuid.uuid4().hex
+                message["dequeue_count"] += 1
+            receipt = not peek and "<PopReceipt>%s</PopReceipt><TimeNextVisible>%s</TimeNextVisible>" % (message["pop_receipt"], rfc1123_date(message["visible_at"])) or ""
+            entries.append("<QueueMessage><MessageId>%s</MessageId><InsertionTime>%s</InsertionTime><ExpirationTime>%s</ExpirationTime>%s<DequeueCount>%d</DequeueCount><MessageText>%s</MessageText></QueueMessage>"
+                           % (message["id"], rfc1123_date(message["inserted"]), rfc1123_date(message["inserted"] + 7 * 86400), receipt, message["dequeue_count"], message["text"]))
+        body = '<?xml version="1.0" encoding="utf-8"?><QueueMessagesList>%s</QueueMessagesList>' % "".join(entries)
+        return 200, body, {"Content-Type": "application/xml"}
+
+_FILTER_TOKEN = re.compile(r"\s*(?:(\()|(\))|(eq|ne|gt|ge|lt|le)\b|(and|or|not)\b|(datetime|guid|X|binary)'([^']*)'|'((?:[^']|'')*)'|(true|false)\b|(-?\d+(?:\.\d+)?)(L)?|([A-Za-z_][A-Za-z0-9_]*))")
+_COMPARISONS = {"eq": lambda a, b: a == b, "ne": lambda a, b: a != b, "gt": lambda a, b: a > b,
+                "ge": lambda a, b: a >= b, "lt": lambda a, b: a < b, "le": lambda a, b: a <= b}
+
+def compile_filter(text):
+    '''Compile an OData $filter into a predicate over decoded entity property dicts.'''
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = _FILTER_TOKEN.match(text, position)
+        if match is None: raise ValueError("Invalid filter near: %s" % text[position:])
+        position = match.end()
+        (lparen, rparen, comparison, logical, typed, typed_value, string, boolean, number, long_suffix, name) = match.groups()
+        if lparen: tokens.append(("(", None))
+        elif rparen: tokens.append((")", None))
+        elif comparison: tokens.append(("cmp", comparison))
+        elif logical: tokens.append((logical, None))
+        elif typed == "datetime": tokens.append(("value", PROPERTY_DECODERS["edm.datetime"](typed_value)))
+        elif typed: tokens.append(("value", typed_value))
+        elif string is not None: tokens.append(("value", string.replace("''", "'")))
+        elif boolean: tokens.append(("value", boolean == "true"))
+        elif number is not None: tokens.append(("value", float(number) if "." in number else long(number)))
+        else: tokens.append(("name", name))
+    tokens.append(("end", None))
+    index = [0]
+
+    def peek(): return tokens[index[0]][0]
+    def take():
+        index[0] += 1
+        return tokens[index[0] - 1]
+
+    def parse_or():
+        left = parse_and()
+        while peek() == "or":
+            take()
+            right = parse_and()
+            left = (lambda l, r: lambda e: l(e) or r(e))(left, right)
+        return left
+
+    def parse_and():
+        left = parse_not()
+        while peek() == "and":
+            take()
+            right = parse_not()
+            left = (lambda l, r: lambda e: l(e) and r(e))(left, right)
+        return left
+
+    def parse_not():
+        if peek() == "not":
+            take()
+            operand = parse_not()
+            return lambda e: not operand(e)
+        if peek() == "(":
+            take()
+            result = parse_or()
+            if take()[0] != ")": raise ValueError("Unbalanced parentheses in filter: %s" % text)
+            return result
+        kind, name = take()
+        comparison = take()
+        kind_value, value = take()
+        if kind != "name" or comparison[0] != "cmp" or kind_value != "value":
+            raise ValueError("Invalid comparison in filter: %s" % text)
+        compare = _COMPARISONS[comparison[1]]
+        return lambda e: name in e and e[name] is not None and compare(e[name], value)
+
+    predicate = parse_or()
+    if peek() != "end": raise ValueError("Invalid filter: %s" % text)
+    return predicate
+
+_ENTITY_PATH = re.compile(r"^([^(]+)\(PartitionKey='((?:[^']|'')*)',RowKey='((?:[^']|'')*)'\)$")
+_JSON_NATIVE_TYPES = frozenset(("Edm.Int32", "Edm.Double", "Edm.Boolean"))
+
+class TableService(object):
+    '''Entities are kept as ordered lists of (name, edm_type, text) properties, the text being
+       what the Atom payload carries.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}
+        self._decoded = {} # id(entity) -> (entity, decoded values), for filtering
+
+    def _format(self, request):
+        match = re.search(r"odata=(\w+)", request.headers.get("accept", ""))
+        if "json" in request.headers.get("accept", "") and match: return match.group(1)
+        return "atom"
+
+    def handle(self, request):
+        path = request.path
+        with self.lock:
+            if path == "Tables":
+                if request.method == "POST": return self.create_table(request)
+                if request.method == "GET": return self.list_tables(request)
+            match = re.match(r"^Tables\('([^']*)'\)$", path)
+            if match:
+                if request.method != "DELETE": return error(405, "UnsupportedHttpVerb")
+                if self.tables.pop(match.group(1), None) is None: return error(404, "TableNotFound")
+                return 204, "", {}
+            if path == "$batch" and request.method == "POST": return self.batch(request)
+            match = _ENTITY_PATH.match(path)
+            if match:
+                table, partition_key, row_key = match.group(1), match.group(2).replace("''", "'"), match.group(3).replace("''", "'")
+                return self.entity(request, table, (partition_key, row_key))
+            table = path.rstrip("()")
+            if request.method == "POST": return self.insert(request, table)
+            if request.method == "GET": return self.query(request, table)
+            return error(405, "UnsupportedHttpVerb")
+
+    def create_table(self, request):
+        if request.headers.get("content-type", "").startswith("application/json"):
+            name = json.loads(request.body)["TableName"]
+        else:
+            name = fromstring(request.body).findtext(".//%sTableName" % DATASERVICES_NAMESPACE)
+        if name in self.tables: return error(409, "TableAlreadyExists")
+        self.tables[name] = {}
+        return 201, "", {}
+
+    def list_tables(self, request):
+        if self._format(request) != "atom":
+            return 200, json.dumps({"value": [{"TableName": name} for name in sorted(self.tables)]}), {"Content-Type": "application/json"}
+        entries = ['<entry><id>%s</id><content type="application/xml"><m:properties><d:TableName>%s</d:TableName></m:properties></content></entry>' % (escape(name), escape(name))
+                   for name in sorted(self.tables)]
+        return 200, self._feed(entries), {"Content-Type": "application/atom+xml"}
+
+    def _feed(self, entries):
+        return ('<?xml version="1.0" encoding="utf-8" standalone="yes"?><feed xmlns:d="%s" xmlns:m="%s" xmlns="%s">%s</feed>'
+                % (DATASERVICES_NAMESPACE[1:-1], METADATA_NAMESPACE[1:-1], ATOM_NAMESPACE[1:-1], "".join(entries)))
+
+    def _parse(self, request):
+        '''Return the properties of the entity in the request body.'''
+        properties = []
+        if request.headers.get("content-type", "").startswith("application/json"):
+            body = json.loads(request.body)
+            for name, value in body.iteritems():
+                if "@" in name or name == "Timestamp": continue
+                edm_type = body.get(name + "@odata.type")
+                if value is None: text = None
+                elif isinstance(value, bool): edm_type, text = "Edm.Boolean", value and "true" or "false"
+                elif isinstance(value, (int, long)) and edm_type is None: edm_type, text = "Edm.Int32", str(value)
+                elif isinstance(value, float): edm_type, text = "Edm.Double", repr(value)
+                else: text = value.encode("utf-8") if isinstance(value, unicode) else str(value)
+                properties.append((name.encode("utf-8"), edm_type, text))
+            return properties
+        for element in fromstring(request.body).find(".//%sproperties" % METADATA_NAMESPACE):
+            name = element.tag[element.tag.find("}") + 1:]
+            if name == "Timestamp": continue
+            text = element.text
+            if text is None and element.get(METADATA_NAMESPACE + "null") != "true": text = ""
+            if isinstance(text, unicode): text = text.encode("utf-8")
+            properties.append((name, element.get(METADATA_NAMESPACE + "type"), text))
+        return properties
+
+    def _check(self, properties):
+        '''Return the error reply for property values the service rejects, or None.'''
+        for name, edm_type, text in properties:
+            if edm_type == "Edm.Int32" and text is not None and not -2 ** 31 <= int(text) < 2 ** 31:
+                return error(400, "InvalidInput", "%s is out of range for Edm.Int32" % name)
+        return None
+
+    def _keys(self, properties):
+        values = dict((name, text) for name, edm_type, text in properties)
+        return values.get("PartitionKey"), values.get("RowKey")
+
+    def _store(self, table, key, properties):
+        properties = [p for p in properties if p[0] not in ("PartitionKey", "RowKey")]
+        table[key] = [("PartitionKey", None, key[0]), ("RowKey", None, key[1]), ("Timestamp", "Edm.DateTime", edm_timestamp())] + properties
+
+    def _decode_cached(self, entity):
+        # Scans filter the same stored entities over and over; entities are replaced, never
+        # changed, so the entity held by the cache tells whether its entry is current.
+        cached = self._decoded.get(id(entity))
+        if cached is not None and cached[0] is entity: return cached[1]
+        if len(self._decoded) > 1000000: self._decoded.clear()
+        values = self._decode(entity)
+        self._decoded[id(entity)] = (entity, values)
+        return values
+
+    def _decode(self, entity):
+        values = {}
+        for name, edm_type, text in entity:
+            if text is not None and edm_type is not None:
+                text = PROPERTY_DECODERS[edm_type.lower()](text)
+            values[name] = text
+        return values
+
+    def _entity_xml(self, table, entity, key = None):
+        properties = []
+        for name, edm_type, text in entity:
+            attributes = edm_type and ' m:type="%s"' % edm_type or ""
+            if text is None: properties.append('<d:%s%s m:null="true" />' % (name, attributes))
+            else: properties.append("<d:%s%s>%s</d:%s>" % (name, attributes, escape(text), name))
+        key = key or self._keys(entity)
+        return ('<entry><id>%s(PartitionKey=\'%s\',RowKey=\'%s\')</id><content type="application/xml"><m:properties>%s</m:properties></content></entry>'
+                % (escape(table), escape(key[0]), escape(key[1]), "".join(properties)))
+
+    def _entity_json(self, entity, payload_format):
+        result = {}
+        for name, edm_type, text in entity:
+            if text is None: value = None
+            elif edm_type in _JSON_NATIVE_TYPES: value = PROPERTY_DECODERS[edm_type.lower()](text)
+            else:
+                value = text.decode("utf-8")
+                if edm_type not in (None, "Edm.String") and payload_format != "nometadata" and name != "Timestamp":
+                    result[name + "@odata.type"] = edm_type
+            result[name] = value
+        return result
+
+    def _reply_entities(self, request, table_name, entities, headers = None, single = False, keys = None):
+        # keys are those of the entities, which may not be among their selected properties.
+        headers = dict(headers or {})
+        payload_format = self._format(request)
+        if payload_format == "atom":
+            entries = [self._entity_xml(table_name, entity, key) for entity, key in zip(entities, keys or [None] * len(entities))]
+            if single: body = '<?xml version="1.0" encoding="utf-8" standalone="yes"?>' + entries[0].replace("<entry>", '<entry xmlns:d="%s" xmlns:m="%s" xmlns="%s">' % (DATASERVICES_NAMESPACE[1:-1], METADATA_NAMESPACE[1:-1], ATOM_NAMESPACE[1:-1]), 1)
+            else: body = self._feed(entries)
+            headers["Content-Type"] = "application/atom+xml"
+        else:
+            values = [self._entity_json(entity, payload_format) for entity in entities]
+            body = json.dumps(single and values[0] or {"value": values})
+            headers["Content-Type"] = "application/json;odata=%s" % payload_format
+        return 200, body, headers
+
+    def insert(self, request, table_name, status_only = False):
+        table = self.tables.get(table_name)
+        if table is None: return error(404, "TableNotFound")
+        properties = self._parse(request)
+        invalid = self._check(properties)
+        if invalid is not None: return invalid
+        key = self._keys(properties)
+        if key in table: return error(409, "EntityAlreadyExists")
+        self._store(table, key, properties)
+        if status_only or "return-no-content" in request.headers.get("prefer", ""): return 204, "", {}
+        code, body, headers = self._reply_entities(request, table_name, [table[key]], single = True)
+        return 201, body, headers
+
+    def entity(self, request, table_name, key):
+        table = self.tables.get(table_name)
+        if table is None: return error(404, "TableNotFound")
+        if request.method == "GET":
+            if key not in table: return error(404, "ResourceNotFound")
+            entity = table[key]
+            if "$select" in request.query:
+                select = set(request.query["$select"].split(","))
+                entity = [p for p in entity if p[0] in select]
+            return self._reply_entities(request, table_name, [entity], single = True, keys = [key])
+        if_match = request.headers.get("if-match")
+        if request.method == "DELETE":
+            if table.pop(key, None) is None: return error(404, "ResourceNotFound")
+            return 204, "", {}
+        if request.method not in ("PUT", "MERGE"): return error(405, "UnsupportedHttpVerb")
+        if if_match is not None and key not in table: return error(404, "ResourceNotFound")
+        properties = self._parse(request)
+        invalid = self._check(properties)
+        if invalid is not None: return invalid
+        if request.method == "MERGE" and key in table:
+            merged = dict((p[0], p) for p in table[key][3:])
+            merged.update((p[0], p) for p in properties)
+            properties = merged.values()
+        self._store(table, key, properties)
+        return 204, "", {}
+
+    def query(self, request, table_name):
+        table = self.tables.get(table_name)
+        if table is None: return error(404, "TableNotFound")
+        top = min(int(request.query.get("$top", QUERY_MAX_RESULTS)), QUERY_MAX_RESULTS)
+        start = (request.query.get("NextPartitionKey"), request.query.get("NextRowKey") or "")
+        predicate = "$filter" in request.query and compile_filter(request.query["$filter"]) or None
+        select = "$select" in request.query and set(request.query["$select"].split(",")) or None
+        entities, keys = [], []
+        next_key = None
+        for key in sorted(table):
+            if start[0] is not None and key < start: continue
+            entity = table[key]
+            if predicate is not None and not predicate(self._decode_cached(entity)): continue
+            if len(entities) == top:
+                next_key = key
+                break
+            if select is not None: entity = [p for p in entity if p[0] in select]
+            entities.append(entity)
+            keys.append(key)
+        headers = {}
+        if next_key is not None:
+            headers["x-ms-continuation-NextPartitionKey"] = next_key[0]
+            headers["x-ms-continuation-NextRowKey"] = next_key[1]
+        return self._reply_entities(request, table_name, entities, headers, keys = keys)
+
+    def batch(self, request):
+        '''Apply the operations of an Entity Group Transaction atomically.'''
+        operations = re.findall(r"^(POST|PUT|MERGE|DELETE) (\S+) HTTP/1.1\r\n(.*?)\r\n\r\n(.*?)\r\n--changeset", request.body, re.S | re.M)
+        saved = dict((name, dict(table)) for name, table in self.tables.iteritems())
+        responses = []
+        for index, (method, url, header_lines, body) in enumerate(operations):
+            headers = dict((key.lower(), value.strip()) for key, _, value in (line.partition(":") for line in header_lines.split("\r\n")))
+            path = unquote(urlsplit(url).path).lstrip("/").partition("/")[2]
+            operation = FakeRequest(method, path, {}, headers, body)
+            match = _ENTITY_PATH.match(path)
+            if match: code, reply, reply_headers = self.entity(operation, match.group(1), (match.group(2).replace("''", "'"), match.group(3).replace("''", "'")))
+            else: code, reply, reply_headers = self.insert(operation, path, status_only = True)
+            if code >= 400:
+                self.tables = saved
+                if self._format(request) == "atom":
+                    error = ("application/xml", '<?xml version="1.0" encoding="utf-8"?><error><code>Error</code><message xml:lang="en-US">%d:Operation failed.</message></error>' % index)
+                else:
+                    error = ("application/json", json.dumps({"odata.error": {"code": "Error", "message": {"lang": "en-US", "value": "%d:Operation failed." % index}}}))
+                body = ('--batchresponse\r\nContent-Type: multipart/mixed; boundary=changesetresponse\r\n\r\n--changesetresponse\r\n'
+                        'Content-Type: application/http\r\n\r\nHTTP/1.1 %d Error\r\nContent-Type: %s\r\n\r\n%s\r\n'
+                        '--changesetresponse--\r\n--batchresponse--\r\n' % (code, error[0], error[1]))
+                return 202, body, {"Content-Type": "multipart/mixed; boundary=batchresponse"}
+            responses.append("--changesetresponse\r\nContent-Type: application/http\r\n\r\nHTTP/1.1 %d OK\r\nContent-ID: %d\r\n\r\n" % (code, index + 1))
+        body = "--batchresponse\r\nContent-Type: multipart/mixed; boundary=changesetresponse\r\n\r\n%s--changesetresponse--\r\n--batchresponse--\r\n" % "".join(responses)
+        return 202, body, {"Content-Type": "multipart/mixed; boundary=batchresponse"}
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = 64 * 1024 # whole responses go out in one write
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections[self.connection] = threading.current_thread()
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.pop(self.connection, None)
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        (scheme, host, path, query, fragment) = urlsplit(self.path)
+        account, _, path = unquote(path).lstrip("/").partition("/")
+        request = FakeRequest(self.command, path, dict(parse_qsl(query, True)),
+                              dict((key.lower(), value) for key, value in self.headers.items()), body)
+        failure = fake._next_failure(self.server.service_name)
+        if fake.latency: time.sleep(fake.latency)
+        if failure is not None:
+            if failure == 0:
+                # Drop the connection without a reply.
+                self.close_connection = 1
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            code, reply, headers = error(failure, failure == 503 and "ServerBusy" or "InternalError", "Injected failure.")
+        elif account != fake.account:
+            code, reply, headers = error(403, "AuthenticationFailed")
+        else:
+            code, reply, headers = self.server.service.handle(request)
+        fake._count(self.server.service_name, code)
+        self.send_response(code, RESPONSE_REASONS.get(code))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("x-ms-request-id", str(uuid.uuid4()))
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        if self.command != "HEAD": self.wfile.write(reply)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = do_MERGE = _handle
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler_class)
+        self.lock = threading.Lock()
+        self.connections = {} # open connection -> the thread handling it
+
+class FakeAzure(object):
+    '''In-memory blob, queue and table services listening on 127.0.0.1 (ports chosen by
+       the system unless given). Every request is delayed by latency seconds; a share
+       failure_rate of them (picked with a random generator seeded with seed) fails with
+       failure_code before being processed, and fail_next queues deterministic failures.
+       Blob copies stay pending for copy_delay seconds.'''
+    def __init__(self, account = DEVSTORE_ACCOUNT, key = DEVSTORE_SECRET_KEY, latency = 0, failure_rate = 0, failure_code = 503, seed = None, ports = (0, 0, 0), copy_delay = 0):
+        self.account = account
+        self.key = key
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.blob = BlobService(copy_delay)
+        self.queue = QueueService()
+        self.table = TableService()
+        self.requests = {}
+        self._ports = ports
+        self._random = random.Random(seed)
+        self._failures = []
+        self._lock = threading.Lock()
+        self._servers = []
+
+    def start(self):
+        for (name, service), port in zip((("blob", self.blob), ("queue", self.queue), ("table", self.table)), self._ports):
+            server = _Server(("127.0.0.1", port), _Handler)
+            server.fake, server.service, server.service_name = self, service, name
+            thread = threading.Thread(target = server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._servers.append(server)
+        (self.blob_host, self.queue_host, self.table_host) = ["127.0.0.1:%d" % server.server_port for server in self._servers]
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+            # Wake up the handlers waiting on idle keep-alive connections.
+            with server.lock:
+                connections = server.connections.items()
+            for connection, thread in connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            # Let them finish, rather than be killed at interpreter exit while reporting the error.
+            for connection, thread in connections:
+                thread.join(1)
+        self._servers = []
+
+    def fail_next(self, count, code = 503, service = None):
+        '''Fail the next count requests (to service, "blob", "queue" or "table", or to any
+           service) with code, or by dropping the connection when code is None.'''
+        with self._lock:
+            self._failures.extend([(service, code or 0)] * count)
+
+    def _next_failure(self, service):
+        with self._lock:
+            for index, (target, code) in enumerate(self._failures):
+                if target in (None, service):
+                    del self._failures[index]
+                    return code
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                return self.failure_code
+        return None
+
+    def _count(self, service, code):
+        with self._lock:
+            counts = self.requests.setdefault(service, {})
+            counts[code] = counts.get(code, 0) + 1
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage = "%prog [options]", description = "Serve fake blob, queue and table endpoints until interrupted.")
+    parser.add_option("--ports", default = "10000,10001,10002", help = "blob, queue and table ports [%default]")
+    parser.add_option("--latency", type = "float", default = 0, help = "seconds added to every request")
+    parser.add_option("--failure-rate", type = "float", default = 0, help = "share of requests failing with 503")
+    options, args = parser.parse_args()
+    fake = FakeAzure(latency = options.latency, failure_rate = options.failure_rate, ports = [int(port) for port in options.ports.split(",")]).start()
+    print "blob %s, queue %s, table %s (account %s)" % (fake.blob_host, fake.queue_host, fake.table_host, fake.account)
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,602 @@
 from winazurestorage import *
 import base64
+import hashlib
+import hmac
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+from datetime import datetime
+from urllib2 import HTTPError, Request, urlopen
+from urlparse import parse_qs
 
-def do_blob_tests(account, key):
+def check(label, actual, expected):
+    print "\t%s: %s" % (label, actual)
+    assert actual == expected, "%s: expected %r, got %r" % (label, expected, actual)
+
+def do_blob_tests(account, key, blobs = None):
     '''Expected output:
         Starting blob tests
                 create_container: 201
                 put_blob: 201
                 get_blob: Hello, World!
+                put_block: 201
+                upload_stream: 201
                 delete_container: 202
         Done.
     '''
     print "Starting blob tests"
-    if account is None or key is None: blobs = BlobStorage()
+    if blobs is not None: pass
+    elif account is None or key is None: blobs = BlobStorage()
     else: blobs = BlobStorage(CLOUD_BLOB_HOST, account, key)
     print "\tcreate_container: %d" % blobs.create_container("testcontainer", True)
     print "\tput_blob: %d" % blobs.put_blob("testcontainer", "testblob.txt", "Hello, World!")
     print "\tget_blob: %s" % blobs.get_blob("testcontainer", "testblob.txt")
     print "\tput_block: %d" % blobs.put_block("testcontainer", "testblob.txt", base64.encodestring('foobar'), 'something')
+    print "\tupload_stream: %d" % blobs.upload_stream("testcontainer", "testblocks.txt", StringIO("Hello, World!" * 1000), block_size=1024)
     print "\tdelete_container: %d" % blobs.delete_container("testcontainer")
     print "Done."
 
-def do_table_tests(account, key):
-    if account is None or key is None:
+def do_table_tests(account, key, tables = None):
+    if tables is None and (account is None or key is None):
         print "Skipping table tests, since no account and key were passed on the command line."
         return
     print "Starting table tests"
-    tables = TableStorage(CLOUD_TABLE_HOST, account, key)
+    if tables is None: tables = TableStorage(CLOUD_TABLE_HOST, account, key)
     print "\tcreate_table: %d" % tables.create_table("testtable")
     print "\tget_all: %d" % len(tables.get_all("testtable"))
+    print "\tinsert_entity: %d" % tables.insert_entity("testtable", TableEntity("it's", "1", {"Count": 1}))
+    print "\tquery_entity: %d" % len(tables.query_entity("testtable", (Property("PartitionKey") == "it's") & (Property("Count") >= 1), ["Count"]))
+    print "\tdelete_entity: %d" % tables.delete_entity("testtable", "it's", "1")
+    # Property names may be Python keywords.
+    print "\tinsert_entity with keyword properties: %d" % tables.insert_entity("testtable", TableEntity("keywords", "1", {"from": "alice", "class": 1, "None": "x"}))
+    entity = tables.get_entity("testtable", "keywords", "1")
+    print "\tget_entity with keyword properties: %s %s %s" % (getattr(entity, "from"), getattr(entity, "class"), getattr(entity, "None"))
+    # Properties named like the record's own attributes must not shadow them.
+    clashing = {"partition_key": "p", "row_key": "r", "properties": "x", "_names": "n", "to_update_xml": "u"}
+    tables.insert_entity("testtable", TableEntity("clash", "1", clashing))
+    entity = tables.get_entity("testtable", "clash", "1")
+    check("get_entity with clashing properties", (entity.partition_key, entity.row_key, entity.properties), ("clash", "1", clashing))
+    check("update_entity with clashing properties", tables.update_entity("testtable", "clash", "1", entity), 204)
+    check("entity after update", tables.get_entity("testtable", "clash", "1").properties, clashing)
+    tables.delete_entity("testtable", "clash", "1")
+    # Ints beyond the Int32 range are stored as Int64, the type filters compare them with.
+    tables.insert_entity("testtable", TableEntity("big", "1", {"Big": 1099511627776, "Small": 7}))
+    entity = tables.get_entity("testtable", "big", "1")
+    check("get_entity with a large int", (entity.Big, entity.Small), (1099511627776, 7))
+    check("query_entity on a large int", len(tables.query_entity("testtable", Property("Big") == 1099511627776)), 1)
+    tables.delete_entity("testtable", "big", "1")
     print "\tdelete_table: %d" % tables.delete_table("testtable")
     print "Done"
 
-def do_queue_tests(account, key):
+def do_batch_tests(tables):
+    print "Starting batch tests"
+    tables.create_table("batchtable")
+    batch = TableBatch("batchtable")
+    for i in range(3): batch.insert_entity(TableEntity("p", str(i), {"Count": i}))
+    check("commit_batch", [code < 300 for code in tables.commit_batch(batch)], [True] * 3)
+    check("entities after commit_batch", sorted(entity.row_key for entity in tables.get_all("batchtable")), ["0", "1", "2"])
+    # Row 1 exists already, so the transaction fails as a whole and reports which operation failed.
+    batch = TableBatch("batchtable")
+    for i in (3, 1, 4): batch.insert_entity(TableEntity("p", str(i), {"Count": i}))
+    check("commit_batch with a conflict", tables.commit_batch(batch), [None, 409, None])
+    check("entities after the failed batch", len(tables.get_all("batchtable")), 3)
+    try:
+        batch.insert_entity(TableEntity("q", "1", {}))
+        rejected = False
+    except TableEntityException:
+        rejected = True
+    check("batch across partitions rejected", rejected, True)
+
+    entities = [TableEntity("w%d" % (i % 2), "%03d" % i, {"Count": i}) for i in range(250)]
+    check("write_entities", tables.write_entities("batchtable", entities), [])
+    check("entities after write_entities", len(tables.get_all("batchtable")), 253)
+    failures = tables.write_entities("batchtable", [TableEntity("w0", "new", {}), TableEntity("w0", "000", {})])
+    check("write_entities with a conflict", [(entity.row_key, code) for entity, code in failures], [("new", None), ("000", 409)])
+    check("delete with write_entities", tables.write_entities("batchtable", entities, "delete"), [])
+    check("entities after deleting", len(tables.get_all("batchtable")), 3)
+    tables.delete_table("batchtable")
+    print "Done"
+
+def do_payload_format_tests(fake):
+    print "Starting payload format tests"
+    properties = {"Name": "Hello", "Count": 3, "Big": 1L << 40, "Ratio": 0.5, "Flag": True, "When": datetime(2020, 1, 2, 3, 4, 5)}
+    # Without metadata the service can't tell an Int64 or a DateTime from a string.
+    untyped = dict(properties, Big = "1099511627776", When = "2020-01-02T03:04:05Z")
+    for payload_format, expected in ((PAYLOAD_ATOM, properties), (PAYLOAD_MINIMAL_METADATA, properties), (PAYLOAD_NO_METADATA, untyped)):
+        tables = TableStorage(fake.table_host, fake.account, fake.key, payload_format = payload_format)
+        sent = []
+        send = tables._send
+        def recording_send(req):
+            if req.has_data(): sent.append(req.get_header("Content-type").split(";")[0])
+            return send(req)
+        tables._send = recording_send
+        tables.create_table("formattable")
+        tables.insert_entity("formattable", TableEntity("p", "1", properties))
+        entity = tables.get_entity("formattable", "p", "1")
+        check("%s round trip" % payload_format, entity.properties, expected)
+        check("%s bodies sent" % payload_format, sent, payload_format == PAYLOAD_ATOM and ["application/atom+xml"] * 2 or ["application/json"] * 2)
+        tables.delete_table("formattable")
+    print "Done"
+
+def do_scan_tests(tables):
+    print "Starting scan tests"
+    tables.create_table("scantable")
+    entities = [TableEntity(hashlib.md5(str(i % 40)).hexdigest(), "%03d" % i, {"Count": i, "Even": i % 2 == 0}) for i in range(300)]
+    entities[0].properties["Note"] = "first"
+    tables.write_entities("scantable", entities)
+    found = []
+    check("scan_entities", tables.scan_entities("scantable", found.append, max_workers = 4), 300)
+    check("entities scanned", sorted(entity.Count for entity in found) == range(300), True)
+    del found[:]
+    tables.scan_entities("scantable", found.append, (Property("Count") >= 100) & (Property("Even") == True), ["Count"], max_workers = 4)
+    check("scan_entities with a filter", sorted(entity.Count for entity in found) == range(100, 300, 2), True)
+    check("properties selected", set(tuple(sorted(entity.properties)) for entity in found), set([("Count",)]))
+    del found[:]
+    tables.scan_entities("scantable", found.append, ranges = split_key_space(5, "0123456789abcdef"))
+    check("scan_entities with key ranges", len(found), 300)
+
+    output = StringIO()
+    tables.scan_entities("scantable", JsonLinesSink(output), Property("Count") < 3)
+    rows = sorted((json.loads(line) for line in output.getvalue().splitlines()), key = lambda row: row["Count"])
+    check("JsonLinesSink", [(row["Count"], row.get("Note"), "Timestamp" in row) for row in rows], [(0, "first", True), (1, None, True), (2, None, True)])
+    output = StringIO()
+    tables.scan_entities("scantable", CsvSink(output, ["RowKey", "Count", "Note"]), Property("Count") < 3)
+    lines = output.getvalue().splitlines()
+    check("CsvSink", [lines[0]] + sorted(lines[1:]), ["RowKey,Count,Note", "000,0,first", "001,1,", "002,2,"])
+    batches = []
+    tables.scan_entities("scantable", ColumnarSink(lambda columns, rows: batches.append((columns, rows)), batch_size = 64), max_workers = 4)
+    check("ColumnarSink rows", sorted(rows for columns, rows in batches), [44] + [64] * 4)
+    check("ColumnarSink columns", all(len(column) == rows for columns, rows in batches for column in columns.values()), True)
+    check("ColumnarSink values", sorted(value for columns, rows in batches for value in columns["Count"]) == range(300), True)
+    check("ColumnarSink sparse column", [value for columns, rows in batches for value in columns.get("Note", []) if value is not None], ["first"])
+    tables.delete_table("scantable")
+    print "Done"
+
+def do_queue_tests(account, key, queues = None):
     print "Starting queue tests"
-    if account is None or key is None: queues = QueueStorage()
+    if queues is not None: pass
+    elif account is None or key is None: queues = QueueStorage()
     else: queues = QueueStorage(CLOUD_QUEUE_HOST, account, key)
     print "\tcreate_queue: %d" % queues.create_queue("testqueue")
+    print "\tput_message: %d" % queues.put_message("testqueue", "Hello, World!")
+    check("peek_messages past the limit", [message.text for message in queues.peek_messages("testqueue", 40)], ["Hello, World!"])
+    messages = queues.get_messages("testqueue", 40, visibility_timeout=60)
+    print "\tget_messages: %s" % [message.text for message in messages]
+    print "\tdelete_messages: %s" % queues.delete_messages("testqueue", messages)
     print "\tdelete_queue: %d" % queues.delete_queue("testqueue")
     print "Done"
 
+def do_retry_tests(fake):
+    '''Expected output:
+        Starting retry tests
+                put_blob after two 503s: 201
+                get_blob after a dropped connection: Hello, World!
+                put_message after a 500: 500
+                put_message after a 503: 201
+                circuit breaker open: 503, requests sent: 0
+                circuit breaker closed: 201
+        Done.
+    '''
+    print "Starting retry tests"
+    policy = RetryPolicy(backoff = 0.01)
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key, retry_policy = policy)
+    queues = QueueStorage(fake.queue_host, fake.account, fake.key, retry_policy = policy)
+    blobs.create_container("retrycontainer")
+    queues.create_queue("retryqueue")
+    fake.fail_next(2, 503)
+    print "\tput_blob after two 503s: %d" % blobs.put_blob("retrycontainer", "testblob.txt", "Hello, World!")
+    fake.fail_next(1, None)
+    print "\tget_blob after a dropped connection: %s" % blobs.get_blob("retrycontainer", "testblob.txt")
+    # A POST may have been processed when a 500 comes back, so it is not sent again.
+    fake.fail_next(1, 500)
+    print "\tput_message after a 500: %d" % queues.put_message("retryqueue", "Hello, World!")
+    fake.fail_next(1, 503)
+    print "\tput_message after a 503: %d" % queues.put_message("retryqueue", "Hello, World!")
+
+    breaker = RetryPolicy(max_attempts = 1, failure_threshold = 3, reset_timeout = 0.5)
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key, retry_policy = breaker)
+    fake.fail_next(3, 500)
+    for i in range(3): blobs.put_blob("retrycontainer", "testblob.txt", "Hello, World!")
+    sent = sum(sum(counts.values()) for counts in fake.requests.values())
+    code = blobs.put_blob("retrycontainer", "testblob.txt", "Hello, World!")
+    print "\tcircuit breaker open: %d, requests sent: %d" % (code, sum(sum(counts.values()) for counts in fake.requests.values()) - sent)
+    time.sleep(0.5)
+    print "\tcircuit breaker closed: %d" % blobs.put_blob("retrycontainer", "testblob.txt", "Hello, World!")
+    print "Done."
+
+def do_shared_access_tests(fake):
+    print "Starting shared access signature tests"
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    tables = TableStorage(fake.table_host, fake.account, fake.key)
+    blobs.create_container("sascontainer")
+    blobs.put_blob("sascontainer", "blob.txt", "Hello, World!")
+    def signature(*fields):
+        return base64.b64encode(hmac.new(base64.b64decode(fake.key), "\n".join(fields), hashlib.sha256).digest())
+
+    token = blobs.generate_shared_access_signature("sascontainer", "blob.txt", "r", datetime(2030, 1, 1))
+    fields = parse_qs(token)
+    check("blob token fields", sorted((name, values[0]) for name, values in fields.items() if name != "sig"),
+          [("se", "2030-01-01T00:00:00Z"), ("sp", "r"), ("sr", "b"), ("sv", SAS_VERSION)])
+    check("blob token signature", fields["sig"][0] == signature("r", "", "2030-01-01T00:00:00Z", "/%s/sascontainer/blob.txt" % fake.account, "", SAS_VERSION), True)
+    token = tables.generate_shared_access_signature("SasTable", "r", "2030-01-01T00:00:00Z", start_partition_key = "a", end_partition_key = "b")
+    fields = parse_qs(token)
+    check("table token fields", (fields["tn"], fields["spk"], fields["epk"]), (["SasTable"], ["a"], ["b"]))
+    check("table token signature", fields["sig"][0] == signature("r", "", "2030-01-01T00:00:00Z", "/%s/sastable" % fake.account, "", SAS_VERSION, "a", "", "b", ""), True)
+
+    # Requests made with SAS credentials carry the token instead of an Authorization header.
+    token = blobs.generate_shared_access_signature("sascontainer", permission = "rl", expiry = "2030-01-01T00:00:00Z")
+    credentials = SharedAccessSignatureCredentials("?" + token)
+    req = credentials.sign_request(Request("http://%s/sascontainer/blob.txt?comp=metadata" % fake.blob_host))
+    check("signed URL", req.get_full_url() == "http://%s/sascontainer/blob.txt?comp=metadata&%s" % (fake.blob_host, token), True)
+    check("signed request headers", "Authorization" in req.headers, False)
+    sas_blobs = BlobStorage(fake.blob_host, fake.account, fake.key, credentials = credentials)
+    check("get_blob with SAS credentials", sas_blobs.get_blob("sascontainer", "blob.txt"), "Hello, World!")
+    check("get_shared_access_url", urlopen(blobs.get_shared_access_url("sascontainer", "blob.txt", expiry = "2030-01-01T00:00:00Z")).read(), "Hello, World!")
+    blobs.delete_container("sascontainer")
+    print "Done."
+
+def do_copy_tests(fake):
+    print "Starting copy and snapshot tests"
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    blobs.create_container("copycontainer")
+    blobs.put_blob("copycontainer", "source.txt", "version 1")
+    snapshot = blobs.snapshot_blob("copycontainer", "source.txt")
+    blobs.put_blob("copycontainer", "source.txt", "version 2")
+    check("get_blob of the snapshot", blobs.get_blob("copycontainer", "source.txt", snapshot), "version 1")
+    check("copy_blob", blobs.copy_blob("copycontainer", "source.txt", "copycontainer", "copy.txt")[1], "success")
+    check("get_blob of the copy", blobs.get_blob("copycontainer", "copy.txt"), "version 2")
+    blobs.copy_blob("copycontainer", "source.txt", "copycontainer", "old.txt", source_snapshot = snapshot)
+    check("get_blob of the snapshot copy", blobs.get_blob("copycontainer", "old.txt"), "version 1")
+    try:
+        blobs.delete_blob("copycontainer", "source.txt")
+        code = None
+    except HTTPError, e:
+        code = e.code
+    check("delete_blob with snapshots", code, 409)
+    blobs.delete_blob("copycontainer", "source.txt", delete_snapshots = "include")
+    check("blob deleted with its snapshots", blobs.blob_exists("copycontainer", "source.txt"), False)
+
+    blobs.put_blob("copycontainer", "dir/a", "a")
+    blobs.put_blob("copycontainer", "dir/b", "b")
+    results = blobs.copy_prefix("copycontainer", "dir/", "copycontainer", "copied/", wait = True).wait()
+    check("copy_prefix", (results.succeeded, results.failed), (2, 0))
+    check("copied blobs", [blobs.get_blob("copycontainer", name) for name in ("copied/a", "copied/b")], ["a", "b"])
+
+    # Copies now stay pending for a while, to be waited for or aborted.
+    fake.blob.copy_delay = 0.3
+    try:
+        check("pending copy_blob", blobs.copy_blob("copycontainer", "dir/a", "copycontainer", "slow.txt")[1], "pending")
+        check("wait_for_copy", blobs.wait_for_copy("copycontainer", "slow.txt", poll_interval = 0.05)["status"], "success")
+        check("get_blob after wait_for_copy", blobs.get_blob("copycontainer", "slow.txt"), "a")
+        copy_id, status = blobs.copy_blob("copycontainer", "dir/b", "copycontainer", "aborted.txt")
+        check("abort_copy", blobs.abort_copy("copycontainer", "aborted.txt", copy_id), 204)
+        check("status after abort_copy", blobs.get_copy_status("copycontainer", "aborted.txt")["status"], "aborted")
+    finally:
+        fake.blob.copy_delay = 0
+    blobs.delete_container("copycontainer")
+    print "Done."
+
+def do_page_and_append_blob_tests(fake):
+    print "Starting page and append blob tests"
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    blobs.create_container("pagecontainer")
+    check("create_page_blob", blobs.create_page_blob("pagecontainer", "disk", 4096), 201)
+    check("put_page", blobs.put_page("pagecontainer", "disk", 1024, "a" * 1024), 201)
+    check("clear_pages", blobs.clear_pages("pagecontainer", "disk", 1536, 2047), 201)
+    check("get_page_ranges", blobs.get_page_ranges("pagecontainer", "disk"), [(1024, 1535)])
+    check("get_page_ranges within a range", blobs.get_page_ranges("pagecontainer", "disk", 0, 1023), [])
+    check("get_blob of the page blob", blobs.get_blob("pagecontainer", "disk") == "\0" * 1024 + "a" * 512 + "\0" * 2560, True)
+    for name, call in (("put_page off a page boundary", lambda: blobs.put_page("pagecontainer", "disk", 100, "x")),
+                       ("get_page_ranges without end", lambda: blobs.get_page_ranges("pagecontainer", "disk", 0))):
+        try:
+            call()
+            rejected = False
+        except ValueError:
+            rejected = True
+        check(name + " rejected", rejected, True)
+
+    # Only the pages holding data are sent and fetched.
+    directory = tempfile.mkdtemp()
+    try:
+        source, target = os.path.join(directory, "sparse"), os.path.join(directory, "sparse.out")
+        with open(source, "wb") as f:
+            f.truncate(3 * 1024 * 1024 + 300)
+            f.seek(1000); f.write("hello")
+            f.seek(2 * 1024 * 1024); f.write("z" * 5000)
+        check("upload_page_blob_from_file", blobs.upload_page_blob_from_file("pagecontainer", "image", source), 11 * PAGE_SIZE)
+        check("download_page_blob_to_file", blobs.download_page_blob_to_file("pagecontainer", "image", target, range_size = 4096), 11 * PAGE_SIZE)
+        data = open(source, "rb").read()
+        check("downloaded image", open(target, "rb").read() == data + "\0" * (-len(data) % PAGE_SIZE), True)
+    finally:
+        shutil.rmtree(directory)
+
+    check("create_append_blob", blobs.create_append_blob("pagecontainer", "log"), 201)
+    check("append_block", [blobs.append_block("pagecontainer", "log", "one\n"), blobs.append_block("pagecontainer", "log", "two\n", append_position = 4)], [0, 4])
+    try:
+        blobs.append_block("pagecontainer", "log", "three\n", append_position = 0)
+        code = None
+    except HTTPError, e:
+        code = e.code
+    check("append_block at a wrong position", code, 412)
+    check("get_blob of the append blob", blobs.get_blob("pagecontainer", "log").split("\n"), ["one", "two", ""])
+    blobs.delete_container("pagecontainer")
+    print "Done."
+
+def do_content_encoding_tests(fake):
+    print "Starting content encoding tests"
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    blobs.create_container("encodingcontainer")
+    stored = fake.blob.containers["encodingcontainer"]
+    text = "Hello, World! " * 10000
+    check("put_blob gzip", blobs.put_blob("encodingcontainer", "put.txt", text, content_encoding = "gzip", compute_md5 = True), 201)
+    check("stored compressed", len(stored["put.txt"]["data"]) < len(text) / 10, True)
+    check("get_blob", blobs.get_blob("encodingcontainer", "put.txt") == stored["put.txt"]["data"], True)
+    check("get_blob_stream", blobs.get_blob_stream("encodingcontainer", "put.txt").read() == stored["put.txt"]["data"], True)
+    check("get_blob decompressed and verified", blobs.get_blob("encodingcontainer", "put.txt", decompress = True, verify_md5 = True) == text, True)
+    check("upload_stream gzip", blobs.upload_stream("encodingcontainer", "stream.txt", StringIO(text), block_size = 1024, content_encoding = "gzip", compute_md5 = True), 201)
+    check("iter_blob decompressed and verified", "".join(blobs.iter_blob("encodingcontainer", "stream.txt", range_size = 1000, decompress = True, verify_md5 = True)) == text, True)
+    directory = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(directory, "stream.txt")
+        blobs.download_blob_to_file("encodingcontainer", "stream.txt", file_name, decompress = True, verify_md5 = True)
+        check("download_blob_to_file decompressed", open(file_name, "rb").read() == text, True)
+    finally:
+        shutil.rmtree(directory)
+
+    data = stored["put.txt"]["data"]
+    stored["put.txt"]["data"] = data[:-1] + chr(ord(data[-1]) ^ 1)
+    try:
+        blobs.get_blob("encodingcontainer", "put.txt", verify_md5 = True)
+        detected = False
+    except IOError:
+        detected = True
+    check("corruption detected", detected, True)
+
+    # Encodings other than gzip, set by other tools, are passed through.
+    for encoding in ("identity", "br"):
+        blobs.put_blob("encodingcontainer", "other.txt", "plain")
+        stored["other.txt"]["content_encoding"] = encoding
+        check("get_blob_stream of %s content" % encoding, blobs.get_blob_stream("encodingcontainer", "other.txt", decompress = True).read(), "plain")
+    blobs.delete_container("encodingcontainer")
+    print "Done."
+
+def do_instrumentation_tests(fake):
+    print "Starting instrumentation tests"
+    stream = StringIO()
+    metrics = MetricsCollector([JsonLinesExporter(stream), MetricsExporter()])
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key, instrumentation = metrics)
+    blobs.create_container("metricscontainer")
+    blobs.put_blob("metricscontainer", "blob.txt", "Hello, World!")
+    blobs.upload_stream("metricscontainer", "stream.txt", StringIO("x" * 10), block_size = 4, max_workers = 1)
+    BlobCache(blobs).get_blob("metricscontainer", "blob.txt")
+    blobs.get_blob_properties("metricscontainer", "blob.txt")
+    snapshot = metrics.export()
+    check("operations", sorted(snapshot), ["BlobStorage.create_container", "BlobStorage.get_blob", "BlobStorage.get_blob_properties",
+                                           "BlobStorage.put_blob", "BlobStorage.put_block", "BlobStorage.put_block_list"])
+    check("requests per operation", [snapshot[operation]["requests"] for operation in sorted(snapshot)], [1, 1, 1, 1, 3, 1])
+    check("bytes read by get_blob", snapshot["BlobStorage.get_blob"]["bytes_in"], len("Hello, World!"))
+    check("exported snapshot", sorted(json.loads(stream.getvalue())["operations"]), sorted(snapshot))
+
+def do_blob_cache_tests(fake):
+    print "Starting blob cache tests"
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    blobs.create_container("cachecontainer")
+    blobs.put_blob("cachecontainer", "blob.txt", "Hello, World!")
+    def requests_sent():
+        return sum(sum(counts.values()) for counts in fake.requests.values())
+
+    cache = BlobCache(blobs)
+    check("get_blob through the cache", [cache.get_blob("cachecontainer", "blob.txt") for i in range(2)], ["Hello, World!"] * 2)
+    check("revalidated hit", [cache.stats()[key] for key in ("misses", "hits", "revalidations")], [1, 1, 1])
+    blobs.put_blob("cachecontainer", "blob.txt", "Changed")
+    check("get_blob after a change", cache.get_blob("cachecontainer", "blob.txt"), "Changed")
+    cache = BlobCache(blobs, ttl = 60)
+    cache.get_blob("cachecontainer", "blob.txt")
+    sent = requests_sent()
+    check("get_blob within the ttl", cache.get_blob("cachecontainer", "blob.txt"), "Changed")
+    check("requests sent within the ttl", requests_sent() - sent, 0)
+    cache = BlobCache(blobs, max_bytes = 10)
+    blobs.put_blob("cachecontainer", "other.txt", "12345678")
+    cache.get_blob("cachecontainer", "blob.txt")
+    cache.get_blob("cachecontainer", "other.txt")
+    check("entries after eviction", [cache.stats()[key] for key in ("entries", "bytes")], [1, 8])
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = BlobCache(blobs, directory = directory)
+        # Concurrent misses on the same blob each store it; none may fail or leave files behind.
+        errors = []
+        def get():
+            try: cache.get_blob("cachecontainer", "blob.txt")
+            except Exception, e: errors.append(e)
+        threads = [threading.Thread(target = get) for i in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        check("concurrent stores", errors, [])
+        check("cache files", len(os.listdir(directory)), 2)
+        cache = BlobCache(blobs, directory = directory, ttl = 60)
+        sent = requests_sent()
+        check("get_blob from a reloaded cache", cache.get_blob("cachecontainer", "blob.txt"), "Changed")
+        check("requests sent by the reloaded cache", requests_sent() - sent, 0)
+    finally:
+        shutil.rmtree(directory)
+    blobs.delete_container("cachecontainer")
+    print "Done."
+
+def do_parallel_download_tests(fake):
+    print "Starting parallel download tests"
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    blobs.create_container("downloadcontainer")
+    data = "".join(chr(i % 251) for i in range(100 * 1024))
+    blobs.put_blob("downloadcontainer", "blob", data)
+    check("iter_blob", "".join(blobs.iter_blob("downloadcontainer", "blob", range_size = 1000, max_workers = 4)) == data, True)
+
+    # Stall the first range: later ranges may be fetched ahead, but only up to the window.
+    release = threading.Event()
+    started = []
+    get_blob_range = blobs.get_blob_range
+    def stalling_get_blob_range(container_name, blob_name, start, end, etag = None):
+        started.append(start)
+        if start == 0: release.wait()
+        return get_blob_range(container_name, blob_name, start, end, etag)
+    blobs.get_blob_range = stalling_get_blob_range
+    chunks = blobs.iter_blob("downloadcontainer", "blob", range_size = 1000, max_workers = 4)
+    reader = threading.Thread(target = lambda: started.append("".join(chunks) == data))
+    reader.daemon = True
+    reader.start()
+    time.sleep(0.5)
+    check("ranges requested while the first one stalls", len(started), 8)
+    release.set()
+    reader.join()
+    check("iter_blob after a stalled range", started[-1], True)
+    blobs.delete_container("downloadcontainer")
+    print "Done."
+
+def do_directory_sync_tests(fake):
+    print "Starting directory sync tests"
+    blobs = BlobStorage(fake.blob_host, fake.account, fake.key)
+    blobs.create_container("synccontainer")
+    source, target = tempfile.mkdtemp(), tempfile.mkdtemp()
+    def counts(result):
+        return result["transferred"], result["skipped"], result["deleted"]
+    try:
+        os.mkdir(os.path.join(source, "sub"))
+        contents = {"a.txt": "Hello, World!", "sub/b.txt": "b" * 1000, "large.bin": "l" * (BLOCK_SIZE + 1)}
+        for name, data in contents.items():
+            with open(os.path.join(source, *name.split("/")), "wb") as f: f.write(data)
+        sync = DirectorySync(blobs, source, "synccontainer", "files/")
+        check("upload", counts(sync.upload()), (3, 0, 0))
+        check("stored blobs", sorted(name for name, etag, modified in blobs.list_blobs("synccontainer")), ["files/a.txt", "files/large.bin", "files/sub/b.txt"])
+        check("upload again", counts(sync.upload()), (0, 3, 0))
+        with open(os.path.join(source, "a.txt"), "wb") as f: f.write("Changed")
+        os.remove(os.path.join(source, "sub", "b.txt"))
+        check("upload after changes", counts(sync.upload(delete = True)), (1, 1, 1))
+        check("blob of the changed file", blobs.get_blob("synccontainer", "files/a.txt"), "Changed")
+
+        with open(os.path.join(target, "extra.txt"), "wb") as f: f.write("extra")
+        sync = DirectorySync(blobs, target, "synccontainer", "files/")
+        check("download", counts(sync.download(delete = True)), (2, 0, 1))
+        check("downloaded files", sorted(os.listdir(target)), sorted(["a.txt", "large.bin", SYNC_MANIFEST_NAME]))
+        check("downloaded content", open(os.path.join(target, "large.bin"), "rb").read() == contents["large.bin"], True)
+        check("download again", counts(sync.download()), (0, 2, 0))
+
+        # A blob whose name leads out of the directory fails instead of being written there.
+        blobs.put_blob("synccontainer", "files/../x", "outside")
+        result = sync.download()
+        check("download of files/../x", [(name, type(error).__name__) for name, error in result["failed"]], [("../x", "ValueError")])
+        check("file written outside", os.path.exists(os.path.join(target, "..", "x")), False)
+    finally:
+        shutil.rmtree(source)
+        shutil.rmtree(target)
+    blobs.delete_container("synccontainer")
+    print "Done."
+
+def wait_for(condition, timeout = 10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def do_queue_consumer_tests(fake):
+    '''Expected output:
+        Starting queue consumer tests
+                empty polls backed off: True
+                processed and deleted: 5 processed, 0 left
+                failed message kept: 1 failed, 1 left
+                renewed while handling: True, handled once: True
+                threads alive after dropped connections: True, errors counted: True
+                processed after dropped connections: True
+        Done.
+    '''
+    print "Starting queue consumer tests"
+    policy = RetryPolicy(backoff = 0.01, failure_threshold = 1000)
+    queues = QueueStorage(fake.queue_host, fake.account, fake.key, retry_policy = policy)
+    queues.create_queue("consumerqueue")
+    handled = []
+    def handler(message):
+        handled.append(message.text)
+        if message.text == "fail": raise ValueError(message.text)
+        if message.text.startswith("slow"): time.sleep(1.5)
+
+    # With no backoff, 0.5 seconds of polling every 0.01 seconds would take 50 requests.
+    consumer = QueueConsumer(queues, "consumerqueue", handler, workers = 2, visibility_timeout = 1, min_poll_interval = 0.01, max_poll_interval = 0.16)
+    consumer.start()
+    time.sleep(0.5)
+    print "\tempty polls backed off: %s" % (consumer.stats()["empty_polls"] <= 10)
+
+    for i in range(5): queues.put_message("consumerqueue", "message %d" % i)
+    wait_for(lambda: consumer.stats()["processed"] == 5)
+    print "\tprocessed and deleted: %d processed, %d left" % (consumer.stats()["processed"], len(fake.queue.queues["consumerqueue"]))
+
+    queues.put_message("consumerqueue", "fail")
+    wait_for(lambda: consumer.stats()["failed"] == 1)
+    print "\tfailed message kept: %d failed, %d left" % (consumer.stats()["failed"], len(fake.queue.queues["consumerqueue"]))
+    consumer.stop()
+    del fake.queue.queues["consumerqueue"][:]
+
+    # The handler outlives the 1 second visibility timeout, so the message must be renewed.
+    del handled[:]
+    consumer = QueueConsumer(queues, "consumerqueue", handler, workers = 2, visibility_timeout = 1, min_poll_interval = 0.01, max_poll_interval = 0.05)
+    consumer.start()
+    queues.put_message("consumerqueue", "slow 1")
+    wait_for(lambda: consumer.stats()["processed"] == 1)
+    print "\trenewed while handling: %s, handled once: %s" % (consumer.stats()["renewed"] >= 1, handled == ["slow 1"])
+
+    # Drop every connection while a slow message is being handled: its renewals and its
+    # delete fail, but the threads must survive and handle the next message.
+    queues.put_message("consumerqueue", "slow 2")
+    wait_for(lambda: "slow 2" in handled)
+    fake.fail_next(50, None, "queue")
+    wait_for(lambda: not fake._failures)
+    alive = all(thread.is_alive() for thread in consumer._threads)
+    print "\tthreads alive after dropped connections: %s, errors counted: %s" % (alive, consumer.stats()["errors"] > 0)
+    queues.put_message("consumerqueue", "message 6")
+    print "\tprocessed after dropped connections: %s" % wait_for(lambda: "message 6" in handled)
+    consumer.stop()
+    queues.delete_queue("consumerqueue")
+    print "Done."
+
 def run_tests(account, key):
     do_blob_tests(account, key)
     do_table_tests(account, key)
     do_queue_tests(account, key)
 
+def run_fake_tests():
+    '''Run the tests against the local fake server (fakeazure.py), adding the tests which
+       need its failure injection.'''
+    from fakeazure import FakeAzure
+    fake = FakeAzure().start()
+    try:
+        do_blob_tests(None, None, BlobStorage(fake.blob_host, fake.account, fake.key))
+        do_table_tests(None, None, TableStorage(fake.table_host, fake.account, fake.key))
+        do_table_tests(None, None, TableStorage(fake.table_host, fake.account, fake.key, payload_format = PAYLOAD_MINIMAL_METADATA))
+        do_batch_tests(TableStorage(fake.table_host, fake.account, fake.key))
+        do_batch_tests(TableStorage(fake.table_host, fake.account, fake.key, payload_format = PAYLOAD_NO_METADATA))
+        do_payload_format_tests(fake)
+        do_scan_tests(TableStorage(fake.table_host, fake.account, fake.key))
+        do_queue_tests(None, None, QueueStorage(fake.queue_host, fake.account, fake.key))
+        do_retry_tests(fake)
+        do_shared_access_tests(fake)
+        do_copy_tests(fake)
+        do_page_and_append_blob_tests(fake)
+        do_content_encoding_tests(fake)
+        do_blob_cache_tests(fake)
+        do_instrumentation_tests(fake)
+        do_parallel_download_tests(fake)
+        do_directory_sync_tests(fake)
+        do_queue_consumer_tests(fake)
+    finally:
+        fake.stop()
+
 if __name__ == '__main__':
-    if len(sys.argv) > 2:
+    if sys.argv[1:] == ["--fake"]:
+        run_fake_tests()
+    elif len(sys.argv) > 2:
         run_tests(sys.argv[1], sys.argv[2])
     else:
         run_tests(None, None)
\ No newline at end of file
@@ -9,18 +9,33 @@ Steve Marx <steve.marx@microsoft.com>
 import base64
 import hmac
 import hashlib
+import zlib
 import time
 import sys
 import os
-from xml.dom import minidom #TODO: Use a faster way of processing XML
+import tempfile
+from xml.etree.cElementTree import iterparse
+from xml.sax.saxutils import escape
 import re
-from urllib2 import Request, urlopen, URLError
+import uuid
+import random
+import errno
+import math
+import httplib
+import socket
+import threading
+import types
+import json
+import keyword
+import csv
+import Queue
+from collections import deque, OrderedDict
+from cStringIO import StringIO
+from urllib2 import Request, urlopen, URLError, HTTPError
 from urllib import urlencode, quote
 from urlparse import urlsplit, parse_qs
 from datetime import datetime, timedelta
 
-import locale # dirty hack for locale changing
-
 DEVSTORE_ACCOUNT = "devstoreaccount1"
 DEVSTORE_SECRET_KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
 
@@ -38,14 +53,194 @@ PREFIX_STORAGE_HEADER = "x-ms-"
 
 NEW_LINE = "\x0A"
 
+SAS_VERSION = "2012-02-12" # first version with shared access signatures for queues and tables
+SAS_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
 DEBUG = False
 
 TIME_FORMAT ="%a, %d %b %Y %H:%M:%S %Z"
 
+ATOM_NAMESPACE = "{http://www.w3.org/2005/Atom}"
+DATASERVICES_NAMESPACE = "{http://schemas.microsoft.com/ado/2007/08/dataservices}"
+METADATA_NAMESPACE = "{http://schemas.microsoft.com/ado/2007/08/dataservices/metadata}"
+
+POOL_MAX_IDLE_PER_HOST = 10
+POOL_IDLE_TIMEOUT = 60 # seconds an idle keep-alive connection is kept around
+POOL_PRELOAD_LIMIT = 64 * 1024 # bodies up to this size are read eagerly
+
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5 # seconds, doubled on every attempt
+RETRY_MAX_BACKOFF = 30
+RETRY_MAX_ELAPSED = 60 # well within the 15 minute validity of a request signature
+RETRY_STATUS_CODES = frozenset((408, 500, 502, 503, 504))
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "PUT", "DELETE", "MERGE"))
+
+ACCOUNT_RATE_LIMIT = 20000 # requests per second, the scalability targets of a storage account
+BLOB_RATE_LIMIT = 500 # per blob
+QUEUE_RATE_LIMIT = 2000 # per queue
+TABLE_RATE_LIMIT = 2000 # per table partition
+RATE_LIMIT_MAX_BUCKETS = 10000
+
+HISTOGRAM_MIN_VALUE = 1e-6 # smaller values share the first bucket
+HISTOGRAM_PRECISION = 0.05
+
+DEFAULT_WORKERS = 8
+SYNC_MANIFEST_NAME = ".winazurestorage-sync.json"
+DEFAULT_CONCURRENCY = 64 # concurrent requests of the Async* clients
+PAYLOAD_ATOM = "atom" # table payload formats
+PAYLOAD_NO_METADATA = "nometadata"
+PAYLOAD_MINIMAL_METADATA = "minimalmetadata"
+JSON_VERSION = "2013-08-15" # first version accepting JSON table payloads
+
+QUEUE_MAX_MESSAGES = 32 # most messages returned by one Get Messages request
+QUERY_PAGE_SIZE = 1000 # most entities returned by one table query request
+BATCH_MAX_OPERATIONS = 100 # limits of an Entity Group Transaction
+BATCH_MAX_SIZE = 4 * 1024 * 1024
+ENTITY_MAX_SIZE = 1024 * 1024
+SCAN_RANGES_PER_WORKER = 4 # smaller ranges even out skew between the workers of a table scan
+KEY_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BLOCK_SIZE = 4 * 1024 * 1024 # largest block accepted by Put Block
+RANGE_SIZE = 4 * 1024 * 1024 # size of each ranged GET issued by parallel downloads
+READ_CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6 # zlib's default; higher levels cost much more CPU for little gain on text
+PAGE_SIZE = 512 # page blobs are written in whole, aligned pages
+PAGE_MAX_WRITE = 4 * 1024 * 1024 # largest Put Page
+APPEND_MAX_BLOCK = 4 * 1024 * 1024 # largest Append Block
+APPEND_BLOB_VERSION = "2015-02-21" # first version with append blobs
+COPY_VERSION = "2012-02-12" # first version with asynchronous Copy Blob and copy status
+COPY_POLL_INTERVAL = 1 # seconds between copy status requests
+
+def iter_elements(source, tags):
+    '''Incrementally parse the XML document read from source (a file-like object such as a
+       response) and yield every element whose tag is in tags as soon as it is closed.
+       Yielded elements are detached and cleared afterwards, so memory use does not grow
+       with the size of the document; callers must extract what they need before resuming.'''
+    stack = []
+    for event, elem in iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag in tags:
+            yield elem
+            if stack: stack[-1].remove(elem)
+            elem.clear()
+
+_STOP = object()
+
+def parallel_imap(func, items, max_workers = DEFAULT_WORKERS):
+    '''Call func on every item from items using up to max_workers threads and yield
+       (item, result, exception) tuples in completion order. items is consumed lazily and at
+       most 2 * max_workers items are in flight at once, so large or unbounded iterables can be
+       processed with bounded memory. exception is None when func returned normally.'''
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    def worker():
+        while True:
+            item = tasks.get()
+            if item is _STOP: return
+            try: results.put((item, func(item), None))
+            except Exception, e: results.put((item, None, e))
+    threads = [threading.Thread(target=worker) for i in range(max(1, max_workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    in_flight = 0
+    try:
+        for item in items:
+            while in_flight >= 2 * len(threads):
+                in_flight -= 1
+                yield results.get()
+            tasks.put(item)
+            in_flight += 1
+        while in_flight:
+            in_flight -= 1
+            yield results.get()
+    finally:
+        # Idle workers exit right away; busy ones (when the caller stopped early) exit after
+        # their current item, whose result is dropped.
+        for thread in threads:
+            tasks.put(_STOP)
+    for thread in threads:
+        thread.join()
+
+class Future(object):
+    '''The pending result of a call submitted to an Executor.'''
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def _set(self, result, exception):
+        self._result, self._exception = result, exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout = None):
+        if not self._done.wait(timeout): raise RuntimeError("Timed out waiting for the result")
+        return self._exception
+
+    def result(self, timeout = None):
+        '''Wait for the call to finish and return its result, or raise its exception.'''
+        if self.exception(timeout) is not None: raise self._exception
+        return self._result
+
+class Executor(object):
+    '''Run submitted calls on at most max_workers threads, started on demand.'''
+    def __init__(self, max_workers = DEFAULT_WORKERS):
+        self.max_workers = max_workers
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is _STOP: return
+            future, func, args, kwargs = task
+            try: future._set(func(*args, **kwargs), None)
+            except Exception, e: future._set(None, e)
+            with self._lock:
+                self._idle += 1
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._idle: self._idle -= 1
+            elif len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._tasks.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait = True):
+        for thread in self._threads:
+            self._tasks.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+def gather(futures, timeout = None):
+    '''Wait for every future and return their results in order. The first exception is raised
+       once all of them have finished.'''
+    futures = list(futures)
+    errors = [future.exception(timeout) for future in futures]
+    for error in errors:
+        if error is not None: raise error
+    return [future.result() for future in futures]
+
 def parse_edm_datetime(input):
-    d = datetime.strptime(input[:input.find('.')], "%Y-%m-%dT%H:%M:%S")
-    if input.find('.') != -1:
-        d += timedelta(0, 0, int(round(float(input[input.index('.'):-1])*1000000)))
+    # Fixed layout (yyyy-mm-ddThh:mm:ss[.fffffff]Z), sliced directly as strptime is slow.
+    d = datetime(int(input[0:4]), int(input[5:7]), int(input[8:10]), int(input[11:13]), int(input[14:16]), int(input[17:19]))
+    fraction = input.find('.')
+    if fraction != -1:
+        d += timedelta(0, 0, int(round(float(input[fraction:].rstrip('Z'))*1000000)))
     return d
 
 def parse_edm_int32(input):
@@ -60,10 +255,36 @@ def parse_edm_double(input):
 def parse_edm_boolean(input):
     return input.lower() == "true"
 
+_WEEKDAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTH_NAMES = (None, "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+_rfc1123_cache = (None, None)
+
+def format_rfc1123_date():
+    '''Return the current time as an RFC 1123 date. The string is built by hand rather than
+       with time.strftime, whose day and month names follow the process locale, and is only
+       rebuilt once per second.'''
+    global _rfc1123_cache
+    now = int(time.time())
+    cached = _rfc1123_cache
+    if cached[0] == now: return cached[1]
+    t = time.gmtime(now)
+    value = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (_WEEKDAY_NAMES[t.tm_wday], t.tm_mday, _MONTH_NAMES[t.tm_mon], t.tm_year, t.tm_hour, t.tm_min, t.tm_sec)
+    _rfc1123_cache = (now, value)
+    return value
+
 class SharedKeyCredentials(object):
     def __init__(self, account_name, account_key, use_path_style_uris = None):
         self._account = account_name
         self._key = base64.decodestring(account_key)
+        # Keyed once; every signature works on a copy so the key schedule isn't redone.
+        self._hmac = hmac.new(self._key, digestmod=hashlib.sha256)
+
+    def sign_string(self, string_to_sign):
+        if isinstance(string_to_sign, unicode):
+            string_to_sign = string_to_sign.encode("utf-8")
+        mac = self._hmac.copy()
+        mac.update(string_to_sign)
+        return base64.b64encode(mac.digest())
 
     def _sign_request_impl(self, request, for_tables = False,  use_path_style_uris = None):
         (scheme, host, path, query, fragment) = urlsplit(request.get_full_url())
@@ -72,53 +293,88 @@ class SharedKeyCredentials(object):
 
         canonicalized_resource = "/" + self._account + path
 
-        if not for_tables:
+        if query and not for_tables:
             q = parse_qs(query)
-            if len(q.keys()) > 0:
-                canonicalized_resource +=''.join(["\n%s:%s" % (k, ','.join(sorted(q[k]))) for k in sorted(q.keys())])
-
-        if use_path_style_uris is None:
-            use_path_style_uris = re.match('^[\d.:]+$', host) is not None
+            canonicalized_resource += ''.join(["\n%s:%s" % (k, ','.join(sorted(q[k]))) for k in sorted(q.keys())])
 
-        request.add_header(PREFIX_STORAGE_HEADER + 'version', '2011-08-18')
-        locale.setlocale(locale.LC_ALL, "C") # dirty hack for locale changing
-        request.add_header(PREFIX_STORAGE_HEADER + 'date', time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())) #RFC 1123
+        headers = request.headers
+        date = format_rfc1123_date()
+        headers.setdefault('X-ms-version', '2011-08-18')
+        headers['X-ms-date'] = date
+        if for_tables:
+            headers['Date'] = date
+            headers.setdefault('Dataserviceversion', '1.0;NetFx')
+            headers.setdefault('Maxdataserviceversion', '1.0;NetFx')
+        if request.unredirected_hdrs:
+            headers = dict(request.unredirected_hdrs, **headers)
+        get = headers.get
 
         if for_tables:
-            request.add_header('Date', request.get_header((PREFIX_STORAGE_HEADER + 'date').capitalize()))
-            request.add_header('DataServiceVersion', '1.0;NetFx')
-            request.add_header('MaxDataServiceVersion', '1.0;NetFx')
-
-        canonicalized_headers = NEW_LINE.join(('%s:%s' % (k.lower(), request.get_header(k).strip()) for k in sorted(request.headers.keys(), lambda x,y: cmp(x.lower(), y.lower())) if k.lower().startswith(PREFIX_STORAGE_HEADER)))
-
-        string_to_sign = request.get_method().upper() + NEW_LINE # verb
-        if not for_tables:
-            string_to_sign += (request.get_header('Content-encoding') or '') + NEW_LINE
-            string_to_sign += (request.get_header('Content-language') or '') + NEW_LINE
-            string_to_sign += str(request.get_header('Content-length') or '') + NEW_LINE
-                
-        string_to_sign += (request.get_header('Content-md5') or '') + NEW_LINE
-        string_to_sign += (request.get_header('Content-type') or '') + NEW_LINE
-        string_to_sign += (request.get_header('Date') or '') + NEW_LINE
-        if not for_tables:
-            string_to_sign += (request.get_header('If-modified-since') or '') + NEW_LINE
-            string_to_sign += (request.get_header('If-match') or '') + NEW_LINE
-            string_to_sign += (request.get_header('If-none-match') or '') + NEW_LINE
-            string_to_sign += (request.get_header('If-unmodified-since') or '') + NEW_LINE
-            string_to_sign += (request.get_header('Range') or '') + NEW_LINE
-        if not for_tables:
-            string_to_sign += canonicalized_headers + NEW_LINE
-        string_to_sign += canonicalized_resource
-
-        request.add_header('Authorization', 'SharedKey ' + self._account + ':' + base64.encodestring(hmac.new(self._key, unicode(string_to_sign).encode("utf-8"), hashlib.sha256).digest()).strip())
+            string_to_sign = NEW_LINE.join((request.get_method().upper(),
+                                            get('Content-md5') or '',
+                                            get('Content-type') or '',
+                                            date,
+                                            canonicalized_resource))
+        else:
+            canonicalized_headers = sorted([(k.lower(), v.strip()) for k, v in headers.iteritems() if k[:5].lower() == PREFIX_STORAGE_HEADER])
+            content_length = str(get('Content-length') or '')
+            # From 2015-02-21 on, a zero Content-Length is signed as an empty string.
+            if content_length == '0' and get('X-ms-version') >= '2015-02-21': content_length = ''
+            string_to_sign = NEW_LINE.join([request.get_method().upper(),
+                                            get('Content-encoding') or '',
+                                            get('Content-language') or '',
+                                            content_length,
+                                            get('Content-md5') or '',
+                                            get('Content-type') or '',
+                                            get('Date') or '',
+                                            get('If-modified-since') or '',
+                                            get('If-match') or '',
+                                            get('If-none-match') or '',
+                                            get('If-unmodified-since') or '',
+                                            get('Range') or ''] +
+                                           ['%s:%s' % header for header in canonicalized_headers] +
+                                           [canonicalized_resource])
+
+        request.headers['Authorization'] = 'SharedKey ' + self._account + ':' + self.sign_string(string_to_sign)
         return request
 
     def sign_request(self, request, use_path_style_uris = None):
-        return self._sign_request_impl(request, use_path_style_uris)
+        return self._sign_request_impl(request, use_path_style_uris = use_path_style_uris)
 
     def sign_table_request(self, request, use_path_style_uris = None):
         return self._sign_request_impl(request, for_tables = True, use_path_style_uris = use_path_style_uris)
 
+def _set_full_url(request, url):
+    # urllib2.Request has no public way to change its URL once built.
+    request._Request__original = url
+    request.type = None
+    request.host = None
+    request.__dict__.pop('_Request__r_type', None)
+    request.__dict__.pop('_Request__r_host', None)
+
+class SharedAccessSignatureCredentials(object):
+    '''Credentials which authorize requests with a precomputed shared access signature, as
+       returned by generate_shared_access_signature, instead of signing every request with
+       the account key. The token is simply appended to each request URL.'''
+    def __init__(self, sas_token):
+        self._token = sas_token.lstrip("?")
+
+    def _sign_request_impl(self, request, for_tables = False):
+        url = request.get_full_url()
+        if "?" in url: url += "&" + self._token
+        else: url += "?" + self._token
+        _set_full_url(request, url)
+        if for_tables:
+            request.headers.setdefault('Dataserviceversion', '1.0;NetFx')
+            request.headers.setdefault('Maxdataserviceversion', '1.0;NetFx')
+        return request
+
+    def sign_request(self, request, use_path_style_uris = None):
+        return self._sign_request_impl(request)
+
+    def sign_table_request(self, request, use_path_style_uris = None):
+        return self._sign_request_impl(request, for_tables = True)
+
 class RequestWithMethod(Request):
     '''Subclass urllib2.Request to add the capability of using methods other than GET and POST.
        Thanks to http://benjamin.smedbergs.us/blog/2008-10-21/putting-and-deleteing-in-python-urllib2/'''
@@ -129,20 +385,636 @@ class RequestWithMethod(Request):
     def get_method(self):
         return self._method
 
+class PooledResponse(object):
+    '''File-like wrapper around an httplib.HTTPResponse which behaves like the object returned
+       by urllib2.urlopen (code, msg, info(), read()) and hands its connection back to the pool
+       once the body has been consumed.'''
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._buffer = None
+        self.code = response.status
+        self.msg = response.reason
+        self.url = url
+        self.headers = response.msg
+        if response.length is not None and response.length <= POOL_PRELOAD_LIMIT:
+            # Small bodies (most status-only replies) are read right away, so the
+            # connection is returned to the pool even if the caller never reads it.
+            self._buffer = StringIO(response.read())
+            self._release()
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt=None):
+        if self._buffer is not None:
+            if amt is None: return self._buffer.read()
+            return self._buffer.read(amt)
+        if self._response is None:
+            return ""
+        if amt is None: data = self._response.read()
+        else: data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._response is not None:
+            # The body was not read to the end, so the socket can't be reused.
+            self._conn.close()
+            self._response = None
+            self._conn = None
+
+    def _release(self):
+        if self._response.will_close:
+            self._conn.close()
+        else:
+            self._pool._put_connection(self._key, self._conn)
+        self._response = None
+        self._conn = None
+
+class ConnectionPool(object):
+    '''Thread-safe pool of keep-alive HTTP connections, keyed by (scheme, host).
+       At most max_idle_per_host idle connections are kept per host; connections idle for
+       longer than idle_timeout seconds are closed instead of being reused.'''
+    def __init__(self, max_idle_per_host = POOL_MAX_IDLE_PER_HOST, idle_timeout = POOL_IDLE_TIMEOUT, timeout = None):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, scheme, host):
+        if scheme == "https": conn_class = httplib.HTTPSConnection
+        else: conn_class = httplib.HTTPConnection
+        if self.timeout is None: return conn_class(host)
+        return conn_class(host, timeout=self.timeout)
+
+    def _get_connection(self, key):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_connection(*key), False
+
+    def _put_connection(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        '''Close every idle connection.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+    def urlopen(self, req):
+        '''Send a urllib2.Request over a pooled connection. Mirrors urllib2.urlopen: returns a
+           response object on success and raises urllib2.HTTPError for 4xx/5xx replies.'''
+        (scheme, host, path, query, fragment) = urlsplit(req.get_full_url())
+        key = (scheme, host)
+        selector = path or "/"
+        if query: selector += "?" + query
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        while True:
+            conn, reused = self._get_connection(key)
+            sent = False
+            try:
+                if not reused:
+                    # Connect up front so instrumentation can tell connect time apart.
+                    start = time.time()
+                    conn.connect()
+                    req.connect_time = time.time() - start
+                conn.request(req.get_method(), selector, req.get_data(), headers)
+                sent = True
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # A reused connection may have been closed by the server while idle;
+                # retry once on a fresh one. Errors on a fresh connection are real. Once
+                # the request is out it may have been processed, so only idempotent ones
+                # are sent again here; the retry policy decides about the others.
+                if not reused or (sent and req.get_method() not in IDEMPOTENT_METHODS): raise
+        result = PooledResponse(self, key, conn, response, req.get_full_url())
+        if result.code >= 400:
+            raise HTTPError(req.get_full_url(), result.code, result.msg, result.headers, StringIO(result.read()))
+        return result
+
+DEFAULT_CONNECTION_POOL = ConnectionPool()
+
+class CircuitOpenError(HTTPError):
+    '''Raised without sending the request while an account's circuit breaker is open. It is a
+       503 HTTPError, so callers returning e.code report it like server side throttling.'''
+    def __init__(self, url):
+        HTTPError.__init__(self, url, 503, "Circuit Breaker Open", {}, StringIO(""))
+
+class _AccountHealth(object):
+    def __init__(self, retry_budget):
+        self.lock = threading.Lock()
+        self.balance = float(retry_budget)
+        self.failures = 0
+        self.opened_at = None
+
+class RetryPolicy(object):
+    '''Retries transient failures (RETRY_STATUS_CODES and socket errors) with exponential
+       backoff and full jitter, honouring Retry-After. A request is given up after
+       max_attempts attempts or once max_elapsed seconds would be exceeded.
+
+       Only requests that are safe to repeat are retried: non-idempotent methods (POST)
+       are retried solely on 503, which Azure returns before processing the request, and on
+       refused connections. Request bodies must be strings so they can be sent again.
+
+       Retries are also limited per account: every request deposits retry_ratio into a
+       budget capped at retry_budget and every retry spends one, so a struggling service
+       sees at most about retry_ratio extra load. After failure_threshold requests in a row
+       fail, the account's circuit opens and requests fail fast with CircuitOpenError for
+       reset_timeout seconds, after which requests are let through again to probe it.'''
+    def __init__(self, max_attempts = RETRY_MAX_ATTEMPTS, backoff = RETRY_BACKOFF, max_backoff = RETRY_MAX_BACKOFF,
+                 max_elapsed = RETRY_MAX_ELAPSED, retry_ratio = 0.2, retry_budget = 10,
+                 failure_threshold = 20, reset_timeout = 30):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_elapsed = max_elapsed
+        self.retry_ratio = retry_ratio
+        self.retry_budget = retry_budget
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def _health(self, account):
+        with self._lock:
+            health = self._accounts.get(account)
+            if health is None:
+                health = self._accounts[account] = _AccountHealth(self.retry_budget)
+            return health
+
+    def is_transient(self, error):
+        if isinstance(error, CircuitOpenError): return False
+        if isinstance(error, HTTPError): return error.code in RETRY_STATUS_CODES
+        return isinstance(error, (URLError, httplib.HTTPException, socket.error))
+
+    def is_retryable(self, req, error):
+        '''Return True when the failed request may be sent again.'''
+        if not self.is_transient(error): return False
+        if not isinstance(req.get_data(), (types.NoneType, str)): return False
+        if req.get_method() in IDEMPOTENT_METHODS: return True
+        if isinstance(error, HTTPError): return error.code == 503
+        return isinstance(error, socket.error) and error.errno == errno.ECONNREFUSED
+
+    def get_delay(self, attempt, error):
+        '''Return the seconds to wait before retry number attempt (1 for the first retry).'''
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if isinstance(error, HTTPError):
+            try:
+                delay = max(delay, float(error.hdrs.get("Retry-After")))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    def urlopen(self, account, opener, req):
+        '''Send req with opener (a ConnectionPool.urlopen-like callable), retrying on behalf
+           of account according to this policy.'''
+        health = self._health(account)
+        with health.lock:
+            if health.opened_at is not None and time.time() - health.opened_at < self.reset_timeout:
+                raise CircuitOpenError(req.get_full_url())
+            health.balance = min(self.retry_budget, health.balance + self.retry_ratio)
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = opener(req)
+            except Exception, e:
+                if not self.is_transient(e):
+                    self._record(health, True)
+                    raise
+                delay = self.get_delay(attempt, e)
+                if (attempt >= self.max_attempts or not self.is_retryable(req, e)
+                        or time.time() - start + delay > self.max_elapsed or not self._spend(health)):
+                    self._record(health, False)
+                    raise
+                time.sleep(delay)
+                continue
+            self._record(health, True)
+            return response
+
+    def _spend(self, health):
+        with health.lock:
+            if health.balance < 1: return False
+            health.balance -= 1
+            return True
+
+    def _record(self, health, succeeded):
+        with health.lock:
+            if succeeded:
+                health.failures = 0
+                health.opened_at = None
+                return
+            health.failures += 1
+            if health.failures >= self.failure_threshold:
+                health.opened_at = time.time()
+
+NO_RETRY = RetryPolicy(max_attempts = 1, failure_threshold = sys.maxint)
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+class TokenBucket(object):
+    '''Token bucket admitting up to rate requests per second with bursts of burst requests.
+       The rate adapts AIMD style: throttled() halves it (at most once per second, so a
+       wave of 503s counts as one signal) and every succeeded() request adds increase / rate,
+       regaining about increase requests per second each second, up to max_rate.'''
+    def __init__(self, rate, burst = None, min_rate = 1.0, increase = 1.0, decrease = 0.5):
+        self.max_rate = self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = self._capacity()
+        self._updated = time.time()
+        self._throttled_at = 0
+        self._lock = threading.Lock()
+
+    def _capacity(self):
+        if self.burst is None: return max(1.0, self.rate / 10)
+        return self.burst
+
+    def reserve(self):
+        '''Take a token and return the seconds to wait before using it.'''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._capacity(), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0: return 0
+            return -self._tokens / self.rate
+
+    def throttled(self):
+        with self._lock:
+            now = time.time()
+            if now - self._throttled_at < 1: return
+            self._throttled_at = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+class RateLimiter(object):
+    '''Client side throttling shared by Storage instances. Every request takes a token from
+       its account's bucket (account_rate requests per second) and from its partition's
+       bucket: a blob, a queue or a table partition, at partition_rate or the service's
+       scalability target (BLOB_RATE_LIMIT, QUEUE_RATE_LIMIT, TABLE_RATE_LIMIT).
+
+       503 replies lower the partition's rate, or the account's when the server reports the
+       account limit was hit, and successes raise it back again. Idle partition buckets are
+       forgotten once more than max_buckets are tracked.'''
+    def __init__(self, account_rate = ACCOUNT_RATE_LIMIT, partition_rate = None, max_buckets = RATE_LIMIT_MAX_BUCKETS):
+        self.account_rate = account_rate
+        self.partition_rate = partition_rate
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, rate):
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(rate)
+                if len(self._buckets) >= self.max_buckets:
+                    self._buckets.popitem(last = False)
+            self._buckets[key] = bucket
+            return bucket
+
+    def acquire(self, account, partition, partition_rate):
+        '''Wait until a request to partition of account may be sent and return the
+           (account bucket, partition bucket) pair to report its outcome to.'''
+        account_bucket = self._bucket((account,), self.account_rate)
+        partition_bucket = self._bucket((account, partition), self.partition_rate or partition_rate)
+        delay = max(account_bucket.reserve(), partition_bucket.reserve())
+        if delay > 0: time.sleep(delay)
+        return account_bucket, partition_bucket
+
+    def report(self, buckets, error = None):
+        account_bucket, partition_bucket = buckets
+        if error is None:
+            account_bucket.succeeded()
+            partition_bucket.succeeded()
+        elif "account" in (error.msg or "").lower():
+            account_bucket.throttled()
+        else:
+            partition_bucket.throttled()
+
+class RequestEvent(object):
+    '''Timings and outcome of one attempt of a storage request, passed to the
+       instrumentation hook once the response body has been read to the end or closed,
+       straight away for replies with no body left to read, or on error.
+       Times are in seconds: sign_time is spent signing (first attempt only), wait_time in
+       the rate limiter, connect_time opening a new connection, server_time from sending
+       the request to receiving the response headers, and body_time reading and parsing
+       the body. attempt counts from 1, so any attempt above 1 is a retry.'''
+    __slots__ = ("operation", "method", "url", "attempt", "status", "request_id", "error",
+                 "bytes_out", "bytes_in", "start", "sign_time", "wait_time", "connect_time",
+                 "server_time", "body_time", "total_time")
+
+    def __init__(self, operation, req):
+        self.operation = operation
+        self.method = req.get_method()
+        self.url = req.get_full_url()
+        self.attempt = req.attempt = getattr(req, "attempt", 0) + 1
+        self.status = self.request_id = self.error = None
+        data = req.get_data()
+        self.bytes_out = len(data) if isinstance(data, str) else 0
+        self.bytes_in = 0
+        self.start = time.time()
+        self.sign_time = getattr(req, "sign_time", 0) if self.attempt == 1 else 0
+        self.wait_time = self.connect_time = self.server_time = self.body_time = 0
+        self.total_time = 0
+
+    def __repr__(self):
+        return "<RequestEvent %s %s %s %.1fms>" % (self.operation, self.method, self.status, self.total_time * 1000)
+
+class _TimedCredentials(object):
+    def __init__(self, credentials):
+        self._credentials = credentials
+
+    def __getattr__(self, name):
+        return getattr(self._credentials, name)
+
+    def sign_request(self, request, use_path_style_uris = None):
+        start = time.time()
+        result = self._credentials.sign_request(request, use_path_style_uris)
+        request.sign_time = time.time() - start
+        return result
+
+    def sign_table_request(self, request, use_path_style_uris = None):
+        start = time.time()
+        result = self._credentials.sign_table_request(request, use_path_style_uris)
+        request.sign_time = time.time() - start
+        return result
+
+class InstrumentedResponse(object):
+    '''Response wrapper counting the bytes read and reporting the event once the body has
+       been read to the end or the response closed.'''
+    def __init__(self, response, event, hook):
+        self._response = response
+        self._event = event
+        self._hook = hook
+        self._received = time.time()
+        self.code = response.code
+        self.msg = response.msg
+        self.headers = response.headers
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self._response.geturl()
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt = None):
+        data = self._response.read() if amt is None else self._response.read(amt)
+        if self._event is not None:
+            self._event.bytes_in += len(data)
+            if amt is None or len(data) < amt: self._finish()
+        return data
+
+    def close(self):
+        self._response.close()
+        self._finish()
+
+    def _finish(self):
+        event, self._event = self._event, None
+        if event is None: return
+        now = time.time()
+        event.body_time = now - self._received
+        event.total_time = event.sign_time + (now - event.start)
+        self._hook.on_request(event)
+
+class Histogram(object):
+    '''Histogram of positive values (seconds, bytes) with logarithmic buckets, each about
+       HISTOGRAM_PRECISION wide, so percentiles are exact to within that ratio.'''
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        index = int(math.log(max(value, HISTOGRAM_MIN_VALUE) / HISTOGRAM_MIN_VALUE, 1 + HISTOGRAM_PRECISION))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def percentile(self, p):
+        '''Return the upper bound of the bucket holding the p-th percentile (0 < p <= 100).'''
+        if not self.count: return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank: break
+        return min(self.max, HISTOGRAM_MIN_VALUE * (1 + HISTOGRAM_PRECISION) ** (index + 1))
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.total, "min": self.min, "max": self.max,
+                "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99)}
+
+class MetricsExporter(object):
+    '''Base of the exporters a MetricsCollector publishes its snapshots to. Subclasses
+       override export(); any other object with an export(snapshot) method works as well.'''
+    def export(self, snapshot):
+        '''Publish snapshot, as returned by MetricsCollector.snapshot(). Does nothing here.'''
+        pass
+
+class JsonLinesExporter(MetricsExporter):
+    '''Appends every snapshot to stream as one line of JSON.'''
+    def __init__(self, stream):
+        self._stream = stream
+
+    def export(self, snapshot):
+        self._stream.write(json.dumps({"time": time.time(), "operations": snapshot}, sort_keys = True) + "\n")
+        self._stream.flush()
+
+class MetricsCollector(object):
+    '''In-process instrumentation hook aggregating RequestEvents per operation: latency
+       histograms for every phase, request, retry and error counts, status codes and bytes
+       transferred. export() publishes a snapshot to every exporter.'''
+    PHASES = ("total", "sign", "wait", "connect", "server", "body")
+
+    def __init__(self, exporters = ()):
+        self.exporters = list(exporters)
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def on_request(self, event):
+        with self._lock:
+            stats = self._operations.get(event.operation)
+            if stats is None:
+                stats = self._operations[event.operation] = {
+                    "requests": 0, "retries": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0, "status": {},
+                    "latency": dict((phase, Histogram()) for phase in self.PHASES)}
+            stats["requests"] += 1
+            if event.attempt > 1: stats["retries"] += 1
+            if event.error is not None: stats["errors"] += 1
+            stats["bytes_in"] += event.bytes_in
+            stats["bytes_out"] += event.bytes_out
+            status = str(event.status)
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+            latency = stats["latency"]
+            latency["total"].add(event.total_time)
+            latency["sign"].add(event.sign_time)
+            latency["wait"].add(event.wait_time)
+            latency["connect"].add(event.connect_time)
+            latency["server"].add(event.server_time)
+            latency["body"].add(event.body_time)
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for operation, stats in self._operations.iteritems():
+                stats = dict(stats)
+                stats["status"] = dict(stats["status"])
+                stats["latency"] = dict((phase, histogram.to_dict()) for phase, histogram in stats["latency"].iteritems())
+                result[operation] = stats
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+    def export(self):
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter.export(snapshot)
+        return snapshot
+
 class Table(object):
     def __init__(self, url, name):
         self.url = url
         self.name = name
 
 class Storage(object):
-    def __init__(self, host, account_name, secret_key, use_path_style_uris):
+    '''Base of the storage clients. Requests go through connection_pool (the shared
+       DEFAULT_CONNECTION_POOL by default) and are retried according to retry_policy
+       (DEFAULT_RETRY_POLICY by default; pass NO_RETRY to disable retries). An optional
+       rate_limiter, usually shared by every client of a job, paces each attempt.
+
+       instrumentation is an optional hook, such as a MetricsCollector, whose
+       on_request(event) method receives a RequestEvent for every attempt. Without one the
+       request path is not timed at all.'''
+    PARTITION_RATE_LIMIT = BLOB_RATE_LIMIT
+
+    def __init__(self, host, account_name, secret_key, use_path_style_uris, connection_pool = None, credentials = None, retry_policy = None, rate_limiter = None, instrumentation = None):
         self._host = host
         self._account = account_name
         self._key = secret_key
         if use_path_style_uris is None:
             use_path_style_uris = re.match(r'^[^:]*[\d:]+$', self._host)
         self._use_path_style_uris = use_path_style_uris
-        self._credentials = SharedKeyCredentials(self._account, self._key)
+        if credentials is None:
+            credentials = SharedKeyCredentials(self._account, self._key)
+        self._credentials = credentials
+        if connection_pool is None:
+            connection_pool = DEFAULT_CONNECTION_POOL
+        self._connection_pool = connection_pool
+        if retry_policy is None:
+            retry_policy = DEFAULT_RETRY_POLICY
+        self._retry_policy = retry_policy
+        self._rate_limiter = rate_limiter
+        self._instrumentation = instrumentation
+        if instrumentation is not None:
+            self._credentials = _TimedCredentials(self._credentials)
+
+    def _urlopen(self, req, operation):
+        # operation names the public method sending req, for the instrumentation hook.
+        req.operation = operation
+        return self._retry_policy.urlopen(self._account, self._send, req)
+
+    def _send(self, req):
+        if self._instrumentation is not None:
+            return self._send_instrumented(req)
+        if self._rate_limiter is None:
+            return self._connection_pool.urlopen(req)
+        buckets = self._rate_limiter.acquire(self._account, self._get_partition(req), self.PARTITION_RATE_LIMIT)
+        try:
+            response = self._connection_pool.urlopen(req)
+        except HTTPError, e:
+            if e.code == 503: self._rate_limiter.report(buckets, e)
+            raise
+        self._rate_limiter.report(buckets)
+        return response
+
+    def _send_instrumented(self, req):
+        event = RequestEvent("%s.%s" % (type(self).__name__, req.operation), req)
+        req.connect_time = 0
+        buckets = None
+        if self._rate_limiter is not None:
+            buckets = self._rate_limiter.acquire(self._account, self._get_partition(req), self.PARTITION_RATE_LIMIT)
+            event.wait_time = time.time() - event.start
+        sent = time.time()
+        try:
+            response = self._connection_pool.urlopen(req)
+        except Exception, e:
+            now = time.time()
+            event.connect_time = req.connect_time
+            event.server_time = now - sent - event.connect_time
+            event.total_time = event.sign_time + (now - event.start)
+            event.error = e
+            if isinstance(e, HTTPError):
+                event.status = e.code
+                event.request_id = e.hdrs.get("x-ms-request-id")
+                if buckets is not None and e.code == 503: self._rate_limiter.report(buckets, e)
+            self._instrumentation.on_request(event)
+            raise
+        if buckets is not None: self._rate_limiter.report(buckets)
+        event.connect_time = req.connect_time
+        event.server_time = time.time() - sent - event.connect_time
+        event.status = response.code
+        event.request_id = response.headers.get("x-ms-request-id")
+        preloaded = getattr(response, "_buffer", None)
+        if preloaded is None and req.get_method() != "HEAD":
+            return InstrumentedResponse(response, event, self._instrumentation)
+        # Nothing left to read: small bodies were read along with the headers by the pool.
+        if preloaded is not None: event.bytes_in = len(preloaded.getvalue())
+        event.total_time = event.sign_time + (time.time() - event.start)
+        self._instrumentation.on_request(event)
+        return response
+
+    def _get_resource_path(self, req):
+        path = urlsplit(req.get_full_url())[2].lstrip("/")
+        if self._use_path_style_uris: path = path.partition("/")[2]
+        return path
+
+    def _get_partition(self, req):
+        '''Return the name of the partition req is served by, for rate limiting.'''
+        return self._get_resource_path(req)
 
     def get_base_url(self):
         if self._use_path_style_uris:
@@ -150,31 +1022,161 @@ class Storage(object):
         else:
             return "http://%s.%s" % (self._account, self._host)
 
+    def _make_shared_access_signature(self, resource, permission, expiry, start, identifier, query, extra_fields = ()):
+        '''Sign a SAS_VERSION shared access signature for the canonicalized resource and return
+           it as a query string. query holds the resource specific parameters (sr, tn, ...);
+           extra_fields are appended to the string to sign (table key ranges).'''
+        def format_time(value):
+            if value is None: return ""
+            if isinstance(value, datetime): return value.strftime(SAS_TIME_FORMAT)
+            return value
+        start, expiry = format_time(start), format_time(expiry)
+        string_to_sign = NEW_LINE.join((permission or "", start, expiry, resource, identifier or "", SAS_VERSION) + tuple(extra_fields))
+        fields = [("sv", SAS_VERSION)]
+        if start: fields.append(("st", start))
+        if expiry: fields.append(("se", expiry))
+        fields.extend(query)
+        if permission: fields.append(("sp", permission))
+        if identifier: fields.append(("si", identifier))
+        fields.append(("sig", self._credentials.sign_string(string_to_sign)))
+        return urlencode(fields)
+
 class TableEntityException(Exception):
     def __init__(self, value):
         self.value = value
     def __str__(self):
         return repr(self.value)
 
+def format_edm_datetime(value):
+    return value.isoformat()
+
+def format_edm_boolean(value):
+    if value: return "true"
+    return "false"
+
+# Python type -> (Edm type, formatter). Subclasses are resolved through their MRO on first use.
+PROPERTY_ENCODERS = {
+    bool: ("Edm.Boolean", format_edm_boolean),
+    datetime: ("Edm.DateTime", format_edm_datetime),
+    float: ("Edm.Double", repr),
+    long: ("Edm.Int64", str),
+    int: ("Edm.Int32", str),
+    str: ("Edm.String", escape),
+    unicode: ("Edm.String", escape),
+}
+
+# Lower-cased Edm type -> parser.
+PROPERTY_DECODERS = {
+    "edm.datetime": parse_edm_datetime,
+    "edm.int32": parse_edm_int32,
+    "edm.int64": parse_edm_int64,
+    "edm.boolean": parse_edm_boolean,
+    "edm.double": parse_edm_double,
+    "edm.string": lambda input: input,
+    "edm.guid": lambda input: input,
+    "edm.binary": base64.b64decode,
+}
+# Also register the spelling the service sends, so the common case needs no lower().
+for _name in ("Edm.DateTime", "Edm.Int32", "Edm.Int64", "Edm.Boolean", "Edm.Double", "Edm.String", "Edm.Guid", "Edm.Binary"):
+    PROPERTY_DECODERS[_name] = PROPERTY_DECODERS[_name.lower()]
+
+ENTITY_XML_TEMPLATE = """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
+<entry xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" xmlns="http://www.w3.org/2005/Atom">
+  <title />
+  <updated>%s</updated>
+  <author>
+    <name />
+  </author>
+  <id />
+  <content type="application/xml">
+    <m:properties>
+%s
+      <d:PartitionKey>%s</d:PartitionKey>
+      <d:RowKey>%s</d:RowKey>
+      <d:Timestamp m:type="Edm.DateTime">0001-01-01T00:00:00</d:Timestamp>
+    </m:properties>
+  </content>
+</entry>
+"""
+
+def _get_property_encoder(value):
+    value_type = type(value)
+    encoder = PROPERTY_ENCODERS.get(value_type)
+    if encoder is None:
+        for base in getattr(value_type, "__mro__", ()):
+            if base in PROPERTY_ENCODERS:
+                encoder = PROPERTY_ENCODERS[value_type] = PROPERTY_ENCODERS[base]
+                break
+        else:
+            raise TableEntityException("Unexpected property: %s" % (value,))
+    return encoder
+
+def _fits_int32(value):
+    return -2147483648 <= value <= 2147483647
+
+def make_property_node(name, value):
+    if value is None:
+        return '<d:%s m:null="true" />' % name
+    edm_type, format = _get_property_encoder(value)
+    # Python 2 ints are 64 bits wide: those which don't fit an Int32 are sent as Int64.
+    if edm_type == "Edm.Int32" and not _fits_int32(value): edm_type = "Edm.Int64"
+    return '<d:%s m:type="%s">%s</d:%s>' % (name, edm_type, format(value), name)
+
+def serialize_entity(partition_key, row_key, properties):
+    '''Return the Atom entry for an entity as UTF-8 encoded XML, with every value escaped.'''
+    contents = "\n".join([make_property_node(name, value) for name, value in properties.iteritems()])
+    xml = ENTITY_XML_TEMPLATE % (datetime.utcnow().isoformat() + "Z", contents, escape(partition_key), escape(row_key))
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    return xml
+
+def format_json_datetime(value):
+    if value.tzinfo is None: return value.isoformat() + "Z"
+    return value.isoformat()
+
+# Python type -> (Edm type annotation or None for native JSON types, converter).
+JSON_PROPERTY_ENCODERS = {
+    bool: (None, bool),
+    datetime: ("Edm.DateTime", format_json_datetime),
+    float: (None, float),
+    long: ("Edm.Int64", str),
+    int: (None, int),
+    str: (None, lambda value: value),
+    unicode: (None, lambda value: value),
+}
+
+def serialize_json_entity(partition_key, row_key, properties):
+    '''Return the JSON body for an entity; Int64 and DateTime values carry odata.type
+       annotations, as their JSON form is a string.'''
+    body = {"PartitionKey": partition_key, "RowKey": row_key}
+    for name, value in properties.iteritems():
+        if value is None:
+            body[name] = None
+            continue
+        encoder = JSON_PROPERTY_ENCODERS.get(type(value))
+        if encoder is None:
+            _get_property_encoder(value) # raises for unsupported types
+            for base in type(value).__mro__:
+                if base in JSON_PROPERTY_ENCODERS:
+                    encoder = JSON_PROPERTY_ENCODERS[type(value)] = JSON_PROPERTY_ENCODERS[base]
+                    break
+        edm_type, convert = encoder
+        if convert is int and not _fits_int32(value): edm_type, convert = JSON_PROPERTY_ENCODERS[long]
+        body[name] = convert(value)
+        if edm_type is not None: body[name + "@odata.type"] = edm_type
+    return json.dumps(body, separators = (",", ":"))
+
 class TableEntity(object):
     "Table Entity"
-    def __init__(self, partition_key="", row_key="", props={}):
+    def __init__(self, partition_key="", row_key="", props=None):
+        if props is None: props = {}
         self.partition_key = partition_key
         self.row_key = row_key
         self.properties = props
 
-#    class Binary(object):
-#        pass
-
-#    class Guid(object):
-#        pass
-
     class Boolean(int):
         def __str__(self):
-            if self:
-                return "true"
-            else:
-                return "false"
+            return format_edm_boolean(self)
 
     def __repr__(self):
         props = ",".join([ k + ":" + str(self.properties[k]) for k in self.properties])
@@ -184,104 +1186,113 @@ class TableEntity(object):
         self.properties[key] = value
 
     def to_insert_xml(self):
-        contents = [self._make_property_node(propname, self.properties[propname]) for propname in self.properties]
-        contents_str = "\n".join(contents)
-        now_str = datetime.utcnow().isoformat() + "Z"
-        xml = """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
-<entry xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" xmlns="http://www.w3.org/2005/Atom">
-  <title />
-  <author>
-    <name />
-  </author>
-  <id />
-  <content type="application/xml">
-    <m:properties>
-%(contents)s
-      <d:PartitionKey>%(partition_key)s</d:PartitionKey>
-      <d:RowKey>%(row_key)s</d:RowKey>
-      <d:Timestamp m:type="Edm.DateTime">0001-01-01T00:00:00</d:Timestamp>
-    </m:properties>
-  </content>
-</entry>
-""" % dict(contents=contents_str, now=now_str, partition_key=self.partition_key, row_key=self.row_key)
-        if isinstance(xml, unicode):
-            xml = xml.encode('utf-8')
-        return xml
+        return serialize_entity(self.partition_key, self.row_key, self.properties)
 
     def to_update_xml(self):
-        contents = [self._make_property_node(propname, self.properties[propname]) for propname in self.properties]
-        contents_str = "\n".join(contents)
-        now_str = datetime.utcnow().isoformat() + "Z"
-        xml = """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
-<entry xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" xmlns="http://www.w3.org/2005/Atom">
-  <title />
-  <updated>%(now)s</updated>
-  <author>
-    <name />
-  </author>
-  <id />
-  <content type="application/xml">
-    <m:properties>
-%(contents)s
-      <d:PartitionKey>%(partition_key)s</d:PartitionKey>
-      <d:RowKey>%(row_key)s</d:RowKey>
-      <d:Timestamp m:type="Edm.DateTime">0001-01-01T00:00:00</d:Timestamp>
-    </m:properties>
-  </content>
-</entry>
-""" % dict(contents=contents_str, now=now_str, partition_key=self.partition_key, row_key=self.row_key)
-        if isinstance(xml, unicode):
-            xml = xml.encode('utf-8')
-        return xml
-    
+        return serialize_entity(self.partition_key, self.row_key, self.properties)
+
     def _make_property_node(self, name, value):
-        type = ""
-        string_repr = ""
-#        if isinstance(value, TableEntity.Binary):
-#            type = "Edm.Binary"
-#            string_repr = str(TableEntity.Binary(value))
-        if isinstance(value, bool):
-            type = "Edm.Boolean"
-            string_repr = str(TableEntity.Boolean(value))
-        elif isinstance(value, datetime):
-            type = "Edm.DateTime"
-            string_repr = value.isoformat()
-        elif isinstance(value, float):
-            type = "Edm.Double"
-            string_repr = str(value)
-#        elif isinstance(value, TableEntity.Guid):
-#            type = "Edm.Guid"
-#            string_repr = str(TableEntity.Boolean(value))
-        elif isinstance(value, long):
-            type = "Edm.Int64"
-            string_repr = str(value)
-        elif isinstance(value, int):
-            type = "Edm.Int32"
-            string_repr = str(value)
-        elif isinstance(value, str):
-            type = "Edm.String"
-            string_repr = value
-        elif isinstance(value, unicode):
-            type = "Edm.String"
-            string_repr = value
-        if type is not "":
-            prop_element = """<d:%(name)s m:type="%(type)s">%(value)s</d:%(name)s>"""
-            return prop_element % dict(name=name, type=type, value=string_repr)
+        return make_property_node(name, value)
+
+PROPERTY_ENCODERS[TableEntity.Boolean] = PROPERTY_ENCODERS[bool]
+JSON_PROPERTY_ENCODERS[TableEntity.Boolean] = JSON_PROPERTY_ENCODERS[bool]
+
+_SYSTEM_PROPERTIES = ("PartitionKey", "RowKey", "Timestamp")
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_entity_record_classes = {}
+
+def _is_slot_name(name):
+    # Names the generated __init__ can assign to without clobbering the record's own API: Azure
+    # also allows keywords such as "from", and columns named partition_key, properties, _names...
+    return (bool(_IDENTIFIER.match(name)) and not name.startswith("_") and not keyword.iskeyword(name)
+            and name not in ("None", "True", "False") and not hasattr(TableEntityRecord, name))
+
+class TableEntityRecord(object):
+    '''Base of the compact entities returned by TableStorage queries. Each distinct set of
+       property names gets its own subclass with one __slots__ entry per property, so entities
+       carry no per-instance dict. Properties are read as attributes (entity.PartitionKey,
+       entity.Name, ...); partition_key, row_key and properties mirror TableEntity, so a record
+       can be passed back to insert_entity or update_entity. Properties whose names clash with
+       those attributes (or start with "_") are only reachable through properties.'''
+    __slots__ = ()
+    _names = ()
+
+    def _value(self, name, default = None):
+        return getattr(self, name, default)
+
+    @property
+    def partition_key(self):
+        return getattr(self, "PartitionKey", "")
+
+    @property
+    def row_key(self):
+        return getattr(self, "RowKey", "")
+
+    @property
+    def properties(self):
+        return dict((name, self._value(name)) for name in self._names if name not in _SYSTEM_PROPERTIES)
+
+    def __repr__(self):
+        props = ",".join([k + ":" + str(v) for k, v in self.properties.items()])
+        return ",".join((self.partition_key, self.row_key, props))
+
+    def to_insert_xml(self):
+        return serialize_entity(self.partition_key, self.row_key, self.properties)
+
+    def to_update_xml(self):
+        return serialize_entity(self.partition_key, self.row_key, self.properties)
+
+def entity_record_class(names):
+    '''Return the TableEntityRecord subclass for the tuple of property names, creating it on
+       first use. Instances are built with cls(values), values being in the order of names.'''
+    cls = _entity_record_classes.get(names)
+    if cls is not None: return cls
+    if all(_is_slot_name(name) for name in names) and len(set(names)) == len(names):
+        namespace = {}
+        if names:
+            exec "def __init__(self, values):\n    %s, = values\n" % ", ".join(["self." + name for name in names]) in namespace
         else:
-            raise TableEntityException("Unexpected property: %s" % (value,))
+            exec "def __init__(self, values):\n    pass\n" in namespace
+        attributes = dict(__slots__ = names, _names = names, __init__ = namespace["__init__"])
+    else:
+        # Names which can't be slots: keep the values in a dict, reached through __getattr__ so
+        # that the record's own attributes always win over a property of the same name.
+        def __init__(self, values):
+            self._values = dict(zip(names, values))
+        def __getattr__(self, name):
+            if name == "_values" or name not in self._values: raise AttributeError(name)
+            return self._values[name]
+        def _value(self, name, default = None):
+            return self._values.get(name, default)
+        attributes = dict(__slots__ = ("_values",), _names = names, __init__ = __init__, __getattr__ = __getattr__, _value = _value)
+    cls = type("TableEntityRecord_%d" % len(_entity_record_classes), (TableEntityRecord,), attributes)
+    if len(_entity_record_classes) < 1024:
+        _entity_record_classes[names] = cls
+    return cls
 
 class QueueMessage(): pass
 
 class QueueStorage(Storage):
-    def __init__(self, host = DEVSTORE_QUEUE_HOST, account_name = DEVSTORE_ACCOUNT, secret_key = DEVSTORE_SECRET_KEY, use_path_style_uris = None):
-        super(QueueStorage, self).__init__(host, account_name, secret_key, use_path_style_uris)
+    PARTITION_RATE_LIMIT = QUEUE_RATE_LIMIT
+
+    def __init__(self, host = DEVSTORE_QUEUE_HOST, account_name = DEVSTORE_ACCOUNT, secret_key = DEVSTORE_SECRET_KEY, use_path_style_uris = None, connection_pool = None, credentials = None, retry_policy = None, rate_limiter = None, instrumentation = None):
+        super(QueueStorage, self).__init__(host, account_name, secret_key, use_path_style_uris, connection_pool, credentials, retry_policy, rate_limiter, instrumentation)
+
+    def _get_partition(self, req):
+        return self._get_resource_path(req).partition("/")[0]
+
+    def generate_shared_access_signature(self, queue_name, permission = None, expiry = None, start = None, identifier = None):
+        '''Return a shared access signature query string for queue_name. permission is any
+           combination of "raup" (read, add, update, process); expiry and start are UTC
+           datetimes or ISO 8601 strings. Omit them when identifier names a stored access policy.'''
+        return self._make_shared_access_signature("/%s/%s" % (self._account, queue_name), permission, expiry, start, identifier, ())
 
     def create_queue(self, name):
         req = RequestWithMethod("PUT", "%s/%s" % (self.get_base_url(), name))
         req.add_header("Content-Length", "0")
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "create_queue")
             return response.code
         except URLError, e:
             return e.code
@@ -290,7 +1301,7 @@ class QueueStorage(Storage):
         req = RequestWithMethod("DELETE", "%s/%s" % (self.get_base_url(), name))
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "delete_queue")
             return response.code
         except URLError, e:
             return e.code
@@ -302,45 +1313,503 @@ class QueueStorage(Storage):
         req.add_header("Content-Length", len(data))
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "put_message")
             return response.code
         except URLError, e:
             return e.code
 
-    def get_message(self, queue_name):
-        req = Request("%s/%s/messages" % (self.get_base_url(), queue_name))
+    def _get_messages(self, queue_name, query, operation):
+        req = Request("%s/%s/messages?%s" % (self.get_base_url(), queue_name, urlencode(query)))
         self._credentials.sign_request(req)
-        response = urlopen(req)
-        dom = minidom.parseString(response.read())
-        messages = dom.getElementsByTagName("QueueMessage")
-        result = None
-        if len(messages) == 1:
-            message = messages[0]
+        response = self._urlopen(req, operation)
+        messages = []
+        for message in iter_elements(response, ("QueueMessage",)):
             result = QueueMessage()
-            result.id = message.getElementsByTagName("MessageId")[0].firstChild.data
-            result.pop_receipt = message.getElementsByTagName("PopReceipt")[0].firstChild.data
-            result.text = base64.decodestring(message.getElementsByTagName("MessageText")[0].firstChild.data)
-        return result
+            result.id = message.findtext("MessageId")
+            result.pop_receipt = message.findtext("PopReceipt")
+            result.dequeue_count = int(message.findtext("DequeueCount") or 0)
+            result.text = base64.decodestring(message.findtext("MessageText"))
+            messages.append(result)
+        return messages
+
+    def get_messages(self, queue_name, count = QUEUE_MAX_MESSAGES, visibility_timeout = None):
+        '''Dequeue up to count (at most 32) messages in a single request. The messages stay
+           invisible to other consumers for visibility_timeout seconds (30 by default), and
+           must be deleted with delete_message or delete_messages before then.'''
+        query = [("numofmessages", min(count, QUEUE_MAX_MESSAGES))]
+        if visibility_timeout is not None: query.append(("visibilitytimeout", visibility_timeout))
+        return self._get_messages(queue_name, query, "get_messages")
+
+    def peek_messages(self, queue_name, count = QUEUE_MAX_MESSAGES):
+        '''Return up to count (at most 32) messages from the front of the queue without
+           changing their visibility. Peeked messages have no pop_receipt.'''
+        return self._get_messages(queue_name, [("peekonly", "true"), ("numofmessages", min(count, QUEUE_MAX_MESSAGES))], "peek_messages")
+
+    def get_message(self, queue_name):
+        messages = self.get_messages(queue_name, 1)
+        if len(messages) == 1:
+            return messages[0]
+        return None
+
+    def update_message(self, queue_name, message, visibility_timeout, text = None):
+        '''Make message invisible for visibility_timeout more seconds from now, e.g. to keep a
+           long job's message from being handed out again, optionally replacing its text. On
+           success message.pop_receipt is updated for subsequent updates or the final delete.'''
+        if text is None: text = message.text
+        data = "<QueueMessage><MessageText>%s</MessageText></QueueMessage>" % base64.encodestring(text)
+        query = urlencode([("popreceipt", message.pop_receipt), ("visibilitytimeout", visibility_timeout)])
+        req = RequestWithMethod("PUT", "%s/%s/messages/%s?%s" % (self.get_base_url(), queue_name, message.id, query), data=data)
+        req.add_header("Content-Type", "application/xml")
+        req.add_header("Content-Length", "%d" % len(data))
+        self._credentials.sign_request(req)
+        try:
+            response = self._urlopen(req, "update_message")
+        except URLError, e:
+            return e.code
+        message.pop_receipt = response.info().get("x-ms-popreceipt", message.pop_receipt)
+        message.text = text
+        return response.code
 
     def delete_message(self, queue_name, message):
         id = message.id
         pop_receipt = message.pop_receipt
-        req = RequestWithMethod("DELETE", "%s/%s/messages/%s?popreceipt=%s" % (self.get_base_url(), queue_name, id, pop_receipt))
+        req = RequestWithMethod("DELETE", "%s/%s/messages/%s?%s" % (self.get_base_url(), queue_name, id, urlencode({"popreceipt": pop_receipt})))
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "delete_message")
             return response.code
         except URLError, e:
             return e.code
 
+    def delete_messages(self, queue_name, messages, max_workers = DEFAULT_WORKERS):
+        '''Delete every message of messages using max_workers concurrent requests. Returns the
+           status codes in the order of messages.'''
+        messages = list(messages)
+        codes = {}
+        for message, code, error in parallel_imap(lambda message: self.delete_message(queue_name, message), messages, max_workers):
+            if error is not None: raise error
+            codes[id(message)] = code
+        return [codes[id(message)] for message in messages]
+
+class QueueConsumer(object):
+    '''Process the messages of a queue with a pool of threads.
+
+       Fetcher threads dequeue messages in batches of up to batch_size into a local buffer of
+       buffer_size messages, backing off exponentially from min_poll_interval to
+       max_poll_interval while the queue is empty. Worker threads call handler(message) for
+       each buffered message and delete it when the handler returns; if the handler raises,
+       the message is left alone and reappears once its visibility timeout expires. While a
+       message is buffered or being handled its visibility is renewed, so slow handlers don't
+       cause it to be handed out twice. Failed requests (fetches, deletes and renewals) are
+       counted as errors and the threads carry on. stats() returns throughput and latency
+       counters.'''
+    def __init__(self, queue_storage, queue_name, handler, workers = DEFAULT_WORKERS, fetchers = 1,
+                 batch_size = QUEUE_MAX_MESSAGES, buffer_size = 2 * QUEUE_MAX_MESSAGES, visibility_timeout = 30,
+                 min_poll_interval = 0.1, max_poll_interval = 30):
+        self.queue_storage = queue_storage
+        self.queue_name = queue_name
+        self.handler = handler
+        self.workers = workers
+        self.fetchers = fetchers
+        self.batch_size = min(batch_size, QUEUE_MAX_MESSAGES)
+        self.visibility_timeout = visibility_timeout
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._buffer = Queue.Queue(buffer_size)
+        self._held = {} # message id -> [message, lock, visible until]
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._counters = dict(received=0, processed=0, failed=0, renewed=0, empty_polls=0, errors=0, handler_time=0.0, max_handler_time=0.0, queue_time=0.0)
+        self._started = None
+
+    def _count(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self._counters[key] += value
+
+    def _fetch(self):
+        interval = self.min_poll_interval
+        while not self._stopping.is_set():
+            free = self._buffer.maxsize - self._buffer.qsize()
+            if free <= 0:
+                self._stopping.wait(self.min_poll_interval)
+                continue
+            try:
+                messages = self.queue_storage.get_messages(self.queue_name, min(free, self.batch_size), self.visibility_timeout)
+            except (URLError, httplib.HTTPException, socket.error):
+                messages = None
+                self._count(errors=1)
+            if not messages:
+                if messages is not None: self._count(empty_polls=1)
+                self._stopping.wait(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+                continue
+            interval = self.min_poll_interval
+            now = time.time()
+            with self._lock:
+                for message in messages:
+                    self._held[message.id] = [message, threading.Lock(), now + self.visibility_timeout]
+                self._counters["received"] += len(messages)
+            for message in messages:
+                self._buffer.put((message, now))
+
+    def _release(self, message, delete):
+        with self._lock:
+            entry = self._held.pop(message.id, None)
+        if entry is not None and delete:
+            with entry[1]:
+                # Any exception escaping would end the worker thread; an undeleted message
+                # just comes back once its visibility timeout expires.
+                try:
+                    code = self.queue_storage.delete_message(self.queue_name, message)
+                except Exception:
+                    code = None
+            if code is None or code >= 300: self._count(errors=1)
+
+    def _work(self):
+        while True:
+            try:
+                message, received = self._buffer.get(timeout=self.min_poll_interval)
+            except Queue.Empty:
+                if self._stopping.is_set(): return
+                continue
+            if self._stopping.is_set():
+                # Not handled; it becomes visible again once its timeout expires.
+                self._release(message, False)
+                continue
+            started = time.time()
+            try:
+                self.handler(message)
+                succeeded = True
+            except Exception:
+                succeeded = False
+            elapsed = time.time() - started
+            self._release(message, succeeded)
+            with self._lock:
+                self._counters[succeeded and "processed" or "failed"] += 1
+                self._counters["handler_time"] += elapsed
+                self._counters["queue_time"] += started - received
+                self._counters["max_handler_time"] = max(self._counters["max_handler_time"], elapsed)
+
+    def _renew(self):
+        # Renew when a third of the visibility timeout is left.
+        margin = self.visibility_timeout / 3.0
+        while not self._stopping.wait(min(1.0, margin / 2)):
+            now = time.time()
+            with self._lock:
+                due = [entry for entry in self._held.values() if entry[2] - now < margin]
+            for entry in due:
+                message, lock = entry[0], entry[1]
+                with lock:
+                    with self._lock:
+                        if message.id not in self._held: continue
+                    try:
+                        code = self.queue_storage.update_message(self.queue_name, message, self.visibility_timeout)
+                    except Exception:
+                        code = None
+                    if code == 204:
+                        entry[2] = time.time() + self.visibility_timeout
+                        self._count(renewed=1)
+                    else:
+                        self._count(errors=1)
+
+    def start(self):
+        '''Start the fetcher, worker and renewal threads and return immediately.'''
+        self._stopping.clear()
+        self._started = time.time()
+        targets = [self._fetch] * self.fetchers + [self._work] * self.workers + [self._renew]
+        self._threads = [threading.Thread(target=target) for target in targets]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, wait = True):
+        '''Stop fetching; messages being handled are finished and deleted, buffered ones are
+           abandoned to their visibility timeout. With wait, block until every thread exits.'''
+        self._stopping.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def run(self):
+        '''Consume messages in the calling thread until stop() is called or a KeyboardInterrupt.'''
+        self.start()
+        try:
+            while not self._stopping.wait(1): pass
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stats(self):
+        '''Return the counters, plus messages handled per second since start and the mean
+           handler and buffer latencies, in seconds.'''
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = len(self._held)
+        handled = stats["processed"] + stats["failed"]
+        elapsed = self._started is not None and time.time() - self._started or 0
+        stats["throughput"] = elapsed and handled / elapsed or 0.0
+        stats["mean_handler_time"] = handled and stats["handler_time"] / handled or 0.0
+        stats["mean_queue_time"] = handled and stats["queue_time"] / handled or 0.0
+        return stats
+
+def _format_odata_string(value):
+    if isinstance(value, unicode): value = value.encode("utf-8")
+    return value.replace("'", "''")
+
+def _format_odata_datetime(value):
+    if value.tzinfo is not None: value = (value - value.utcoffset()).replace(tzinfo = None)
+    return value.isoformat() + "Z"
+
+# Literal kind -> (template of the literal, formatter of the value put into it).
+ODATA_LITERALS = {
+    "boolean": ("%s", format_edm_boolean),
+    "datetime": ("datetime'%s'", _format_odata_datetime),
+    "double": ("%s", repr),
+    "guid": ("guid'%s'", str),
+    "int32": ("%s", str),
+    "int64": ("%sL", str),
+    "string": ("'%s'", _format_odata_string),
+}
+
+# Python type -> literal kind. Subclasses are resolved through their MRO on first use.
+ODATA_LITERAL_KINDS = {
+    bool: "boolean",
+    datetime: "datetime",
+    float: "double",
+    uuid.UUID: "guid",
+    int: "int32",
+    long: "int64",
+    str: "string",
+    unicode: "string",
+}
+
+def _get_literal_kind(value):
+    value_type = type(value)
+    kind = ODATA_LITERAL_KINDS.get(value_type)
+    if kind is None:
+        for base in getattr(value_type, "__mro__", ()):
+            if base in ODATA_LITERAL_KINDS:
+                kind = ODATA_LITERAL_KINDS[value_type] = ODATA_LITERAL_KINDS[base]
+                break
+        else:
+            raise TableEntityException("Can't compare a property with %r" % (value,))
+    # As when entities are written, ints only become Int64 when they don't fit an Int32.
+    if kind == "int32" and not _fits_int32(value): kind = "int64"
+    return kind
+
+_filter_templates = {}
+
+def _build_filter_template(shape, converters):
+    if shape[0] == "cmp":
+        name, operator, kind = shape[1:]
+        literal, converter = ODATA_LITERALS[kind]
+        converters.append(converter)
+        return "%s %s %s" % (name, operator, literal)
+    if shape[0] == "not":
+        return "not (%s)" % _build_filter_template(shape[1], converters)
+    operands = []
+    for operand in shape[1:]:
+        text = _build_filter_template(operand, converters)
+        # An and within an or (or the reverse) keeps its parentheses, so precedence never matters.
+        if operand[0] in ("and", "or"): text = "(%s)" % text
+        operands.append(text)
+    return (" %s " % shape[0]).join(operands)
+
+class Filter(object):
+    '''An OData $filter built from Property comparisons and combined with & (and), | (or)
+       and ~ (not), to be passed wherever TableStorage takes a filter:
+
+           (Property("PartitionKey") == "users") & (Property("Age") >= 18)
+
+       The values are kept apart from the shape of the expression (its properties, operators
+       and value types). compile() turns the shape into a template once, cached for every
+       filter of the same shape, and formats the values into it as typed OData literals,
+       quotes escaped, so no value can change the meaning of the query.'''
+    __slots__ = ("shape", "values")
+
+    def __init__(self, shape, values):
+        self.shape = shape
+        self.values = values
+
+    def _combine(self, operator, other):
+        # a & b & c is one "and" of three operands, rather than nested pairs.
+        operands = ()
+        for shape in (self.shape, other.shape):
+            if shape[0] == operator: operands += shape[1:]
+            else: operands += (shape,)
+        return Filter((operator,) + operands, self.values + other.values)
+
+    def __and__(self, other):
+        return self._combine("and", other)
+
+    def __or__(self, other):
+        return self._combine("or", other)
+
+    def __invert__(self):
+        return Filter(("not", self.shape), self.values)
+
+    def __nonzero__(self):
+        # Catches "a and b" and chained comparisons, which would silently drop a condition.
+        raise TypeError("Filters are combined with &, | and ~, not and, or and not")
+
+    def compile(self):
+        compiled = _filter_templates.get(self.shape)
+        if compiled is None:
+            converters = []
+            compiled = _build_filter_template(self.shape, converters), converters
+            if len(_filter_templates) < 1024:
+                _filter_templates[self.shape] = compiled
+        template, converters = compiled
+        return template % tuple([convert(value) for convert, value in zip(converters, self.values)])
+
+    def __str__(self):
+        return self.compile()
+
+    def __repr__(self):
+        return "Filter(%r)" % self.compile()
+
+class Property(object):
+    '''A table property to compare with a value, giving a Filter: Property("Age") >= 18.
+       Values may be str, unicode, bool, int, long, float, datetime or uuid.UUID. The name
+       must be an identifier.'''
+    __slots__ = ("name",)
+    __hash__ = None
+
+    def __init__(self, name):
+        if not _IDENTIFIER.match(name): raise TableEntityException("Invalid property name: %r" % (name,))
+        self.name = name
+
+    def _compare(self, operator, value):
+        return Filter(("cmp", self.name, operator, _get_literal_kind(value)), (value,))
+
+    def __eq__(self, value): return self._compare("eq", value)
+    def __ne__(self, value): return self._compare("ne", value)
+    def __lt__(self, value): return self._compare("lt", value)
+    def __le__(self, value): return self._compare("le", value)
+    def __gt__(self, value): return self._compare("gt", value)
+    def __ge__(self, value): return self._compare("ge", value)
+
+def _filter_text(filter):
+    if isinstance(filter, Filter): return filter.compile()
+    return filter
+
+def _check_select(select):
+    for name in select:
+        if not _IDENTIFIER.match(name): raise TableEntityException("Invalid property name: %r" % (name,))
+
+def _entity_path(table_name, partition_key, row_key):
+    '''Return the path of an entity. The keys are written as OData string literals, quotes
+       doubled, and URL encoded.'''
+    path = "%s(PartitionKey='%s',RowKey='%s')" % (table_name, quote(_format_odata_string(partition_key), ""), quote(_format_odata_string(row_key), ""))
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return path
+
+class TableBatch(object):
+    '''Operations on entities of a single partition of a table, to be committed atomically as
+       one Entity Group Transaction with TableStorage.commit_batch. A batch holds at most
+       BATCH_MAX_OPERATIONS operations and BATCH_MAX_SIZE bytes of payload.'''
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.partition_key = None
+        self.operations = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.operations)
+
+    def _add(self, method, partition_key, row_key, data, headers):
+        if self.partition_key is None:
+            self.partition_key = partition_key
+        elif self.partition_key != partition_key:
+            raise TableEntityException("All operations of a batch must use PartitionKey '%s'" % (self.partition_key,))
+        if len(self.operations) >= BATCH_MAX_OPERATIONS or self.size + len(data) > BATCH_MAX_SIZE:
+            raise TableEntityException("A batch holds at most %d operations and %d bytes" % (BATCH_MAX_OPERATIONS, BATCH_MAX_SIZE))
+        if method == "POST": path = self.table_name
+        else: path = _entity_path(self.table_name, partition_key, row_key)
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        self.operations.append((method, path, data, headers))
+        self.size += len(data)
+
+    def insert_entity(self, entity):
+        self._add("POST", entity.partition_key, entity.row_key, entity.to_insert_xml(), {})
+
+    def update_entity(self, partition_key, row_key, entity, condition="*"):
+        self._add("PUT", partition_key, row_key, entity.to_update_xml(), {"If-Match": condition})
+
+    def merge_entity(self, partition_key, row_key, entity, condition="*"):
+        self._add("MERGE", partition_key, row_key, entity.to_update_xml(), {"If-Match": condition})
+
+    def delete_entity(self, partition_key, row_key, condition="*"):
+        self._add("DELETE", partition_key, row_key, "", {"If-Match": condition})
+
+_PARTITION_KEY_IN_PATH = re.compile(r"^([^(/]*)\(PartitionKey='([^']*)'")
+
 class TableStorage(Storage):
     '''Due to local development storage not supporting SharedKey authentication, this class
-       will only work against cloud storage.'''
-    def __init__(self, host, account_name, secret_key, use_path_style_uris = None):
-        super(TableStorage, self).__init__(host, account_name, secret_key, use_path_style_uris)
+       will only work against cloud storage.
+
+       payload_format selects the wire format: PAYLOAD_ATOM (AtomPub XML, the default),
+       or the much smaller JSON formats PAYLOAD_NO_METADATA and PAYLOAD_MINIMAL_METADATA.
+       With no metadata, Int64 and DateTime properties of queried entities come back as
+       strings since the type information isn't sent.'''
+    PARTITION_RATE_LIMIT = TABLE_RATE_LIMIT
+
+    def __init__(self, host, account_name, secret_key, use_path_style_uris = None, connection_pool = None, credentials = None, payload_format = PAYLOAD_ATOM, retry_policy = None, rate_limiter = None, instrumentation = None):
+        super(TableStorage, self).__init__(host, account_name, secret_key, use_path_style_uris, connection_pool, credentials, retry_policy, rate_limiter, instrumentation)
+        self._payload_format = payload_format
+        self._json = payload_format != PAYLOAD_ATOM
+
+    def _get_partition(self, req):
+        # Inserts and batches carry their partition key in the body only; they are paced
+        # per table.
+        path = self._get_resource_path(req)
+        match = _PARTITION_KEY_IN_PATH.match(path)
+        if match: return match.groups()
+        return path.partition("(")[0]
+
+    def _sign_table_request(self, req):
+        if self._json:
+            req.add_header("Accept", "application/json;odata=%s" % self._payload_format)
+            req.add_header(PREFIX_STORAGE_HEADER + "version", JSON_VERSION)
+            req.add_header("DataServiceVersion", "3.0;NetFx")
+            req.add_header("MaxDataServiceVersion", "3.0;NetFx")
+        return self._credentials.sign_table_request(req)
+
+    def _serialize_entity(self, entity):
+        if self._json:
+            return serialize_json_entity(entity.partition_key, entity.row_key, entity.properties), "application/json"
+        return entity.to_update_xml(), "application/atom+xml"
+
+    def generate_shared_access_signature(self, table_name, permission = None, expiry = None, start = None, identifier = None,
+                                         start_partition_key = None, start_row_key = None, end_partition_key = None, end_row_key = None):
+        '''Return a shared access signature query string for table_name, optionally limited to a
+           range of keys. permission is any combination of "raud" (query, add, update, delete);
+           expiry and start are UTC datetimes or ISO 8601 strings.'''
+        keys = (("spk", start_partition_key), ("srk", start_row_key), ("epk", end_partition_key), ("erk", end_row_key))
+        query = [("tn", table_name)] + [(k, v) for k, v in keys if v is not None]
+        return self._make_shared_access_signature("/%s/%s" % (self._account, table_name.lower()), permission, expiry, start, identifier, query, [v or "" for k, v in keys])
 
     def create_table(self, name):
-        data = """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
+        if self._json:
+            data, content_type = json.dumps({"TableName": name}), "application/json"
+        else:
+            data, content_type = self._table_xml(name), "application/atom+xml"
+        req = RequestWithMethod("POST", "%s/Tables" % self.get_base_url(), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        req.add_header("Content-Type", content_type)
+        self._sign_table_request(req)
+        try:
+            response = self._urlopen(req, "create_table")
+            return response.code
+        except URLError, e:
+            return e.code
+
+    def _table_xml(self, name):
+        return """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
 <entry xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" xmlns="http://www.w3.org/2005/Atom">
   <title />
   <updated>%s</updated>
@@ -353,174 +1822,556 @@ class TableStorage(Storage):
       <d:TableName>%s</d:TableName>
     </m:properties>
   </content>
-</entry>""" % (time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()), name)
-        req = RequestWithMethod("POST", "%s/Tables" % self.get_base_url(), data=data)
-        req.add_header("Content-Length", "%d" % len(data))
-        req.add_header("Content-Type", "application/atom+xml")
-        self._credentials.sign_table_request(req)
-        try:
-            response = urlopen(req)
-            return response.code
-        except URLError, e:
-            return e.code
+</entry>""" % (time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()), escape(name))
 
     def delete_table(self, name):
         req = RequestWithMethod("DELETE", "%s/Tables('%s')" % (self.get_base_url(), name))
-        self._credentials.sign_table_request(req)
+        self._sign_table_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "delete_table")
             return response.code
         except URLError, e:
             return e.code
 
     def list_tables(self):
         req = Request("%s/Tables" % self.get_base_url())
-        self._credentials.sign_table_request(req)
-        response = urlopen(req)
-
-        dom = minidom.parseString(response.read())
-        
-        entries = dom.getElementsByTagName("entry")
-        for entry in entries:
-            table_url = entry.getElementsByTagName("id")[0].firstChild.data
-            table_name = entry.getElementsByTagName("content")[0].getElementsByTagName("m:properties")[0].getElementsByTagName("d:TableName")[0].firstChild.data
+        self._sign_table_request(req)
+        response = self._urlopen(req, "list_tables")
+
+        if self._json:
+            for table in json.load(response)["value"]:
+                name = table["TableName"].encode("utf-8")
+                yield Table("%s/Tables('%s')" % (self.get_base_url(), name), name)
+            return
+        for entry in iter_elements(response, (ATOM_NAMESPACE + "entry",)):
+            table_url = entry.findtext(ATOM_NAMESPACE + "id")
+            table_name = entry.findtext("%scontent/%sproperties/%sTableName" % (ATOM_NAMESPACE, METADATA_NAMESPACE, DATASERVICES_NAMESPACE))
             yield Table(table_url, table_name)
-        dom.unlink()
 
-    def get_entity(self, table_name, partition_key, row_key):
-        dom = minidom.parseString(urlopen(self._credentials.sign_table_request(Request("%s/%s(PartitionKey='%s',RowKey='%s')" % (self.get_base_url(), table_name, partition_key, row_key)))).read())
-        entity = self._parse_entity(dom.getElementsByTagName("entry")[0])
-        dom.unlink()
-        return entity
+    def get_entity(self, table_name, partition_key, row_key, select = None):
+        '''Return one entity, or with select (a list of property names) only those properties.'''
+        url = "%s/%s" % (self.get_base_url(), _entity_path(table_name, partition_key, row_key))
+        if select is not None:
+            _check_select(select)
+            url += "?$select=%s" % quote(",".join(select))
+        response = self._urlopen(self._sign_table_request(Request(url)), "get_entity")
+        return self._iter_entities(response).next()
 
     def _parse_entity(self, entry):
-        entity = TableEntity()
-        for property in (p for p in entry.getElementsByTagName("m:properties")[0].childNodes if p.nodeType == minidom.Node.ELEMENT_NODE):
-            key = property.tagName[2:]
-            if property.hasAttribute('m:type'):
-                t = property.getAttribute('m:type')
-                if t.lower() == 'edm.datetime': value = parse_edm_datetime(property.firstChild.data)
-                elif t.lower() == 'edm.int32': value = parse_edm_int32(property.firstChild.data)
-                elif t.lower() == 'edm.int64': value = parse_edm_int64(property.firstChild.data)
-                elif t.lower() == 'edm.boolean': value = parse_edm_boolean(property.firstChild.data)
-                elif t.lower() == 'edm.double': value = parse_edm_double(property.firstChild.data)
-                else: raise Exception(t.lower())
-            else: value = property.firstChild is not None and property.firstChild.data or None
-            setattr(entity, key, value)
-        return entity
+        names, values = [], []
+        decoders = PROPERTY_DECODERS
+        type_attribute = METADATA_NAMESPACE + 'type'
+        for property in entry.find("%scontent/%sproperties" % (ATOM_NAMESPACE, METADATA_NAMESPACE)):
+            tag = property.tag
+            names.append(tag[tag.find('}') + 1:])
+            value = property.text
+            t = property.get(type_attribute)
+            if t is not None and value is not None:
+                decoder = decoders.get(t)
+                if decoder is None: decoder = decoders.get(t.lower())
+                if decoder is None: raise Exception(t.lower())
+                value = decoder(value)
+            values.append(value)
+        return entity_record_class(tuple(names))(values)
+
+    def _parse_json_entity(self, obj):
+        names, values = [], []
+        for name, value in obj.iteritems():
+            if "@" in name or name.startswith("odata."): continue
+            edm_type = obj.get(name + "@odata.type")
+            # Timestamp is never annotated, its type being implied by the schema.
+            if name == "Timestamp": edm_type = "Edm.DateTime"
+            if edm_type is not None and value is not None:
+                decoder = PROPERTY_DECODERS.get(edm_type)
+                if decoder is not None: value = decoder(value)
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            names.append(str(name))
+            values.append(value)
+        return entity_record_class(tuple(names))(values)
+
+    def _iter_entities(self, response):
+        '''Yield the entities of an Atom feed (or single entry) response as they are parsed.'''
+        if self._json:
+            body = json.load(response)
+            for obj in body.get("value", [body]):
+                yield self._parse_json_entity(obj)
+            return
+        for entry in iter_elements(response, (ATOM_NAMESPACE + "entry",)):
+            yield self._parse_entity(entry)
+
+    def _open_query(self, table_name, filter, select, top, continuation):
+        query = []
+        if filter is not None: query.append("$filter=%s" % quote(_filter_text(filter)))
+        if select is not None:
+            _check_select(select)
+            query.append("$select=%s" % quote(",".join(select)))
+        if top is not None: query.append("$top=%d" % top)
+        if continuation is not None:
+            query.append("NextPartitionKey=%s" % quote(continuation[0]))
+            if continuation[1] is not None: query.append("NextRowKey=%s" % quote(continuation[1]))
+        url = "%s/%s()" % (self.get_base_url(), table_name)
+        if query: url += "?" + "&".join(query)
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return self._urlopen(self._sign_table_request(Request(url)), "iter_entities")
+
+    def _get_continuation(self, response):
+        headers = response.info()
+        next_partition_key = headers.get("x-ms-continuation-nextpartitionkey")
+        if next_partition_key is None: return None
+        return (next_partition_key, headers.get("x-ms-continuation-nextrowkey"))
+
+    def iter_entities(self, table_name, filter = None, select = None, top = None, prefetch = False):
+        '''Yield the entities of table_name matching filter (a Filter or OData text), following
+           continuation tokens until the whole result set (or top entities) has been returned.
+           select is a list of property names to fetch instead of whole entities. Entities are parsed and
+           yielded as each page streams in. With prefetch, the next page is downloaded by a
+           background thread while the current one is being consumed, so at most one extra
+           page is held in memory.'''
+        def page_size(returned):
+            if top is None: return None
+            return min(top - returned, QUERY_PAGE_SIZE)
+
+        def fetch(continuation, returned, holder):
+            try:
+                response = self._open_query(table_name, filter, select, page_size(returned), continuation)
+                holder.append((self._get_continuation(response), StringIO(response.read())))
+            except Exception, e:
+                holder.append(e)
+
+        returned = 0
+        response = self._open_query(table_name, filter, select, page_size(returned), None)
+        continuation = self._get_continuation(response)
+        while True:
+            if prefetch and continuation is not None:
+                # The page size is based on what has been returned so far, so it may
+                # over-fetch when top is set; the surplus is never yielded.
+                holder = []
+                fetcher = threading.Thread(target=fetch, args=(continuation, returned, holder))
+                fetcher.daemon = True
+                fetcher.start()
+            for entity in self._iter_entities(response):
+                yield entity
+                returned += 1
+                if top is not None and returned >= top: return
+            if continuation is None: return
+            if prefetch:
+                fetcher.join()
+                if isinstance(holder[0], Exception): raise holder[0]
+                continuation, response = holder[0]
+            else:
+                response = self._open_query(table_name, filter, select, page_size(returned), continuation)
+                continuation = self._get_continuation(response)
 
     def get_all(self, table_name):
-        dom = minidom.parseString(urlopen(self._credentials.sign_table_request(Request("%s/%s" % (self.get_base_url(), table_name)))).read())
-        entries = dom.getElementsByTagName("entry")
-        entities = []
-        for entry in entries:
-            entities.append(self._parse_entity(entry))
-        dom.unlink()
-        return entities
+        return list(self.iter_entities(table_name))
 
     def insert_entity(self, table_name, entity):
-        data = entity.to_insert_xml()
+        data, content_type = self._serialize_entity(entity)
         url = "%s/%s" % (self.get_base_url(), table_name)
         req = RequestWithMethod("POST", url, data=data)
         req.add_header("Content-Length", "%d" % len(data))
-        req.add_header("Content-Type", "application/atom+xml")
-        self._credentials.sign_table_request(req)
+        req.add_header("Content-Type", content_type)
+        # Don't echo the entity back; the insert then answers 204 instead of 201.
+        if self._json: req.add_header("Prefer", "return-no-content")
+        self._sign_table_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "insert_entity")
             return response.code
         except URLError, e:
             return e.code
 
     def update_entity(self, table_name, partition_key, row_key, entity):
-        data = entity.to_update_xml()
-        url = """%s/%s(PartitionKey='%s',RowKey='%s')""" % (self.get_base_url(), table_name, partition_key, row_key)
-        if isinstance(url, unicode):
-            url = url.encode('utf-8')
+        data, content_type = self._serialize_entity(entity)
+        url = "%s/%s" % (self.get_base_url(), _entity_path(table_name, partition_key, row_key))
 
         req = RequestWithMethod("PUT", url, data=data)
         req.add_header("Content-Length", "%d" % len(data))
-        req.add_header("Content-Type", "application/atom+xml")
-        self._credentials.sign_table_request(req)
+        req.add_header("Content-Type", content_type)
+        self._sign_table_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "update_entity")
             return response.code
         except URLError, e:
             return e.code
 
     def merge_entity(self, table_name, partition_key, row_key, entity):
-        data = entity.to_update_xml()
-        url = """%s/%s(PartitionKey='%s',RowKey='%s')""" % (self.get_base_url(), table_name, partition_key, row_key)
-        if isinstance(url, unicode):
-            url = url.encode('utf-8')
+        data, content_type = self._serialize_entity(entity)
+        url = "%s/%s" % (self.get_base_url(), _entity_path(table_name, partition_key, row_key))
         req = RequestWithMethod("MERGE", url, data=data)
         req.add_header("Content-Length", "%d" % len(data))
-        req.add_header("Content-Type", "application/atom+xml")
-        self._credentials.sign_table_request(req)
+        req.add_header("Content-Type", content_type)
+        self._sign_table_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "merge_entity")
             return response.code
         except URLError, e:
             return e.code
 
     def delete_entity(self, table_name, partition_key, row_key, condition="*"):
         data = ""
-        url = """%s/%s(PartitionKey='%s',RowKey='%s')""" % (self.get_base_url(), table_name, partition_key, row_key)
-        if isinstance(url, unicode):
-            url = url.encode('utf-8')
+        url = "%s/%s" % (self.get_base_url(), _entity_path(table_name, partition_key, row_key))
         req = RequestWithMethod("DELETE", url, data)
         req.add_header("Content-Length", "%d" % len(data))
         req.add_header("Content-Type", "application/atom+xml")
         req.add_header("If-Match", condition)
-        self._credentials.sign_table_request(req)
+        self._sign_table_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "delete_entity")
             return response.code
         except URLError, e:
             return e.code
 
-    def query_entity(self, table_name, filter):
-        quoted_filter = quote(filter)
-        url = """%s/%s()?$filter=%s""" % (self.get_base_url(), table_name, quoted_filter)
-        if isinstance(url, unicode):
-            url = url.encode('utf-8')
-        req = RequestWithMethod("GET", url)
+    def _make_batch_body(self, batch, batch_boundary):
+        changeset_boundary = "changeset_%s" % uuid.uuid4()
+        parts = ["--%s\r\nContent-Type: multipart/mixed; boundary=%s\r\n\r\n" % (batch_boundary, changeset_boundary)]
+        for content_id, (method, path, data, headers) in enumerate(batch.operations):
+            lines = ["--%s" % changeset_boundary,
+                     "Content-Type: application/http",
+                     "Content-Transfer-Encoding: binary",
+                     "",
+                     "%s %s/%s HTTP/1.1" % (method, self.get_base_url(), path),
+                     "Content-ID: %d" % (content_id + 1)]
+            if data: lines.append("Content-Type: application/atom+xml;type=entry")
+            lines.extend(["%s: %s" % header for header in headers.items()])
+            lines.extend(["Content-Length: %d" % len(data), "", data])
+            parts.append("\r\n".join(lines))
+        parts.append("--%s--\r\n--%s--\r\n" % (changeset_boundary, batch_boundary))
+        return "\r\n".join(parts)
+
+    def commit_batch(self, batch):
+        '''Send every operation of batch in one $batch request. Returns a list with one status
+           code per operation, in the order they were added. The transaction is atomic: when an
+           operation fails, its entry holds the error status and every other entry is None,
+           since none of them were applied.'''
+        if not batch.operations: return []
+        boundary = "batch_%s" % uuid.uuid4()
+        data = self._make_batch_body(batch, boundary)
+        req = RequestWithMethod("POST", "%s/$batch" % self.get_base_url(), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        req.add_header("Content-Type", "multipart/mixed; boundary=%s" % boundary)
+        # The operations inside the batch are Atom, so the batch itself is too, whatever the payload format.
         self._credentials.sign_table_request(req)
         try:
-            resp = urlopen(req)
+            body = self._urlopen(req, "commit_batch").read()
+        except URLError, e:
+            return [e.code] * len(batch)
+        codes = [int(code) for code in re.findall(r"^HTTP/1\.1 (\d{3})", body, re.MULTILINE)]
+        if len(codes) == len(batch) and max(codes) < 400:
+            return codes
+        results = [None] * len(batch)
+        failed = re.search(r'(?:<message[^>]*>|"value"\s*:\s*")(\d+):', body)
+        if failed is not None and int(failed.group(1)) < len(batch): index = int(failed.group(1))
+        else: index = 0
+        results[index] = codes and max(codes) or 400
+        return results
+
+    def write_entities(self, table_name, entities, operation = "insert", max_workers = DEFAULT_WORKERS):
+        '''Insert, update, merge or delete (according to operation) every entity of the iterable
+           entities, using Entity Group Transactions. Entities are bucketed by partition key and a
+           bucket is committed as soon as it is full, so entities can be streamed from any
+           source; up to max_workers batches are committed concurrently. Returns a list of
+           (entity, status) for the entities that were not written, status being None when
+           the entity was rolled back because of another failure in the same batch.'''
+        def add(batch, entity):
+            if operation == "insert": batch.insert_entity(entity)
+            elif operation == "update": batch.update_entity(entity.partition_key, entity.row_key, entity)
+            elif operation == "merge": batch.merge_entity(entity.partition_key, entity.row_key, entity)
+            elif operation == "delete": batch.delete_entity(entity.partition_key, entity.row_key)
+            else: raise TableEntityException("Unknown batch operation: %s" % (operation,))
+
+        def batches():
+            buckets = {}
+            for entity in entities:
+                batch, members = buckets.get(entity.partition_key, (None, None))
+                if batch is not None and (len(batch) == BATCH_MAX_OPERATIONS or batch.size > BATCH_MAX_SIZE - ENTITY_MAX_SIZE):
+                    yield batch, members
+                    batch = None
+                if batch is None:
+                    batch, members = TableBatch(table_name), []
+                    buckets[entity.partition_key] = (batch, members)
+                add(batch, entity)
+                members.append(entity)
+            for batch, members in buckets.values():
+                yield batch, members
+
+        failures = []
+        for (batch, members), codes, error in parallel_imap(lambda (batch, members): self.commit_batch(batch), batches(), max_workers):
+            if error is not None: raise error
+            failures.extend([(entity, code) for entity, code in zip(members, codes) if code is None or code >= 400])
+        return failures
+
+    def scan_entities(self, table_name, sink, filter = None, select = None, ranges = None, max_workers = DEFAULT_WORKERS):
+        '''Read every entity of table_name matching filter with max_workers concurrent queries
+           and pass them to sink. The table is split into PartitionKey ranges, by default
+           split_key_space(SCAN_RANGES_PER_WORKER * max_workers); ranges can also be given as
+           (low, high) pairs, low inclusive and high exclusive, None being unbounded. Each range
+           is queried by one worker, following continuation tokens.
+
+           sink is either a function called with each entity or an object such as JsonLinesSink,
+           CsvSink or ColumnarSink whose write() is called with lists of entities, up to a page
+           at a time, and whose flush() is called at the end. Calls come from the worker threads
+           but never at the same time; entities of different ranges are interleaved. Returns
+           the number of entities scanned.'''
+        if ranges is None: ranges = split_key_space(SCAN_RANGES_PER_WORKER * max_workers)
+        write = getattr(sink, "write", None)
+        if write is None:
+            write = lambda entities: [sink(entity) for entity in entities]
+        lock = threading.Lock()
+
+        def deliver(entities):
+            with lock:
+                write(entities)
+
+        def scan((low, high)):
+            count = 0
+            entities = []
+            for entity in self.iter_entities(table_name, _key_range_filter(low, high, filter), select):
+                entities.append(entity)
+                if len(entities) == QUERY_PAGE_SIZE:
+                    deliver(entities)
+                    count += len(entities)
+                    entities = []
+            if entities: deliver(entities)
+            return count + len(entities)
+
+        count = 0
+        for key_range, scanned, error in parallel_imap(scan, ranges, max_workers):
+            if error is not None: raise error
+            count += scanned
+        flush = getattr(sink, "flush", None)
+        if flush is not None: flush()
+        return count
+
+    def query_entity(self, table_name, filter, select = None):
+        try:
+            return list(self.iter_entities(table_name, filter, select))
         except URLError, e:
             return e.code
 
-        dom = minidom.parseString(resp.read())
-        entries = dom.getElementsByTagName("entry")
-        entities = []
-        for entry in entries:
-            entities.append(self._parse_entity(entry))
-        dom.unlink()
-        return entities
-
-    def top_entity(self, table_name, size):
-        url = """%s/%s()?$top=%s""" % (self.get_base_url(), table_name, size)
-        if isinstance(url, unicode):
-            url = url.encode('utf-8')
-        req = RequestWithMethod("GET", url)
-        self._credentials.sign_table_request(req)
-
+    def top_entity(self, table_name, size, select = None):
         try:
-            resp = urlopen(req)
+            return list(self.iter_entities(table_name, select = select, top = int(size)))
         except URLError, e:
             return e.code
 
-        dom = minidom.parseString(resp.read())
-        entries = dom.getElementsByTagName("entry")
-        entities = []
-        for entry in entries:
-            entities.append(self._parse_entity(entry))
-        dom.unlink()
-        return entities
+def split_key_space(count, alphabet = KEY_ALPHABET):
+    '''Return count (low, high) PartitionKey ranges that together cover every key, low being
+       inclusive and high exclusive, None unbounded. The boundaries are spread evenly over the
+       two-character prefixes made from alphabet, which suits keys distributed uniformly over
+       it (GUIDs, hex digests, ...); pass alphabet="0123456789abcdef" for those. For skewed
+       keys, ranges with boundaries of their own work better.'''
+    alphabet = sorted(alphabet)
+    prefixes = [first + second for first in alphabet for second in alphabet]
+    count = max(1, min(count, len(prefixes)))
+    edges = [None] + [prefixes[len(prefixes) * i / count] for i in range(1, count)] + [None]
+    return zip(edges, edges[1:])
+
+def _key_range_filter(low, high, filter = None):
+    clauses = []
+    if low is not None: clauses.append((Property("PartitionKey") >= low).compile())
+    if high is not None: clauses.append((Property("PartitionKey") < high).compile())
+    if filter is not None: clauses.append("(%s)" % _filter_text(filter))
+    return " and ".join(clauses) or None
+
+def _entity_items(entity):
+    return [(name, entity._value(name)) for name in entity._names]
+
+def _export_value(value):
+    if isinstance(value, datetime): return format_json_datetime(value)
+    if isinstance(value, unicode): return value.encode("utf-8")
+    return value
+
+class JsonLinesSink(object):
+    '''Table scan sink writing one JSON object per entity and line to the file object f.
+       DateTime values are written as ISO 8601 strings.'''
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, entities):
+        dumps = json.dumps
+        self._f.write("".join([dumps(dict((name, _export_value(value)) for name, value in _entity_items(entity))) + "\n" for entity in entities]))
+
+    def flush(self):
+        self._f.flush()
+
+class CsvSink(object):
+    '''Table scan sink writing entities as CSV rows to the file object f, after a header row.
+       columns lists the properties to write; by default they are those of the first entity.
+       Properties an entity lacks are left empty.'''
+    def __init__(self, f, columns = None):
+        self._writer = csv.writer(f)
+        self._f = f
+        self.columns = columns
+        if columns is not None: self._writer.writerow(columns)
+
+    def write(self, entities):
+        if not entities: return
+        if self.columns is None:
+            self.columns = list(entities[0]._names)
+            self._writer.writerow(self.columns)
+        columns = self.columns
+        self._writer.writerows([[_export_value(entity._value(name)) for name in columns] for entity in entities])
+
+    def flush(self):
+        self._f.flush()
+
+class ColumnarSink(object):
+    '''Table scan sink gathering entities into columnar batches of up to batch_size rows:
+       dicts mapping every property name to the list of its values, None where an entity
+       lacks the property. callback(columns, row_count) is called with each full batch,
+       and by flush() with the last one.'''
+    def __init__(self, callback, batch_size = QUERY_PAGE_SIZE):
+        self._callback = callback
+        self.batch_size = batch_size
+        self._columns = {}
+        self._rows = 0
+
+    def write(self, entities):
+        for entity in entities:
+            # flush() starts a new batch, so look the columns up again for every entity.
+            columns = self._columns
+            for name, value in _entity_items(entity):
+                column = columns.get(name)
+                if column is None: column = columns[name] = [None] * self._rows
+                column.append(value)
+            self._rows += 1
+            for column in columns.itervalues():
+                if len(column) < self._rows: column.append(None)
+            if self._rows == self.batch_size: self.flush()
+
+    def flush(self):
+        if not self._rows: return
+        columns, rows = self._columns, self._rows
+        self._columns, self._rows = {}, 0
+        self._callback(columns, rows)
+
+def _check_content_encoding(content_encoding):
+    if content_encoding not in (None, "gzip"):
+        raise ValueError("Unsupported content encoding %r, only gzip is" % content_encoding)
+
+def gzip_compress(data, level = GZIP_LEVEL):
+    '''Return data compressed in the gzip format, as sent with Content-Encoding: gzip.'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class _TransformStream(object):
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = ""
+        self._eof = False
+
+    def read(self, size = -1):
+        chunks = [self._buffer]
+        buffered = len(self._buffer)
+        while not self._eof and (size < 0 or buffered < size):
+            data = self._stream.read(READ_CHUNK_SIZE)
+            if data:
+                data = self._transform(data)
+            else:
+                data = self._finish()
+                self._eof = True
+            chunks.append(data)
+            buffered += len(data)
+        data = "".join(chunks)
+        if size < 0: size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        close = getattr(self._stream, "close", None)
+        if close is not None: close()
+
+class GzipStream(_TransformStream):
+    '''File-like object returning what is read from stream gzip compressed. The input is
+       compressed READ_CHUNK_SIZE bytes at a time as it is read, never as a whole.'''
+    def __init__(self, stream, level = GZIP_LEVEL):
+        _TransformStream.__init__(self, stream)
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _transform(self, data):
+        return self._compressor.compress(data)
+
+    def _finish(self):
+        return self._compressor.flush()
+
+class ContentDecoder(object):
+    '''Incrementally verify and decode blob content as it is received: update() takes the
+       bytes as stored and returns them decoded, finish() returns what is left and raises
+       IOError if their MD5 does not match content_md5 (a base64 Content-MD5; None skips the
+       check). gzip content is decompressed if decompress is set; content in any other
+       encoding (identity, or one set by another tool) is returned as stored.'''
+    def __init__(self, content_encoding = None, content_md5 = None, decompress = True):
+        self._content_md5 = content_md5
+        self._md5 = content_md5 and hashlib.md5()
+        self._decompressor = None
+        if decompress and (content_encoding or "").strip().lower() == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def update(self, data):
+        if self._md5: self._md5.update(data)
+        if self._decompressor: return self._decompressor.decompress(data)
+        return data
+
+    def finish(self):
+        tail = self._decompressor and self._decompressor.flush() or ""
+        if self._md5:
+            md5 = base64.b64encode(self._md5.digest())
+            if md5 != self._content_md5: raise IOError("Content-MD5 mismatch: expected %s, received %s" % (self._content_md5, md5))
+        return tail
+
+class BlobReader(_TransformStream):
+    '''File-like object reading a blob GET response through a ContentDecoder.'''
+    def __init__(self, response, decoder):
+        _TransformStream.__init__(self, response)
+        self._transform = decoder.update
+        self._finish = decoder.finish
+        self.response = response
+
+class BulkResults(object):
+    '''Iterable over the (name, result, error) tuples of a bulk operation, in completion order.
+       A failing item doesn't stop the others: error holds the exception it raised, or its
+       status code when that was 400 or above. succeeded, failed and errors (a list of
+       (name, error)) are updated while iterating; wait() runs everything to completion.'''
+    def __init__(self, results):
+        self._results = results
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = []
+
+    def __iter__(self):
+        for name, result, error in self._results:
+            if error is None and isinstance(result, int) and result >= 400:
+                error = result
+            if error is None:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+                self.errors.append((name, error))
+            yield name, result, error
+
+    def wait(self):
+        for result in self: pass
+        return self
 
 class BlobStorage(Storage):
-    def __init__(self, host = DEVSTORE_BLOB_HOST, account_name = DEVSTORE_ACCOUNT, secret_key = DEVSTORE_SECRET_KEY, use_path_style_uris = None):
-        super(BlobStorage, self).__init__(host, account_name, secret_key, use_path_style_uris)
+    def __init__(self, host = DEVSTORE_BLOB_HOST, account_name = DEVSTORE_ACCOUNT, secret_key = DEVSTORE_SECRET_KEY, use_path_style_uris = None, connection_pool = None, credentials = None, retry_policy = None, rate_limiter = None, instrumentation = None):
+        super(BlobStorage, self).__init__(host, account_name, secret_key, use_path_style_uris, connection_pool, credentials, retry_policy, rate_limiter, instrumentation)
+
+    def generate_shared_access_signature(self, container_name, blob_name = None, permission = None, expiry = None, start = None, identifier = None):
+        '''Return a shared access signature query string for a blob, or for the whole container
+           when blob_name is None. permission is any combination of "rwdl" (read, write, delete,
+           list); expiry and start are UTC datetimes or ISO 8601 strings.'''
+        if blob_name is None:
+            resource, kind = "/%s/%s" % (self._account, container_name), "c"
+        else:
+            resource, kind = "/%s/%s/%s" % (self._account, container_name, blob_name), "b"
+        return self._make_shared_access_signature(resource, permission, expiry, start, identifier, [("sr", kind)])
+
+    def get_shared_access_url(self, container_name, blob_name, permission = "r", expiry = None, start = None, identifier = None):
+        '''Return a URL giving holders of it access to the blob without the account key.'''
+        return "%s/%s/%s?%s" % (self.get_base_url(), container_name, blob_name, self.generate_shared_access_signature(container_name, blob_name, permission, expiry, start, identifier))
 
     def create_container(self, container_name, is_public = False):
         req = RequestWithMethod("PUT", "%s/%s?restype=container" % (self.get_base_url(), container_name))
@@ -528,7 +2379,7 @@ class BlobStorage(Storage):
         if is_public: req.add_header(PREFIX_PROPERTIES + "publicaccess", "true")
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "create_container")
             return response.code
         except URLError, e:
             return e.code
@@ -537,7 +2388,7 @@ class BlobStorage(Storage):
         req = RequestWithMethod("DELETE", "%s/%s?restype=container" % (self.get_base_url(), container_name))
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "delete_container")
             return response.code
         except URLError, e:
             return e.code
@@ -545,60 +2396,246 @@ class BlobStorage(Storage):
     def list_containers(self):
         req = Request("%s/?comp=list" % self.get_base_url())
         self._credentials.sign_request(req)
-        dom = minidom.parseString(urlopen(req).read())
-        containers = dom.getElementsByTagName("Container")
-        for container in containers:
-            container_name = container.getElementsByTagName("Name")[0].firstChild.data
-            etag = container.getElementsByTagName("Etag")[0].firstChild.data
-            last_modified = time.strptime(container.getElementsByTagName("LastModified")[0].firstChild.data, TIME_FORMAT)
+        for container in iter_elements(self._urlopen(req, "list_containers"), ("Container",)):
+            container_name = container.findtext("Name")
+            etag = container.findtext(".//Etag")
+            last_modified = time.strptime(container.findtext(".//LastModified") or container.findtext(".//Last-Modified"), TIME_FORMAT)
             yield (container_name, etag, last_modified)
-        
-        dom.unlink() #Docs say to do this to force GC. Ugh.
 
-    def put_blob(self, container_name, blob_name, data, content_type = "", metadata = {}):
+    def put_blob(self, container_name, blob_name, data, content_type = "", metadata = {}, content_encoding = None, compute_md5 = False):
+        '''Upload data as a block blob. With content_encoding "gzip" the data is compressed
+           first and stored with that Content-Encoding. With compute_md5 its MD5 is sent as
+           Content-MD5, which the service checks and keeps as the blob's.'''
+        _check_content_encoding(content_encoding)
+        if content_encoding: data = gzip_compress(data)
         req = RequestWithMethod("PUT", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name), data=data)
         req.add_header("Content-Length", "%d" % len(data))
         req.add_header('x-ms-blob-type', 'BlockBlob')
+        if content_encoding: req.add_header("Content-Encoding", content_encoding)
+        if compute_md5: req.add_header("Content-MD5", base64.b64encode(hashlib.md5(data).digest()))
         for key, value in metadata.items():
             req.add_header("x-ms-meta-%s" % key, value)
         req.add_header("Content-Type", content_type)
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "put_blob")
             return response.code
         except URLError, e:
             return e.code
 
-    def delete_blob(self, container_name, blob_name):
-        req = RequestWithMethod("DELETE", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+    def get_blob_url(self, container_name, blob_name, snapshot = None):
+        url = "%s/%s/%s" % (self.get_base_url(), container_name, blob_name)
+        if snapshot is not None: url += "?" + urlencode({"snapshot": snapshot})
+        return url
+
+    def delete_blob(self, container_name, blob_name, snapshot = None, delete_snapshots = None):
+        '''Delete the blob, or only the given snapshot of it. A blob that has snapshots can
+           only be deleted with delete_snapshots set to "include" (delete them too) or "only"
+           (delete them and keep the blob).'''
+        req = RequestWithMethod("DELETE", self.get_blob_url(container_name, blob_name, snapshot))
+        if delete_snapshots is not None: req.add_header("x-ms-delete-snapshots", delete_snapshots)
         self._credentials.sign_request(req)
-        urlopen(req)
+        self._urlopen(req, "delete_blob")
 
-    def get_blob(self, container_name, blob_name):
-        req = Request("%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+    def _open_blob(self, container_name, blob_name, if_none_match = None, snapshot = None):
+        req = Request(self.get_blob_url(container_name, blob_name, snapshot))
+        if if_none_match is not None: req.add_header("If-None-Match", if_none_match)
         self._credentials.sign_request(req)
-        return urlopen(req).read()
+        return self._urlopen(req, "get_blob")
 
-    def get_blob_with_metadata(self, container_name, blob_name):
-        req = Request("%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
-        self._credentials.sign_request(req)
-        response = urlopen(req)
+    def _get_metadata(self, response):
         metadata = {}
         for key, value in response.info().items():
             if key.startswith('x-ms-meta-'):
                 metadata[key[len('x-ms-meta-'):]] = value
-        return metadata, response.read()
+        return metadata
+
+    def get_blob(self, container_name, blob_name, snapshot = None, decompress = False, verify_md5 = False):
+        '''Return the content of the blob; see get_blob_stream for decompress and verify_md5.'''
+        if not (decompress or verify_md5):
+            return self._open_blob(container_name, blob_name, snapshot = snapshot).read()
+        return self.get_blob_stream(container_name, blob_name, snapshot, decompress, verify_md5).read()
+
+    def get_blob_stream(self, container_name, blob_name, snapshot = None, decompress = False, verify_md5 = False):
+        '''Return a file-like BlobReader over the content of the blob. With decompress, gzip
+           encoded content is decompressed as it is read; other encodings are left as they
+           are. With verify_md5, the MD5 of the bytes received is computed on the way and
+           reading the end raises IOError if it differs from the blob's Content-MD5 (blobs
+           without one are not checked). Both default to off, as for get_blob.'''
+        response = self._open_blob(container_name, blob_name, snapshot = snapshot)
+        info = response.info()
+        decoder = ContentDecoder(info.get("content-encoding"), verify_md5 and info.get("content-md5") or None, decompress)
+        return BlobReader(response, decoder)
+
+    def get_blob_with_metadata(self, container_name, blob_name):
+        response = self._open_blob(container_name, blob_name)
+        return self._get_metadata(response), response.read()
 
     def blob_exists(self, container_name, blob_name):
         req = RequestWithMethod("HEAD", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
         self._credentials.sign_request(req)
         try:
-            urlopen(req)
+            self._urlopen(req, "blob_exists")
             return True
         except:
             return False
+
+    def get_blob_properties(self, container_name, blob_name):
+        '''Return the response headers of a HEAD request on the blob as a dict with
+           lower-cased keys (content-length, etag, last-modified, x-ms-meta-*, ...).'''
+        req = RequestWithMethod("HEAD", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+        self._credentials.sign_request(req)
+        return dict(self._urlopen(req, "get_blob_properties").info().items())
+
+    def snapshot_blob(self, container_name, blob_name, metadata = None):
+        '''Take a read-only snapshot of the blob and return its snapshot id, to be passed as
+           snapshot to get_blob, copy_blob or delete_blob. The snapshot gets metadata if given,
+           otherwise the blob's.'''
+        req = RequestWithMethod("PUT", "%s/%s/%s?comp=snapshot" % (self.get_base_url(), container_name, blob_name))
+        req.add_header("Content-Length", "0")
+        for key, value in (metadata or {}).items():
+            req.add_header("x-ms-meta-%s" % key, value)
+        self._credentials.sign_request(req)
+        return self._urlopen(req, "snapshot_blob").info().get("x-ms-snapshot")
+
+    def copy_blob_from_url(self, container_name, blob_name, source_url, metadata = None):
+        '''Have the service copy the blob at source_url into blob_name, without the data going
+           through this client. source_url is a blob of this account (see get_blob_url) or any
+           blob readable with it, e.g. a URL from get_shared_access_url. The copy gets metadata
+           if given, otherwise the source's. Returns (copy_id, copy_status); the status is
+           "success" when the copy completed right away and "pending" while the service is
+           still copying, in which case poll get_copy_status or call wait_for_copy.'''
+        req = RequestWithMethod("PUT", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+        req.add_header("Content-Length", "0")
+        req.add_header("x-ms-version", COPY_VERSION)
+        req.add_header("x-ms-copy-source", source_url)
+        for key, value in (metadata or {}).items():
+            req.add_header("x-ms-meta-%s" % key, value)
+        self._credentials.sign_request(req)
+        headers = self._urlopen(req, "copy_blob_from_url").info()
+        return headers.get("x-ms-copy-id"), headers.get("x-ms-copy-status")
+
+    def copy_blob(self, source_container, source_blob, container_name, blob_name, metadata = None, source_snapshot = None):
+        '''Copy a blob (or a snapshot of it) of this account server side; see copy_blob_from_url.'''
+        return self.copy_blob_from_url(container_name, blob_name, self.get_blob_url(source_container, source_blob, source_snapshot), metadata)
+
+    def get_copy_status(self, container_name, blob_name):
+        '''Return the state of the last copy into the blob as a dict: id, status ("pending",
+           "success", "aborted" or "failed"), progress ("copied/total" bytes), source,
+           completion-time and status-description, when the service reports them.'''
+        req = RequestWithMethod("HEAD", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+        req.add_header("x-ms-version", COPY_VERSION)
+        self._credentials.sign_request(req)
+        prefix = "x-ms-copy-"
+        return dict((key[len(prefix):], value) for key, value in self._urlopen(req, "get_copy_status").info().items() if key.startswith(prefix))
+
+    def wait_for_copy(self, container_name, blob_name, poll_interval = COPY_POLL_INTERVAL, timeout = None):
+        '''Poll get_copy_status until the copy into the blob is no longer pending, or timeout
+           seconds have passed, and return the last status.'''
+        deadline = timeout is not None and time.time() + timeout or None
+        while True:
+            status = self.get_copy_status(container_name, blob_name)
+            if status.get("status") != "pending": return status
+            if deadline is not None and time.time() + poll_interval > deadline: return status
+            time.sleep(poll_interval)
+
+    def abort_copy(self, container_name, blob_name, copy_id):
+        '''Abort a pending copy, leaving an empty destination blob.'''
+        req = RequestWithMethod("PUT", "%s/%s/%s?%s" % (self.get_base_url(), container_name, blob_name, urlencode({"comp": "copy", "copyid": copy_id})))
+        req.add_header("Content-Length", "0")
+        req.add_header("x-ms-version", COPY_VERSION)
+        req.add_header("x-ms-copy-action", "abort")
+        self._credentials.sign_request(req)
+        try:
+            response = self._urlopen(req, "abort_copy")
+            return response.code
+        except URLError, e:
+            return e.code
+
+    def _open_blob_range(self, container_name, blob_name, start, end, etag = None):
+        req = Request("%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+        req.add_header("Range", "bytes=%d-%d" % (start, end))
+        if etag is not None: req.add_header("If-Match", etag)
+        self._credentials.sign_request(req)
+        return self._urlopen(req, "get_blob_range")
+
+    def get_blob_range(self, container_name, blob_name, start, end, etag = None):
+        '''Return bytes start to end (inclusive) of the blob. If etag is given the request fails
+           with 412 when the blob has changed.'''
+        return self._open_blob_range(container_name, blob_name, start, end, etag).read()
+
+    def _blob_ranges(self, size, range_size):
+        return [(start, min(start + range_size, size) - 1) for start in xrange(0, size, range_size)]
+
+    def iter_blob(self, container_name, blob_name, range_size = RANGE_SIZE, max_workers = DEFAULT_WORKERS, decompress = False, verify_md5 = False):
+        '''Download the blob with concurrent ranged GETs and yield its content in order, one
+           range_size chunk at a time. At most 2 * max_workers chunks are held in memory.
+           decompress and verify_md5 work as for get_blob_stream, on the chunks in order.'''
+        properties = self.get_blob_properties(container_name, blob_name)
+        size = int(properties["content-length"])
+        etag = properties.get("etag")
+        if decompress or verify_md5:
+            decoder = ContentDecoder(properties.get("content-encoding"), verify_md5 and properties.get("content-md5") or None, decompress)
+            for data in self._iter_ranges(container_name, blob_name, size, etag, range_size, max_workers):
+                yield decoder.update(data)
+            yield decoder.finish()
+            return
+        for data in self._iter_ranges(container_name, blob_name, size, etag, range_size, max_workers):
+            yield data
+
+    def _iter_ranges(self, container_name, blob_name, size, etag, range_size, max_workers):
+        # An ordered window: a range is only requested once the one 2 * max_workers places
+        # before it has been yielded, so a stalled range can't let later ones pile up.
+        executor = Executor(max(1, max_workers))
+        window = deque()
+        try:
+            for start, end in self._blob_ranges(size, range_size):
+                if len(window) >= 2 * executor.max_workers:
+                    yield window.popleft().result()
+                window.append(executor.submit(self.get_blob_range, container_name, blob_name, start, end, etag))
+            while window:
+                yield window.popleft().result()
+        finally:
+            executor.shutdown(wait = False)
+
+    def download_blob_to_file(self, container_name, blob_name, file_name, range_size = RANGE_SIZE, max_workers = DEFAULT_WORKERS, decompress = False, verify_md5 = False):
+        '''Download the blob into file_name with concurrent ranged GETs. The file is created at
+           its final size and every range is streamed in READ_CHUNK_SIZE pieces straight to its
+           offset through its own file handle, so memory use does not depend on the blob size.
+           With decompress or verify_md5 (see get_blob_stream) the content has to be decoded
+           in order, so it is written sequentially from iter_blob instead. Returns the number
+           of bytes written.'''
+        if decompress or verify_md5:
+            size = 0
+            with open(file_name, "wb") as f:
+                for data in self.iter_blob(container_name, blob_name, range_size, max_workers, decompress, verify_md5):
+                    f.write(data)
+                    size += len(data)
+            return size
+        properties = self.get_blob_properties(container_name, blob_name)
+        size = int(properties["content-length"])
+        self._download_ranges(container_name, blob_name, file_name, size, self._blob_ranges(size, range_size), properties.get("etag"), max_workers)
+        return size
+
+    def _download_ranges(self, container_name, blob_name, file_name, size, ranges, etag, max_workers):
+        with open(file_name, "wb") as f:
+            f.truncate(size)
+
+        def fetch((start, end)):
+            response = self._open_blob_range(container_name, blob_name, start, end, etag)
+            with open(file_name, "r+b") as f:
+                f.seek(start)
+                remaining = end + 1 - start
+                while remaining > 0:
+                    data = response.read(min(READ_CHUNK_SIZE, remaining))
+                    if not data: raise IOError("Unexpected end of range %d-%d of %s/%s" % (start, end, container_name, blob_name))
+                    f.write(data)
+                    remaining -= len(data)
+
+        for span, result, error in parallel_imap(fetch, ranges, max_workers):
+            if error is not None: raise error
 		
-    def list_blobs(self, container_name, blob_prefix=None):
+    def _iter_blob_elements(self, container_name, blob_prefix):
         marker = None
         while True:
             url = "%s/%s?restype=container&comp=list" % (self.get_base_url(), container_name)
@@ -606,29 +2643,632 @@ class BlobStorage(Storage):
             if not marker is None: url += "&marker=%s" % marker
             req = Request(url)
             self._credentials.sign_request(req)
-            dom = minidom.parseString(urlopen(req).read())
-            blobs = dom.getElementsByTagName("Blob")
-            for blob in blobs:
-                blob_name = blob.getElementsByTagName("Name")[0].firstChild.data
-                etag = blob.getElementsByTagName("Etag")[0].firstChild.data
-                last_modified = time.strptime(blob.getElementsByTagName("LastModified")[0].firstChild.data, TIME_FORMAT)
-                yield (blob_name, etag, last_modified)
-            try: marker = dom.getElementsByTagName("NextMarker")[0].firstChild.data
-            except: marker = None
+            marker = None
+            for elem in iter_elements(self._urlopen(req, "list_blobs"), ("Blob", "NextMarker")):
+                if elem.tag == "NextMarker":
+                    marker = elem.text
+                    continue
+                yield elem
             if marker is None: break
 
-    def put_block(self, container_name, blob_name, block_id, data):
+    def list_blobs(self, container_name, blob_prefix=None):
+        for elem in self._iter_blob_elements(container_name, blob_prefix):
+            blob_name = elem.findtext("Name")
+            etag = elem.findtext(".//Etag")
+            last_modified = time.strptime(elem.findtext(".//LastModified") or elem.findtext(".//Last-Modified"), TIME_FORMAT)
+            yield (blob_name, etag, last_modified)
+
+    def list_blobs_with_properties(self, container_name, blob_prefix=None):
+        '''Yield (blob_name, properties) for every blob, properties being a dict of the listed
+           properties keyed by their element name (Etag, Content-Length, Content-MD5, ...).'''
+        for elem in self._iter_blob_elements(container_name, blob_prefix):
+            properties = elem.find("Properties")
+            if properties is None: properties = elem
+            yield elem.findtext("Name"), dict((child.tag, child.text) for child in properties if child.tag != "Name")
+
+    def put_block(self, container_name, blob_name, block_id, data, compute_md5 = False):
         encoded_block_id = urlencode({"comp": "block", "blockid": block_id})
         req = RequestWithMethod("PUT", "%s/%s/%s?%s" % (self.get_base_url(), container_name, blob_name, encoded_block_id), data=data)
         req.add_header("Content-Type", "")
         req.add_header("Content-Length", "%d" % len(data))
+        # A transactional MD5: the service rejects the block if it arrives different.
+        if compute_md5: req.add_header("Content-MD5", base64.b64encode(hashlib.md5(data).digest()))
+        self._credentials.sign_request(req)
+        try:
+            response = self._urlopen(req, "put_block")
+            return response.code
+        except URLError, e:
+            return e.code
+
+    def put_block_list(self, container_name, blob_name, block_ids, content_type = "", metadata = {}, content_md5 = None, content_encoding = None):
+        data = '<?xml version="1.0" encoding="utf-8"?><BlockList>%s</BlockList>' % "".join(["<Latest>%s</Latest>" % block_id for block_id in block_ids])
+        req = RequestWithMethod("PUT", "%s/%s/%s?comp=blocklist" % (self.get_base_url(), container_name, blob_name), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        for key, value in metadata.items():
+            req.add_header("x-ms-meta-%s" % key, value)
+        if content_type: req.add_header("x-ms-blob-content-type", content_type)
+        if content_md5: req.add_header("x-ms-blob-content-md5", content_md5)
+        if content_encoding: req.add_header("x-ms-blob-content-encoding", content_encoding)
         self._credentials.sign_request(req)
         try:
-            response = urlopen(req)
+            response = self._urlopen(req, "put_block_list")
             return response.code
         except URLError, e:
             return e.code
 
+    def upload_stream(self, container_name, blob_name, stream, content_type = "", metadata = {}, block_size = BLOCK_SIZE, max_workers = DEFAULT_WORKERS, content_md5 = None,
+                      content_encoding = None, compute_md5 = False):
+        '''Upload everything read from stream as a block blob. The input is cut into blocks of
+           block_size bytes which are sent concurrently by max_workers threads, each request
+           being retried by the storage's RetryPolicy. Once every block is stored they are
+           committed with Put Block List, whose status code is returned. If a block can't be
+           stored its last status code is returned and nothing is committed. content_md5, the
+           base64 MD5 of the whole content, is stored as the blob's Content-MD5.
+
+           With content_encoding "gzip" the stream is compressed as it is read (see GzipStream)
+           and the blob stored with that Content-Encoding. With compute_md5 every block is sent
+           with a Content-MD5 the service checks, and the MD5 of the whole content as stored is
+           computed block by block on the way and kept as the blob's Content-MD5.'''
+        _check_content_encoding(content_encoding)
+        if content_encoding: stream = GzipStream(stream)
+        md5 = compute_md5 and hashlib.md5()
+
+        def block_id(index):
+            return base64.b64encode("block-%010d" % index)
+
+        def blocks():
+            index = 0
+            while True:
+                data = stream.read(block_size)
+                if not data: break
+                if md5: md5.update(data)
+                yield (block_id(index), data)
+                index += 1
+
+        def upload_block((block_id, data)):
+            return self.put_block(container_name, blob_name, block_id, data, compute_md5)
+
+        count = 0
+        for block, code, error in parallel_imap(upload_block, blocks(), max_workers):
+            if error is not None: raise error
+            if code != 201: return code
+            count += 1
+        if md5: content_md5 = base64.b64encode(md5.digest())
+        return self.put_block_list(container_name, blob_name, [block_id(index) for index in range(count)], content_type, metadata, content_md5, content_encoding)
+
+    def upload_blob_from_file(self, container_name, blob_name, file_name, content_type = "", metadata = {}, block_size = BLOCK_SIZE, max_workers = DEFAULT_WORKERS, content_md5 = None,
+                              content_encoding = None, compute_md5 = False):
+        '''Upload the local file file_name as a block blob; see upload_stream.'''
+        with open(file_name, "rb") as f:
+            return self.upload_stream(container_name, blob_name, f, content_type, metadata, block_size, max_workers, content_md5, content_encoding, compute_md5)
+
+    def create_page_blob(self, container_name, blob_name, size, content_type = "", metadata = {}):
+        '''Create (or reset) a page blob of size bytes, a multiple of PAGE_SIZE, reading as
+           zeros until pages are written with put_page.'''
+        req = RequestWithMethod("PUT", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+        req.add_header("Content-Length", "0")
+        req.add_header("x-ms-blob-type", "PageBlob")
+        req.add_header("x-ms-blob-content-length", "%d" % size)
+        if content_type: req.add_header("x-ms-blob-content-type", content_type)
+        for key, value in metadata.items():
+            req.add_header("x-ms-meta-%s" % key, value)
+        self._credentials.sign_request(req)
+        try:
+            response = self._urlopen(req, "create_page_blob")
+            return response.code
+        except URLError, e:
+            return e.code
+
+    def _write_pages(self, container_name, blob_name, start, end, data, action):
+        if start % PAGE_SIZE or (end + 1) % PAGE_SIZE:
+            raise ValueError("Page range %d-%d is not aligned to %d byte pages" % (start, end, PAGE_SIZE))
+        req = RequestWithMethod("PUT", "%s/%s/%s?comp=page" % (self.get_base_url(), container_name, blob_name), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        req.add_header("x-ms-page-write", action)
+        req.add_header("x-ms-range", "bytes=%d-%d" % (start, end))
+        self._credentials.sign_request(req)
+        try:
+            response = self._urlopen(req, action == "clear" and "clear_pages" or "put_page")
+            return response.code
+        except URLError, e:
+            return e.code
+
+    def put_page(self, container_name, blob_name, start, data):
+        '''Write data (whole pages, at most PAGE_MAX_WRITE bytes) at offset start, which must be
+           page aligned. Only these pages are sent, whatever the size of the blob.'''
+        return self._write_pages(container_name, blob_name, start, start + len(data) - 1, data, "update")
+
+    def clear_pages(self, container_name, blob_name, start, end):
+        '''Release the pages from start to end (inclusive, page aligned); they read as zeros.'''
+        return self._write_pages(container_name, blob_name, start, end, "", "clear")
+
+    def get_page_ranges(self, container_name, blob_name, start = None, end = None, snapshot = None):
+        '''Return the (start, end) byte ranges (inclusive) of the pages holding data, optionally
+           limited to the range start-end; the service needs both ends of such a range.'''
+        if (start is None) != (end is None): raise ValueError("Pass both start and end, or neither")
+        req = Request(self.get_blob_url(container_name, blob_name, snapshot) + (snapshot is None and "?" or "&") + "comp=pagelist")
+        if start is not None: req.add_header("x-ms-range", "bytes=%d-%d" % (start, end))
+        self._credentials.sign_request(req)
+        return [(int(page_range.findtext("Start")), int(page_range.findtext("End")))
+                for page_range in iter_elements(self._urlopen(req, "get_page_ranges"), ("PageRange",))]
+
+    def upload_page_blob_from_file(self, container_name, blob_name, file_name, content_type = "", metadata = {}, max_workers = DEFAULT_WORKERS):
+        '''Upload a file (a disk image, say) as a page blob, padded to whole pages. Runs of pages
+           holding only zeros are skipped, so sparse files cost only their data. Pages are
+           written by up to max_workers concurrent requests. Returns the number of bytes sent.'''
+        size = os.path.getsize(file_name)
+        size += -size % PAGE_SIZE
+        code = self.create_page_blob(container_name, blob_name, size, content_type, metadata)
+        if code >= 400: raise IOError("Could not create page blob %s/%s: %d" % (container_name, blob_name, code))
+        empty_page = "\0" * PAGE_SIZE
+
+        def writes():
+            # Yield (offset, data) for each run of non-zero pages, split at PAGE_MAX_WRITE.
+            with open(file_name, "rb") as f:
+                offset = 0
+                while True:
+                    chunk = f.read(PAGE_MAX_WRITE)
+                    if not chunk: break
+                    chunk += "\0" * (-len(chunk) % PAGE_SIZE)
+                    run_start = None
+                    for page in xrange(0, len(chunk) + PAGE_SIZE, PAGE_SIZE):
+                        if page < len(chunk) and chunk[page:page + PAGE_SIZE] != empty_page:
+                            if run_start is None: run_start = page
+                        elif run_start is not None:
+                            yield offset + run_start, chunk[run_start:page]
+                            run_start = None
+                    offset += len(chunk)
+
+        def put((start, data)):
+            code = self.put_page(container_name, blob_name, start, data)
+            if code >= 400: raise IOError("Put Page at %d of %s/%s failed: %d" % (start, container_name, blob_name, code))
+            return len(data)
+
+        sent = 0
+        for write, result, error in parallel_imap(put, writes(), max_workers):
+            if error is not None: raise error
+            sent += result
+        return sent
+
+    def download_page_blob_to_file(self, container_name, blob_name, file_name, range_size = RANGE_SIZE, max_workers = DEFAULT_WORKERS):
+        '''Download a page blob into file_name, fetching only the ranges reported by
+           get_page_ranges; the rest of the file is left as holes reading as zeros. Returns
+           the number of bytes downloaded.'''
+        properties = self.get_blob_properties(container_name, blob_name)
+        size = int(properties["content-length"])
+        ranges = []
+        for start, end in self.get_page_ranges(container_name, blob_name):
+            ranges.extend([(start + range_start, start + range_end) for range_start, range_end in self._blob_ranges(end + 1 - start, range_size)])
+        self._download_ranges(container_name, blob_name, file_name, size, ranges, properties.get("etag"), max_workers)
+        return sum(end + 1 - start for start, end in ranges)
+
+    def create_append_blob(self, container_name, blob_name, content_type = "", metadata = {}):
+        '''Create (or reset) an empty append blob.'''
+        req = RequestWithMethod("PUT", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+        req.add_header("Content-Length", "0")
+        req.add_header("x-ms-version", APPEND_BLOB_VERSION)
+        req.add_header("x-ms-blob-type", "AppendBlob")
+        if content_type: req.add_header("x-ms-blob-content-type", content_type)
+        for key, value in metadata.items():
+            req.add_header("x-ms-meta-%s" % key, value)
+        self._credentials.sign_request(req)
+        try:
+            response = self._urlopen(req, "create_append_blob")
+            return response.code
+        except URLError, e:
+            return e.code
+
+    def append_block(self, container_name, blob_name, data, append_position = None):
+        '''Append data (at most APPEND_MAX_BLOCK bytes) to an append blob and return the offset
+           it was written at. With append_position, the append fails with 412 unless the blob
+           is exactly that long, which keeps concurrent writers from interleaving.'''
+        req = RequestWithMethod("PUT", "%s/%s/%s?comp=appendblock" % (self.get_base_url(), container_name, blob_name), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        req.add_header("x-ms-version", APPEND_BLOB_VERSION)
+        if append_position is not None: req.add_header("x-ms-blob-condition-appendpos", "%d" % append_position)
+        self._credentials.sign_request(req)
+        return int(self._urlopen(req, "append_block").info().get("x-ms-blob-append-offset"))
+
+    def get_many(self, container_name, blob_names, max_workers = DEFAULT_WORKERS):
+        '''Download the blobs named in blob_names concurrently. Returns BulkResults yielding
+           (blob_name, data, error) as each download completes.'''
+        def get(blob_name):
+            return self.get_blob(container_name, blob_name)
+        return BulkResults(parallel_imap(get, blob_names, max_workers))
+
+    def put_many(self, container_name, blobs, max_workers = DEFAULT_WORKERS, content_type = ""):
+        '''Upload every (blob_name, data) pair of the iterable blobs concurrently. Returns
+           BulkResults yielding (blob_name, status code, error) as each upload completes.'''
+        def put((blob_name, data)):
+            return self.put_blob(container_name, blob_name, data, content_type)
+        return BulkResults((blob_name, code, error) for (blob_name, data), code, error in parallel_imap(put, blobs, max_workers))
+
+    def delete_prefix(self, container_name, blob_prefix, max_workers = DEFAULT_WORKERS):
+        '''Delete every blob whose name starts with blob_prefix. Listing is pipelined into the
+           deleting threads, so deletes start with the first listing page. Returns BulkResults
+           yielding (blob_name, None, error); call wait() to run it and read the totals.'''
+        names = (blob_name for blob_name, etag, last_modified in self.list_blobs(container_name, blob_prefix))
+        def delete(blob_name):
+            return self.delete_blob(container_name, blob_name)
+        return BulkResults(parallel_imap(delete, names, max_workers))
+
+    def copy_prefix(self, source_container, source_prefix, container_name, prefix = None, max_workers = DEFAULT_WORKERS, wait = False):
+        '''Copy every blob of source_container whose name starts with source_prefix into
+           container_name server side, replacing source_prefix with prefix when given. Copies
+           are started concurrently as the listing streams in. Returns BulkResults yielding
+           (source blob name, (copy_id, copy_status), error). With wait, each copy is followed
+           until it completes and the result is its final get_copy_status dict; copies that
+           fail or are aborted are reported as errors.'''
+        names = (blob_name for blob_name, etag, last_modified in self.list_blobs(source_container, source_prefix))
+        def copy(blob_name):
+            target = blob_name
+            if prefix is not None: target = prefix + blob_name[len(source_prefix or ""):]
+            copy_id, status = self.copy_blob(source_container, blob_name, container_name, target)
+            if not wait: return copy_id, status
+            status = self.wait_for_copy(container_name, target)
+            if status.get("status") != "success":
+                raise IOError("Copy of %s/%s to %s/%s ended as %s" % (source_container, blob_name, container_name, target, status.get("status")))
+            return status
+        return BulkResults(parallel_imap(copy, names, max_workers))
+
+class BlobCache(object):
+    '''Read-through cache in front of a BlobStorage's get_blob and get_blob_with_metadata.
+
+       Entries are keyed by container and blob name and revalidated with a conditional GET
+       (If-None-Match on the cached ETag); a 304 reply is served from the cache. Entries
+       validated less than ttl seconds ago are served without any request. The least recently
+       used entries are evicted once the cached bodies exceed max_bytes. With directory, bodies
+       are stored there and survive restarts; otherwise they are kept in memory. With
+       serve_stale_on_error, a cached copy is returned when revalidation fails for another
+       reason than the blob being gone. Other BlobStorage methods are passed through unchanged.'''
+    def __init__(self, storage, max_bytes = 64 * 1024 * 1024, ttl = 0, directory = None, serve_stale_on_error = False):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.serve_stale_on_error = serve_stale_on_error
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.bytes_saved = 0
+        self._entries = OrderedDict() # (container, blob) -> entry dict, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            self._load()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1("%s/%s" % key).hexdigest())
+
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".meta"): continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                found.append((os.path.getmtime(path), entry))
+            except (IOError, ValueError):
+                continue
+        for mtime, entry in sorted(found):
+            entry["data"] = None
+            self._entries[(entry["container"], entry["blob"])] = entry
+            self._size += entry["size"]
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last = False)
+            self._size -= entry["size"]
+            if self.directory is not None:
+                for path in (self._path(key), self._path(key) + ".meta"):
+                    if os.path.exists(path): os.remove(path)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+        if entry is None or self.directory is None:
+            return entry
+        try:
+            # Touch the index file so the LRU order survives a restart.
+            os.utime(self._path(key) + ".meta", None)
+            with open(self._path(key), "rb") as f:
+                return dict(entry, data = f.read())
+        except (IOError, OSError):
+            self.invalidate(*key)
+            return None
+
+    def _write_temp(self, data):
+        # Each store writes its own temporary files; _load only reads the .meta files.
+        fd, temp_file = tempfile.mkstemp(suffix = ".tmp", dir = self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return temp_file
+
+    def _store(self, key, etag, metadata, data):
+        if etag is None or len(data) > self.max_bytes:
+            return
+        entry = dict(container = key[0], blob = key[1], etag = etag, metadata = metadata, size = len(data), validated = time.time(), data = data)
+        if self.directory is not None:
+            path = self._path(key)
+            data_file = self._write_temp(data)
+            entry["data"] = None
+            meta_file = self._write_temp(json.dumps(entry))
+        with self._lock:
+            if self.directory is not None:
+                # Published together, so concurrent stores of a key can't pair one's body with
+                # the other's ETag.
+                os.rename(data_file, path)
+                os.rename(meta_file, path + ".meta")
+            previous = self._entries.pop(key, None)
+            if previous is not None: self._size -= previous["size"]
+            self._entries[key] = entry
+            self._size += entry["size"]
+            self._evict()
+
+    def _hit(self, entry, revalidated):
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += entry["size"]
+            if revalidated:
+                self.revalidations += 1
+                self._entries.get((entry["container"], entry["blob"]), {})["validated"] = time.time()
+        return entry["metadata"], entry["data"]
+
+    def invalidate(self, container_name, blob_name):
+        key = (container_name, blob_name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None: self._size -= entry["size"]
+        if entry is not None and self.directory is not None:
+            for path in (self._path(key), self._path(key) + ".meta"):
+                if os.path.exists(path): os.remove(path)
+
+    def get_blob_with_metadata(self, container_name, blob_name):
+        key = (container_name, blob_name)
+        entry = self._lookup(key)
+        if entry is not None and self.ttl and time.time() - entry["validated"] < self.ttl:
+            return self._hit(entry, False)
+        try:
+            response = self.storage._open_blob(container_name, blob_name, entry is not None and entry["etag"] or None)
+        except HTTPError, e:
+            if e.code == 404: self.invalidate(container_name, blob_name)
+            elif entry is not None and self.serve_stale_on_error: return self._hit(entry, False)
+            raise
+        except (URLError, httplib.HTTPException, socket.error):
+            if entry is not None and self.serve_stale_on_error: return self._hit(entry, False)
+            raise
+        if response.code == 304 and entry is not None:
+            return self._hit(entry, True)
+        metadata, data = self.storage._get_metadata(response), response.read()
+        with self._lock:
+            self.misses += 1
+        self._store(key, response.info().get("etag"), metadata, data)
+        return metadata, data
+
+    def get_blob(self, container_name, blob_name):
+        return self.get_blob_with_metadata(container_name, blob_name)[1]
+
+    def stats(self):
+        with self._lock:
+            return dict(hits = self.hits, misses = self.misses, revalidations = self.revalidations, bytes_saved = self.bytes_saved, entries = len(self._entries), bytes = self._size)
+
+def file_md5(file_name):
+    '''Return the base64 MD5 digest of a file, as used by Content-MD5.'''
+    md5 = hashlib.md5()
+    with open(file_name, "rb") as f:
+        for data in iter(lambda: f.read(READ_CHUNK_SIZE), ""):
+            md5.update(data)
+    return base64.b64encode(md5.digest())
+
+class DirectorySync(object):
+    '''Mirror a local directory tree to the blobs of a container under prefix, or back.
+
+       Local files are compared with the container listing by size and Content-MD5 and only
+       the differing ones are transferred, by max_workers threads. A manifest (by default
+       SYNC_MANIFEST_NAME at the top of the directory) records the size, mtime, MD5 and ETag
+       of every file after each sync, so an unchanged file is recognised from its stat() and
+       the listing alone and only new or modified files are hashed. With delete, blobs (on
+       upload) or files (on download) missing from the source are removed. upload() and
+       download() return a dict with transferred, skipped and deleted counts and a list of
+       (name, error) failures.'''
+    def __init__(self, storage, local_dir, container_name, prefix = "", max_workers = DEFAULT_WORKERS, manifest_file = None):
+        self.storage = storage
+        self.local_dir = local_dir
+        self.container_name = container_name
+        self.prefix = prefix
+        self.max_workers = max_workers
+        if manifest_file is None:
+            manifest_file = os.path.join(local_dir, SYNC_MANIFEST_NAME)
+        self.manifest_file = manifest_file
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get("container") != self.container_name or manifest.get("prefix") != self.prefix:
+            return {}
+        return manifest.get("files", {})
+
+    def _save_manifest(self, files):
+        with open(self.manifest_file + ".tmp", "w") as f:
+            json.dump(dict(container = self.container_name, prefix = self.prefix, files = files), f)
+        os.rename(self.manifest_file + ".tmp", self.manifest_file)
+
+    def _local_path(self, name):
+        # Blob names come from the listing; one like "a/../../x" must not escape local_dir.
+        root = os.path.abspath(self.local_dir)
+        path = os.path.abspath(os.path.join(root, *name.split("/")))
+        if not path.startswith(root + os.sep):
+            raise ValueError("Blob name %r is outside of %s" % (name, self.local_dir))
+        return path
+
+    def _local_files(self):
+        files = {}
+        manifest_path = os.path.abspath(self.manifest_file)
+        for root, dirs, names in os.walk(self.local_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.abspath(path) in (manifest_path, manifest_path + ".tmp"): continue
+                files[os.path.relpath(path, self.local_dir).replace(os.sep, "/")] = path
+        return files
+
+    def _state(self, path, known):
+        '''Return [size, mtime, md5, etag] for a local file, hashing it only if it changed
+           since known (its manifest record) was written.'''
+        st = os.stat(path)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime:
+            return list(known)
+        return [st.st_size, st.st_mtime, file_md5(path), None]
+
+    def _same(self, state, remote):
+        if remote is None or int(remote.get("Content-Length") or -1) != state[0]: return False
+        if remote.get("Content-MD5"): return remote["Content-MD5"] == state[2]
+        return state[3] is not None and state[3] == (remote.get("Etag") or "").strip('"')
+
+    def _run(self, func, items):
+        result = dict(transferred = 0, failed = [])
+        for name, value, error in parallel_imap(func, items, self.max_workers):
+            if error is None and isinstance(value, int) and value >= 300: error = value
+            if error is None: result["transferred"] += 1
+            else: result["failed"].append((name, error))
+        return result
+
+    def upload(self, delete = False):
+        manifest = self._load_manifest()
+        remote = dict(self.storage.list_blobs_with_properties(self.container_name, self.prefix or None))
+        files, changed = {}, []
+        for name, path in self._local_files().items():
+            state = self._state(path, manifest.get(name))
+            files[name] = state
+            if not self._same(state, remote.get(self.prefix + name)):
+                changed.append(name)
+
+        def upload(name):
+            state = files[name]
+            # The stored Content-MD5 is what the next listing is compared with. Files of a
+            # single block take one Put Blob rather than a block upload with its own threads.
+            if state[0] <= BLOCK_SIZE:
+                with open(self._local_path(name), "rb") as f:
+                    return self.storage.put_blob(self.container_name, self.prefix + name, f.read(), compute_md5 = True)
+            return self.storage.upload_blob_from_file(self.container_name, self.prefix + name, self._local_path(name), content_md5 = state[2])
+
+        result = self._run(upload, changed)
+        result["skipped"] = len(files) - len(changed)
+        result["deleted"] = 0
+        # Failed files are left out of the manifest so the next sync retries them.
+        failed = set(name for name, error in result["failed"])
+        for name in failed: del files[name]
+        if delete:
+            extra = [blob_name for blob_name in remote if blob_name[len(self.prefix):] not in files and blob_name[len(self.prefix):] not in failed]
+            deleted = BulkResults(parallel_imap(lambda blob_name: self.storage.delete_blob(self.container_name, blob_name), extra, self.max_workers)).wait()
+            result["deleted"] = deleted.succeeded
+            result["failed"].extend(deleted.errors)
+        self._save_manifest(files)
+        return result
+
+    def download(self, delete = False):
+        manifest = self._load_manifest()
+        local = self._local_files()
+        files, changed = {}, []
+        for blob_name, properties in self.storage.list_blobs_with_properties(self.container_name, self.prefix or None):
+            name = blob_name[len(self.prefix):]
+            state = name in local and self._state(local[name], manifest.get(name)) or None
+            if state is not None and self._same(state, properties):
+                files[name] = state
+            else:
+                changed.append((name, properties))
+
+        def download((name, properties)):
+            path = self._local_path(name)
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory): os.makedirs(directory)
+            # Likewise a blob of a single range is fetched with one GET.
+            if int(properties.get("Content-Length") or 0) <= RANGE_SIZE:
+                data = self.storage.get_blob(self.container_name, self.prefix + name)
+                with open(path, "wb") as f:
+                    f.write(data)
+            else:
+                self.storage.download_blob_to_file(self.container_name, self.prefix + name, path)
+            st = os.stat(path)
+            files[name] = [st.st_size, st.st_mtime, properties.get("Content-MD5") or file_md5(path), (properties.get("Etag") or "").strip('"')]
+
+        result = self._run(download, changed)
+        result["failed"] = [(name, error) for (name, properties), error in result["failed"]]
+        result["skipped"] = len(files) - result["transferred"]
+        result["deleted"] = 0
+        if delete:
+            for name in set(local) - set(files) - set(name for name, properties in changed):
+                os.remove(local[name])
+                result["deleted"] += 1
+        self._save_manifest(files)
+        return result
+
+class AsyncStorage(object):
+    '''Asynchronous front end to a storage object: every public method of the wrapped object
+       is available under the same name, but runs on a pool of at most max_concurrency threads
+       and returns a Future straight away. Methods returning generators (list_blobs,
+       iter_entities, ...) resolve to lists. Requests share the wrapped object's credentials and
+       go through a connection pool sized for max_concurrency, so fan-out such as
+       gather([blobs.get_blob(c, name) for name in names]) is bounded in threads and sockets.
+
+       Python 2 has no asyncio; this uses threads and keeps the same fan-out/gather shape.'''
+    def __init__(self, storage, max_concurrency = DEFAULT_CONCURRENCY):
+        self.storage = storage
+        self._executor = Executor(max_concurrency)
+
+    def _call(self, func, *args, **kwargs):
+        result = func(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            result = list(result)
+        return result
+
+    def __getattr__(self, name):
+        func = getattr(self.storage, name)
+        if name.startswith('_') or not callable(func):
+            return func
+        def submit(*args, **kwargs):
+            return self._executor.submit(self._call, func, *args, **kwargs)
+        submit.__name__ = name
+        submit.__doc__ = func.__doc__
+        return submit
+
+    def map(self, name, argument_lists):
+        '''Call method name once per argument tuple and return the futures, in order.'''
+        return [getattr(self, name)(*arguments) for arguments in argument_lists]
+
+    def close(self):
+        self._executor.shutdown()
+
+class AsyncBlobStorage(AsyncStorage):
+    def __init__(self, host = DEVSTORE_BLOB_HOST, account_name = DEVSTORE_ACCOUNT, secret_key = DEVSTORE_SECRET_KEY, use_path_style_uris = None, credentials = None, max_concurrency = DEFAULT_CONCURRENCY, retry_policy = None, rate_limiter = None, instrumentation = None):
+        pool = ConnectionPool(max_idle_per_host = max_concurrency)
+        super(AsyncBlobStorage, self).__init__(BlobStorage(host, account_name, secret_key, use_path_style_uris, pool, credentials, retry_policy, rate_limiter, instrumentation), max_concurrency)
+
+class AsyncQueueStorage(AsyncStorage):
+    def __init__(self, host = DEVSTORE_QUEUE_HOST, account_name = DEVSTORE_ACCOUNT, secret_key = DEVSTORE_SECRET_KEY, use_path_style_uris = None, credentials = None, max_concurrency = DEFAULT_CONCURRENCY, retry_policy = None, rate_limiter = None, instrumentation = None):
+        pool = ConnectionPool(max_idle_per_host = max_concurrency)
+        super(AsyncQueueStorage, self).__init__(QueueStorage(host, account_name, secret_key, use_path_style_uris, pool, credentials, retry_policy, rate_limiter, instrumentation), max_concurrency)
+
+class AsyncTableStorage(AsyncStorage):
+    def __init__(self, host, account_name, secret_key, use_path_style_uris = None, credentials = None, max_concurrency = DEFAULT_CONCURRENCY, payload_format = PAYLOAD_ATOM, retry_policy = None, rate_limiter = None, instrumentation = None):
+        pool = ConnectionPool(max_idle_per_host = max_concurrency)
+        super(AsyncTableStorage, self).__init__(TableStorage(host, account_name, secret_key, use_path_style_uris, pool, credentials, payload_format, retry_policy, rate_limiter, instrumentation), max_concurrency)
+
+    def query_entities(self, table_name, filter = None, select = None, top = None):
+        '''Return a Future of the list of entities matching filter, across all pages.'''
+        return self.iter_entities(table_name, filter, select, top)
+
 def main():
     pass
 